@@ -9,7 +9,6 @@ import cv2
 import time
 import os.path
 
-import tf
 import rosbag
 import rospy
 # from message_filters import ApproximateTimeSynchronizer
@@ -25,7 +24,8 @@ from pybot.externals.log_utils import Decoder, LogReader, LogController, LogDB
 from pybot.vision.image_utils import im_resize
 from pybot.vision.imshow_utils import imshow_cv
 from pybot.vision.camera_utils import CameraIntrinsic
-from pybot.geometry.rigid_transform import RigidTransform
+from pybot.geometry.rigid_transform import RigidTransform, RigidTransformArray
+from pybot.utils.transform_tree import TransformTree
 from pybot.utils.dataset.sun3d_utils import SUN3DAnnotationDB
 
 class GazeboDecoder(Decoder): 
@@ -290,6 +290,7 @@ class ROSBagReader(LogReader):
 
         # TF relations
         self.relations_map_ = {}
+        self.tf_tree_ = None
         print('-' * 120 + '\n{:}\n'.format(self.log) + '-' * 120)
         
         # # Gazebo states (if available)
@@ -349,44 +350,25 @@ class ROSBagReader(LogReader):
     def establish_tfs(self, relations):
         """
         Perform a one-time look up of all the requested
-        *static* relations between frames (available via /tf)
+        *static* relations between frames (available via /tf, 
+        and /tf_static). All transforms are ingested in a single
+        pass into an in-process TransformTree (no ROS master
+        required), that is also available for time-varying
+        look ups via self.tf_tree
         """
 
-        # Init node and tf listener
-        rospy.init_node(self.__class__.__name__, disable_signals=True)
-        tf_listener = tf.TransformListener()
-
-        # Create tf decoder
-        tf_dec = TfDecoderAndPublisher(channel='/tf')
-
         # Establish tf relations
         print('{} :: Establishing tfs from ROSBag'.format(self.__class__.__name__))
-        for self.idx, (channel, msg, t) in enumerate(self.log.read_messages(topics='/tf')): 
-            tf_dec.decode(msg)
-            for (from_tf, to_tf) in relations:  
+        self.tf_tree_ = self.load_tf_tree()
 
-                # If the relations have been added already, skip
-                if (from_tf, to_tf) in self.relations_map_: 
-                    continue
-                    
-                # Check if the frames exist yet
-                if not tf_listener.frameExists(from_tf) or not tf_listener.frameExists(to_tf): 
-                    continue
-
-                # Retrieve the transform with common time
-                try:
-                    tcommon = tf_listener.getLatestCommonTime(from_tf, to_tf)
-                    (trans,rot) = tf_listener.lookupTransform(from_tf, to_tf, tcommon)
-                    self.relations_map_[(from_tf,to_tf)] = RigidTransform(tvec=trans, xyzw=rot)
-                    # print('\tSuccessfully received transform: {:} => {:} {:}'
-                    #       .format(from_tf, to_tf, self.relations_map_[(from_tf,to_tf)]))
-                except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException) as e:
-                    # print e
-                    pass
-
-            # Finish up once we've established all the requested tfs
-            if len(self.relations_map_) == len(relations): 
-                break
+        for (from_tf, to_tf) in relations: 
+            # Retrieve the transform with common time
+            try: 
+                self.relations_map_[(from_tf,to_tf)] = \
+                    self.tf_tree_.lookup(from_tf.lstrip('/'), to_tf.lstrip('/'))
+            except KeyError as e: 
+                # print e
+                pass
 
         try: 
             tfs = [self.relations_map_[(from_tf,to_tf)] for (from_tf, to_tf) in relations] 
@@ -400,6 +382,33 @@ class ROSBagReader(LogReader):
         
         return tfs 
 
+    def load_tf_tree(self, topics=['/tf', '/tf_static']): 
+        """
+        Ingest all the transforms (TFMessage) in a single 
+        indexed pass over the bag, and bulk-load the 
+        time-stamped edges into a TransformTree
+        """
+        edges = {}
+        for self.idx, (channel, msg, t) in enumerate(self.log.read_messages(topics=topics)): 
+            static = channel == '/tf_static'
+            for tf_msg in msg.transforms: 
+                key = (tf_msg.header.frame_id.lstrip('/'), tf_msg.child_frame_id.lstrip('/'), static)
+                trans, rot = tf_msg.transform.translation, tf_msg.transform.rotation
+                edges.setdefault(key, []).append(
+                    (tf_msg.header.stamp.to_sec(), rot.x, rot.y, rot.z, rot.w, trans.x, trans.y, trans.z))
+
+        tf_tree = TransformTree()
+        for (parent, child, static), items in edges.iteritems(): 
+            items = np.float64(items)
+            tf_tree.extend(parent, child, items[:,0], 
+                           RigidTransformArray(items[:,1:5], items[:,5:8]), static=static)
+        print('{} :: Loaded {:}'.format(self.__class__.__name__, tf_tree))
+        return tf_tree
+
+    @property
+    def tf_tree(self): 
+        return self.tf_tree_
+
     def calib(self, channels):
         assert(isinstance(channels, list))
         return self.retrieve_camera_calibration(channels)
@@ -18,7 +18,7 @@ from pybot.vision.image_utils import im_resize
 from pybot.vision.camera_utils import CameraIntrinsic
 from pybot.geometry.rigid_transform import RigidTransform
 from pybot.utils.dataset.sun3d_utils import SUN3DAnnotationDB
-from pybot.utils.pose_utils import PoseSampler
+from pybot.utils.pose_utils import PoseSampler, Trajectory
 from pybot.utils.misc import Accumulator
 
 
@@ -393,27 +393,35 @@ class TangoDB(LogDB):
 
         # 1. Iterate through both poses and images, and construct frames
         # with look up table for filename str -> (timestamp, pose, annotation) 
-        poses = []
+        pose_ts, poses = [], []
         pose_decode = lambda msg_item: \
                       self.dataset.decoder[pose_channel].decode(msg_item)
 
         # Note: Control flow for idx is critical since start_idx could
         # potentially change the offset and destroy the pose_index
+        rgb_items = []
         for idx, (t, ch, msg) in enumerate(self.dataset.itercursors()): 
-            pose = None
             if ch == pose_channel: 
                 try: 
-                    pose = pose_decode(msg)
+                    poses.append(pose_decode(msg))
+                    pose_ts.append(t)
                 except: 
-                    pose = None
-            poses.append(pose)
-
-        # Find valid and missing poses
-        # pose_inds: log_index -> closest_valid_index
-        valid_arr = np.array(
-            map(lambda item: item is not None, poses), dtype=np.bool)
-        pose_inds = TangoDB._nn_pose_fill(valid_arr)
-        if np.any(pose_inds < 0): 
+                    pass
+            elif ch == rgb_channel: 
+                rgb_items.append((idx, t, msg))
+
+        # Interpolate poses at the image timestamps (batched
+        # lookup within the time-sorted pose trajectory). Images
+        # outside the pose time span are clamped to the nearest
+        # (first/last) pose, and are retained
+        rgb_ts = np.float64([t for (_, t, _) in rgb_items])
+        if len(poses) and len(rgb_ts): 
+            trajectory = Trajectory.from_list(pose_ts, poses)
+            rgb_poses = trajectory.query(rgb_ts)
+            valid = np.ones(len(rgb_ts), dtype=np.bool)
+        else: 
+            rgb_poses, valid = [], np.zeros(len(rgb_ts), dtype=np.bool)
+        if not np.all(valid): 
             print('{} :: TangoDB poses are not fully synchronized, '
                   'skipping few'.format(self.__class__.__name__))
 
@@ -424,10 +432,9 @@ class TangoDB(LogDB):
         img_decode = lambda msg_item: \
                     self.dataset.decoder[rgb_channel].decode(msg_item)
         self.frame_index_ = OrderedDict([
-            (img_msg, TangoFrame(idx, t, img_msg, poses[pose_inds[idx]], 
+            (img_msg, TangoFrame(idx, t, img_msg, rgb_poses[j], 
                                  self.annotationdb[img_msg], img_decode))
-            for idx, (t, ch, img_msg) in enumerate(self.dataset.itercursors()) \
-            if ch == rgb_channel and pose_inds[idx] >= 0
+            for j, (idx, t, img_msg) in enumerate(rgb_items) if valid[j]
         ])
         self.frame_idx2name_ = OrderedDict([
             (idx, k) for idx, k in enumerate(self.frame_index_.keys())
@@ -440,7 +447,7 @@ class TangoDB(LogDB):
         """
         Ground truth reader interface for Images 
         [time, pose, annotation] : lookup corresponding annotation, 
-        and filled in poses from nearest available timestamp
+        and poses interpolated at the image timestamp
         """
         # self.check_ground_truth_availability()
 
@@ -1 +1 @@
-from .rigid_transform import Pose, RigidTransform, Quaternion, Sim3
+from .rigid_transform import Pose, RigidTransform, RigidTransformArray, Quaternion, QuaternionArray, Sim3
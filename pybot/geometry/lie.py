@@ -0,0 +1,304 @@
+"""
+Batched exponential / logarithm maps, adjoints and Jacobians for
+SO(3), SE(3) and Sim(3) in closed-form.
+
+Tangent vectors are stacked row-wise, with the rotational component
+first (similar to rpyxyz):
+    so(3):  w [N x 3]
+    se(3):  (w, v) [N x 6]
+    sim(3): (w, v, sigma) [N x 7], with scale s = exp(sigma)
+
+Group elements are [N x 3 x 3] rotations, [N x 4 x 4] rigid-body
+transformations [R t; 0 1], and [N x 4 x 4] similarity
+transformations [sR t; 0 1].
+
+The Sim(3) Jacobians have no compact closed-form, and are instead
+evaluated as the series sum_k ad^k / (k+1)! with scaling and squaring.
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+from math import factorial
+
+import numpy as np
+from pybot.geometry.quaternion import QuaternionArray
+
+# Angles below which the Taylor expansions of the
+# coefficients are used (avoids catastrophic cancellation)
+_SMALL_ANGLE = 1e-2
+_SIM3_EPS = 1e-5
+
+# Taylor order, and norm below which it is applied (in _phi1_exp)
+_SERIES_ORDER = 12
+_SERIES_NORM = 0.5
+
+###############################################################################
+def _taylor(theta, f, coeffs):
+    """
+    Evaluate f(theta), and switch to its Taylor expansion
+    c0 + c1 theta^2 + c2 theta^4 for small angles
+    """
+    small = theta < _SMALL_ANGLE
+    t = np.where(small, 1.0, theta)
+    t2 = theta * theta
+    return np.where(small, coeffs[0] + t2 * (coeffs[1] + t2 * coeffs[2]), f(t))
+
+def _angle(w):
+    return np.sqrt(np.sum(w * w, axis=1))
+
+def _sq(W):
+    return np.einsum('nij,njk->nik', W, W)
+
+def _mv(A, v):
+    return np.einsum('nij,nj->ni', A, v)
+
+def _identity(N, n=3):
+    return np.tile(np.eye(n), (N,1,1))
+
+def hat(w):
+    """ Skew-symmetric (cross-product) matrices [N x 3 x 3] of w [N x 3] """
+    w = np.asarray(w, dtype=np.float64).reshape(-1,3)
+    W = np.zeros((len(w),3,3), dtype=np.float64)
+    W[:,0,1], W[:,0,2] = -w[:,2], w[:,1]
+    W[:,1,0], W[:,1,2] = w[:,2], -w[:,0]
+    W[:,2,0], W[:,2,1] = -w[:,1], w[:,0]
+    return W
+
+def vee(W):
+    """ Inverse of hat: [N x 3 x 3] skew-symmetric matrices to [N x 3] """
+    W = np.asarray(W, dtype=np.float64).reshape(-1,3,3)
+    return np.vstack([W[:,2,1], W[:,0,2], W[:,1,0]]).T
+
+###############################################################################
+# SO(3)
+
+def so3_exp(w):
+    """ Exponential map (Rodrigues) so(3) [N x 3] -> SO(3) [N x 3 x 3] """
+    w = np.asarray(w, dtype=np.float64).reshape(-1,3)
+    theta = _angle(w)
+    a = _taylor(theta, lambda t: np.sin(t) / t, (1., -1./6, 1./120))
+    b = _taylor(theta, lambda t: (1 - np.cos(t)) / (t * t), (0.5, -1./24, 1./720))
+    W = hat(w)
+    return _identity(len(w)) + a[:,None,None] * W + b[:,None,None] * _sq(W)
+
+def so3_log(R):
+    """ Logarithm map SO(3) [N x 3 x 3] -> so(3) [N x 3] """
+    return quat_log(QuaternionArray.from_matrix(R).q)
+
+def quat_exp(w):
+    """ Exponential map so(3) [N x 3] -> unit quaternions [N x 4] (xyzw) """
+    w = np.asarray(w, dtype=np.float64).reshape(-1,3)
+    theta = _angle(w)
+    s = _taylor(theta, lambda t: np.sin(t / 2) / t, (0.5, -1./48, 1./3840))
+    return np.hstack([w * s[:,None], np.cos(theta / 2)[:,None]])
+
+def quat_log(q):
+    """ Logarithm map unit quaternions [N x 4] (xyzw) -> so(3) [N x 3] """
+    q = np.asarray(q, dtype=np.float64).reshape(-1,4)
+
+    # Restrict to the hemisphere with w >= 0 (angle in [0, pi])
+    q = np.where(q[:,3:] < 0, -q, q)
+    v, w = q[:,:3], q[:,3]
+    n = _angle(v)
+    small = n < 1e-12
+    scale = np.where(small, 2. / np.where(small, w, 1.),
+                     2. * np.arctan2(n, w) / np.where(small, 1., n))
+    return v * scale[:,None]
+
+def so3_left_jacobian(w):
+    """ Left Jacobian of SO(3) [N x 3 x 3] """
+    w = np.asarray(w, dtype=np.float64).reshape(-1,3)
+    theta = _angle(w)
+    b = _taylor(theta, lambda t: (1 - np.cos(t)) / (t * t), (0.5, -1./24, 1./720))
+    c = _taylor(theta, lambda t: (t - np.sin(t)) / (t * t * t), (1./6, -1./120, 1./5040))
+    W = hat(w)
+    return _identity(len(w)) + b[:,None,None] * W + c[:,None,None] * _sq(W)
+
+def so3_left_jacobian_inv(w):
+    """ Inverse of the left Jacobian of SO(3) [N x 3 x 3] """
+    w = np.asarray(w, dtype=np.float64).reshape(-1,3)
+    theta = _angle(w)
+    d = _taylor(theta, lambda t: 1. / (t * t) - (1 + np.cos(t)) / (2 * t * np.sin(t)),
+                (1./12, 1./720, 1./30240))
+    W = hat(w)
+    return _identity(len(w)) - 0.5 * W + d[:,None,None] * _sq(W)
+
+def so3_right_jacobian(w):
+    """ Right Jacobian of SO(3) [N x 3 x 3], Jr(w) = Jl(-w) """
+    return so3_left_jacobian(-np.asarray(w, dtype=np.float64))
+
+def so3_right_jacobian_inv(w):
+    """ Inverse of the right Jacobian of SO(3) [N x 3 x 3] """
+    return so3_left_jacobian_inv(-np.asarray(w, dtype=np.float64))
+
+###############################################################################
+# SE(3)
+
+def se3_exp_quat(xi):
+    """ Exponential map se(3) [N x 6] -> (quaternions [N x 4] (xyzw), translations [N x 3]) """
+    xi = np.asarray(xi, dtype=np.float64).reshape(-1,6)
+    w, v = xi[:,:3], xi[:,3:]
+    return quat_exp(w), _mv(so3_left_jacobian(w), v)
+
+def se3_log_quat(q, t):
+    """ Logarithm map (quaternions [N x 4] (xyzw), translations [N x 3]) -> se(3) [N x 6] """
+    w = quat_log(q)
+    t = np.asarray(t, dtype=np.float64).reshape(-1,3)
+    return np.hstack([w, _mv(so3_left_jacobian_inv(w), t)])
+
+def se3_exp(xi):
+    """ Exponential map se(3) [N x 6] -> SE(3) [N x 4 x 4] """
+    xi = np.asarray(xi, dtype=np.float64).reshape(-1,6)
+    w, v = xi[:,:3], xi[:,3:]
+    T = _identity(len(xi), n=4)
+    T[:,:3,:3] = so3_exp(w)
+    T[:,:3,3] = _mv(so3_left_jacobian(w), v)
+    return T
+
+def se3_log(T):
+    """ Logarithm map SE(3) [N x 4 x 4] -> se(3) [N x 6] """
+    T = np.asarray(T, dtype=np.float64).reshape(-1,4,4)
+    w = so3_log(T)
+    return np.hstack([w, _mv(so3_left_jacobian_inv(w), T[:,:3,3])])
+
+def se3_adjoint(T):
+    """ Adjoint of SE(3) [N x 6 x 6]: Ad(T) xi = vee(T hat(xi) T^-1) """
+    T = np.asarray(T, dtype=np.float64).reshape(-1,4,4)
+    R, t = T[:,:3,:3], T[:,:3,3]
+    Ad = np.zeros((len(T),6,6), dtype=np.float64)
+    Ad[:,:3,:3] = R
+    Ad[:,3:,3:] = R
+    Ad[:,3:,:3] = np.einsum('nij,njk->nik', hat(t), R)
+    return Ad
+
+def _se3_Q(w, v):
+    """ Off-diagonal block of the left Jacobian of SE(3) """
+    theta = _angle(w)
+    c = _taylor(theta, lambda t: (t - np.sin(t)) / t**3, (1./6, -1./120, 1./5040))
+    e = _taylor(theta, lambda t: (t * t + 2 * np.cos(t) - 2) / (2 * t**4),
+                (1./24, -1./720, 1./40320))
+    f = _taylor(theta, lambda t: (2 * t - 3 * np.sin(t) + t * np.cos(t)) / (2 * t**5),
+                (1./120, -1./2520, 1./120960))
+    W, V = hat(w), hat(v)
+    mm = lambda *args: reduce(lambda A, B: np.einsum('nij,njk->nik', A, B), args)
+    WV, VW, WVW = mm(W, V), mm(V, W), mm(W, V, W)
+    return 0.5 * V + \
+        c[:,None,None] * (WV + VW + WVW) + \
+        e[:,None,None] * (mm(W, WV) + mm(VW, W) - 3 * WVW) + \
+        f[:,None,None] * (mm(WVW, W) + mm(W, WVW))
+
+def se3_left_jacobian(xi):
+    """ Left Jacobian of SE(3) [N x 6 x 6] """
+    xi = np.asarray(xi, dtype=np.float64).reshape(-1,6)
+    w, v = xi[:,:3], xi[:,3:]
+    J = np.zeros((len(xi),6,6), dtype=np.float64)
+    J[:,:3,:3] = J[:,3:,3:] = so3_left_jacobian(w)
+    J[:,3:,:3] = _se3_Q(w, v)
+    return J
+
+def se3_right_jacobian(xi):
+    """ Right Jacobian of SE(3) [N x 6 x 6], Jr(xi) = Jl(-xi) """
+    return se3_left_jacobian(-np.asarray(xi, dtype=np.float64))
+
+###############################################################################
+# Sim(3)
+
+def _sim3_W(w, sigma):
+    """
+    Translational Jacobian of Sim(3) [N x 3 x 3], such that
+    t = W(w, sigma) v (reduces to the SO(3) left Jacobian for sigma=0)
+    """
+    theta = _angle(w)
+    small_t, small_s = theta < _SIM3_EPS, np.fabs(sigma) < _SIM3_EPS
+    t = np.where(small_t, 1.0, theta)
+    s = np.where(small_s, 1.0, sigma)
+    es = np.exp(sigma)
+
+    C = np.where(small_s, 1.0 + sigma / 2, np.expm1(s) / s)
+
+    # Generic case (theta > eps)
+    a, b, c = es * np.sin(t), es * np.cos(t), t * t + sigma * sigma
+    A = (a * sigma + (1 - b) * t) / (t * c)
+    B = (C - ((b - 1) * sigma + a * t) / c) / (t * t)
+
+    # Small rotation (theta ~ 0)
+    A0 = np.where(small_s, 0.5 + sigma / 3, ((s - 1) * es + 1) / (s * s))
+    B0 = np.where(small_s, 1./6 + sigma / 8, ((s * s / 2 - s + 1) * es - 1) / (s * s * s))
+    A, B = np.where(small_t, A0, A), np.where(small_t, B0, B)
+
+    W = hat(w)
+    return A[:,None,None] * W + B[:,None,None] * _sq(W) + \
+        C[:,None,None] * _identity(len(w))
+
+def sim3_exp(xi):
+    """ Exponential map sim(3) [N x 7] -> Sim(3) [N x 4 x 4] ([sR t; 0 1]) """
+    xi = np.asarray(xi, dtype=np.float64).reshape(-1,7)
+    w, v, sigma = xi[:,:3], xi[:,3:6], xi[:,6]
+    T = _identity(len(xi), n=4)
+    T[:,:3,:3] = np.exp(sigma)[:,None,None] * so3_exp(w)
+    T[:,:3,3] = _mv(_sim3_W(w, sigma), v)
+    return T
+
+def sim3_log(T):
+    """ Logarithm map Sim(3) [N x 4 x 4] ([sR t; 0 1]) -> sim(3) [N x 7] """
+    T = np.asarray(T, dtype=np.float64).reshape(-1,4,4)
+    s = np.cbrt(np.linalg.det(T[:,:3,:3]))
+    w = so3_log(T[:,:3,:3] / s[:,None,None])
+    sigma = np.log(s)
+    v = np.linalg.solve(_sim3_W(w, sigma), T[:,:3,3,None])[:,:,0]
+    return np.hstack([w, v, sigma[:,None]])
+
+def sim3_adjoint(T):
+    """ Adjoint of Sim(3) [N x 7 x 7]: Ad(T) xi = vee(T hat(xi) T^-1) """
+    T = np.asarray(T, dtype=np.float64).reshape(-1,4,4)
+    sR, t = T[:,:3,:3], T[:,:3,3]
+    R = sR / np.cbrt(np.linalg.det(sR))[:,None,None]
+    Ad = np.zeros((len(T),7,7), dtype=np.float64)
+    Ad[:,:3,:3] = R
+    Ad[:,3:6,:3] = np.einsum('nij,njk->nik', hat(t), R)
+    Ad[:,3:6,3:6] = sR
+    Ad[:,3:6,6] = -t
+    Ad[:,6,6] = 1.0
+    return Ad
+
+def _sim3_ad(xi):
+    """ Adjoint representation ad(xi) [N x 7 x 7] of sim(3) [N x 7] """
+    xi = np.asarray(xi, dtype=np.float64).reshape(-1,7)
+    w, v, sigma = xi[:,:3], xi[:,3:6], xi[:,6]
+    W = hat(w)
+    ad = np.zeros((len(xi),7,7), dtype=np.float64)
+    ad[:,:3,:3] = W
+    ad[:,3:6,:3] = hat(v)
+    ad[:,3:6,3:6] = W + sigma[:,None,None] * np.eye(3)
+    ad[:,3:6,6] = -v
+    return ad
+
+def _phi1_exp(X):
+    """
+    Evaluates phi1(X) = sum_k X^k / (k+1)! [N x n x n], with scaling
+    and squaring: phi1(2X) = phi1(X) (exp(X) + I) / 2, exp(2X) = exp(X)^2
+    """
+    N, n = X.shape[:2]
+    norm = np.max(np.sum(np.fabs(X), axis=2)) if N else 0.
+    squarings = max(0, int(np.ceil(np.log2(norm / _SERIES_NORM)))) if norm > 0 else 0
+    Xs = X / 2.0 ** squarings
+
+    # Horner evaluation of the truncated series
+    I = _identity(N, n=n)
+    P = I / factorial(_SERIES_ORDER + 1)
+    for k in range(_SERIES_ORDER, 0, -1):
+        P = I / factorial(k) + np.einsum('nij,njk->nik', Xs, P)
+
+    E = I + np.einsum('nij,njk->nik', Xs, P)
+    for _ in range(squarings):
+        P = 0.5 * np.einsum('nij,njk->nik', P, E + I)
+        E = np.einsum('nij,njk->nik', E, E)
+    return P
+
+def sim3_left_jacobian(xi):
+    """ Left Jacobian of Sim(3) [N x 7 x 7] """
+    return _phi1_exp(_sim3_ad(xi))
+
+def sim3_right_jacobian(xi):
+    """ Right Jacobian of Sim(3) [N x 7 x 7], Jr(xi) = Jl(-xi) """
+    return sim3_left_jacobian(-np.asarray(xi, dtype=np.float64))
@@ -15,6 +15,8 @@ class Quaternion(object):
        : (qx, qy, qz, qw)
     
     """
+    __slots__ = ['q']
+
     def __init__ (self, q=[0,0,0,1]):
         if isinstance(q, Quaternion): 
             self.q = q.q.copy()
@@ -32,6 +34,12 @@ class Quaternion(object):
     def __getitem__ (self, i):
         return self.q[i]
 
+    def __getstate__(self): 
+        return {'q': self.q}
+
+    def __setstate__(self, state): 
+        self.q = state['q']
+
     # Basic operations
 
     def __mul__(self, other):
@@ -227,6 +235,355 @@ class Quaternion(object):
 
 
 
+###############################################################################
+class QuaternionArray(object):
+    """
+    Array-backed Quaternion class that stores N quaternions
+    contiguously, and vectorizes the operations of Quaternion
+       : [N x 4] (qx, qy, qz, qw)
+
+    """
+    __slots__ = ['q']
+
+    def __init__(self, q=[[0,0,0,1]]):
+        if isinstance(q, (Quaternion, QuaternionArray)):
+            self.q = q.q.reshape(-1,4).copy()
+        else:
+            try:
+                self.q = np.array(q, np.float64).reshape(-1,4)
+            except:
+                raise TypeError("QuaternionArray can not be initialized from {:}".format(type(q)))
+
+        self.normalize()
+
+    def __repr__(self):
+        return '%s' % self.q
+
+    def __len__(self):
+        return len(self.q)
+
+    def __getstate__(self):
+        return {'q': self.q}
+
+    def __setstate__(self, state):
+        self.q = state['q']
+
+    def __getitem__(self, i):
+        """
+        Integer indexing returns a Quaternion, while slicing
+        or array indexing returns a QuaternionArray
+        """
+        if isinstance(i, (int, np.integer)):
+            return Quaternion(self.q[i])
+        return QuaternionArray(self.q[i])
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    # Basic operations
+
+    def __mul__(self, other):
+        """
+        Multiply quaternions element-wise with another, a single
+        quaternion (or array of length 1) is broadcasted
+        """
+        if isinstance(other, (Quaternion, QuaternionArray)):
+            return QuaternionArray(QuaternionArray.multiply(self.q, other.q))
+        else:
+            raise TypeError('QuaternionArray multiply error')
+
+    @staticmethod
+    def multiply(q1, q0):
+        """ Multiply [N x 4] quaternions (xyzw), identical to tf.quaternion_multiply """
+        x0, y0, z0, w0 = q0[...,0], q0[...,1], q0[...,2], q0[...,3]
+        x1, y1, z1, w1 = q1[...,0], q1[...,1], q1[...,2], q1[...,3]
+        return np.stack([ x1*w0 + y1*z0 - z1*y0 + w1*x0,
+                         -x1*z0 + y1*w0 + z1*x0 + w1*y0,
+                          x1*y0 - y1*x0 + z1*w0 + w1*z0,
+                         -x1*x0 - y1*y0 - z1*z0 + w1*w0], axis=-1)
+
+    def normalize(self):
+        """ Check validity of unit-quaternion norms """
+        norm = self.norm()
+        invalid = np.fabs(norm - 1) > 1e-6
+        if invalid.any():
+            self.q[invalid] /= norm[invalid,np.newaxis]
+
+    def norm(self):
+        return np.linalg.norm(self.q, axis=1)
+
+    def dot(self, other):
+        return np.sum(self.q * other.q, axis=-1)
+
+    def inverse(self):
+        """ Invert rotations assuming unit quaternions """
+        return self.conjugate()
+
+    def conjugate(self):
+        """ Quaternion conjugates """
+        q = self.q * -1.0
+        q[:,3] = self.q[:,3]
+        return QuaternionArray(q)
+
+    def rotate(self, v, outer=False):
+        """
+        Rotate vectors with these quaternions
+
+        outer=False: Rotate [N x 3] vectors element-wise, a single
+                     quaternion rotates all [M x 3] vectors, and a
+                     single vector [3] is rotated by all quaternions
+        outer=True:  Rotate every one of the [M x 3] vectors with each
+                     of the N quaternions, returns [N x M x 3]
+        """
+        v = np.asarray(v)
+        if outer:
+            return np.einsum('nij,mj->nmi', self.R, v.reshape(-1,3))
+        elif len(self.q) == 1:
+            return np.dot(v, self.R[0].T)
+
+        # v' = v + 2 * w * (u x v) + 2 * u x (u x v)
+        u, w = self.q[:,:3], self.q[:,3:]
+        uv = np.cross(u, v)
+        return v + 2.0 * (w * uv + np.cross(u, uv))
+
+    def slerp(self, other, w):
+        """
+        Spherical linear interpolation from these quaternions
+        towards the other, with per-element weights w in [0, 1]
+        (w=0: self, w=1: other)
+        """
+        w = np.asarray(w, dtype=np.float64).reshape(-1,1)
+        assert((w >= 0).all() and (w <= 1).all())
+
+        q0, q1 = self.q, other.q
+        cos_omega = np.sum(q0 * q1, axis=1, keepdims=True)
+
+        # Interpolate along the shortest path
+        q1 = np.where(cos_omega < 0, -q1, q1)
+        cos_omega = np.minimum(np.fabs(cos_omega), 1)
+
+        omega = np.arccos(cos_omega)
+        sin_omega = np.sin(omega)
+        unstable = np.fabs(sin_omega) < 1e-6
+        sin_omega[unstable] = 1.0
+
+        a = np.where(unstable, 1 - w, np.sin((1 - w) * omega) / sin_omega)
+        b = np.where(unstable, w, np.sin(w * omega) / sin_omega)
+
+        # Direct linear interpolation (re-normalized on construction)
+        # for numerically unstable regions
+        return QuaternionArray(q0 * a + q1 * b)
+
+    def interpolate(self, other, this_weight):
+        """ Vectorized Quaternion.interpolate (this_weight=1: self) """
+        return self.slerp(other, 1 - np.asarray(this_weight))
+
+    # To conversions
+
+    def to_wxyz(self):
+        return np.roll(self.q, shift=1, axis=1)
+
+    def to_xyzw(self):
+        """ Return [N x 4] (x,y,z,w) representation """
+        return self.q
+
+    def to_rpy(self, axes='rxyz'):
+        """ Return [N x 3] Euler angles with XYZ convention """
+        try:
+            firstaxis, parity, repetition, frame = tf._AXES2TUPLE[axes.lower()]
+        except (AttributeError, KeyError):
+            _ = tf._TUPLE2AXES[axes]
+            firstaxis, parity, repetition, frame = axes
+
+        i = firstaxis
+        j = tf._NEXT_AXIS[i+parity]
+        k = tf._NEXT_AXIS[i-parity+1]
+
+        M = self.R
+        if repetition:
+            sy = np.sqrt(M[:,i,j]*M[:,i,j] + M[:,i,k]*M[:,i,k])
+            singular = sy <= tf._EPS
+            ax = np.where(singular, np.arctan2(-M[:,j,k], M[:,j,j]), np.arctan2(M[:,i,j], M[:,i,k]))
+            ay = np.arctan2(sy, M[:,i,i])
+            az = np.where(singular, 0.0, np.arctan2(M[:,j,i], -M[:,k,i]))
+        else:
+            cy = np.sqrt(M[:,i,i]*M[:,i,i] + M[:,j,i]*M[:,j,i])
+            singular = cy <= tf._EPS
+            ax = np.where(singular, np.arctan2(-M[:,j,k], M[:,j,j]), np.arctan2(M[:,k,j], M[:,k,k]))
+            ay = np.arctan2(-M[:,k,i], cy)
+            az = np.where(singular, 0.0, np.arctan2(M[:,j,i], M[:,i,i]))
+
+        if parity:
+            ax, ay, az = -ax, -ay, -az
+        if frame:
+            ax, az = az, ax
+        return np.vstack([ax, ay, az]).T
+
+    def to_angle_axis(self):
+        """ Return axis-angle representation, angles [N] and axes [N x 3] """
+        halftheta = np.arccos(np.clip(self.q[:,3], -1, 1))
+        identity = np.fabs(halftheta) < 1e-12
+        sin_halftheta = np.where(identity, 1.0, np.sin(halftheta))
+        axis = self.q[:,:3] / sin_halftheta[:,np.newaxis]
+        axis[identity] = (0, 0, 1)
+        return np.where(identity, 0, halftheta * 2), axis
+
+    def to_matrix(self):
+        """ Returns [N x 4 x 4] transformation matrices """
+        T = np.zeros((len(self.q), 4, 4), dtype=np.float64)
+        T[:,:3,:3] = self.R
+        T[:,3,3] = 1.0
+        return T
+
+    def to_list(self):
+        """ Returns a list of Quaternions """
+        return [Quaternion(q) for q in self.q]
+
+    # From conversions
+
+    @classmethod
+    def from_wxyz(cls, q):
+        return cls(np.roll(np.asarray(q).reshape(-1,4), shift=-1, axis=1))
+
+    @classmethod
+    def from_xyzw(cls, q):
+        return cls(q)
+
+    @classmethod
+    def from_list(cls, quats):
+        """ From a list of Quaternions """
+        return cls(np.vstack([q.q for q in quats]).reshape(-1,4))
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """
+        From [N x 3 x 3] or [N x 4 x 4] transformation matrices.
+        Vectorized form of tf.quaternion_from_matrix, and hence
+        follows the same branching (and sign) conventions.
+        """
+        M = np.asarray(matrix, dtype=np.float64)
+        M = M.reshape((-1,) + M.shape[-2:])[:,:3,:3]
+        N = len(M)
+        d = np.diagonal(M, axis1=1, axis2=2)
+
+        # Candidate quaternions for each of the 4 branches
+        q = np.empty((4, N, 4), dtype=np.float64)
+        t = np.empty((4, N), dtype=np.float64)
+
+        # Trace dominant
+        t[3] = d.sum(axis=1) + 1.0
+        q[3,:,3] = t[3]
+        q[3,:,2] = M[:,1,0] - M[:,0,1]
+        q[3,:,1] = M[:,0,2] - M[:,2,0]
+        q[3,:,0] = M[:,2,1] - M[:,1,2]
+
+        # Diagonal element i dominant
+        for i, j, k in [(0,1,2), (1,2,0), (2,0,1)]:
+            t[i] = d[:,i] - (d[:,j] + d[:,k]) + 1.0
+            q[i,:,i] = t[i]
+            q[i,:,j] = M[:,i,j] + M[:,j,i]
+            q[i,:,k] = M[:,k,i] + M[:,i,k]
+            q[i,:,3] = M[:,k,j] - M[:,j,k]
+
+        branch = np.where(t[3] > 1.0, 3, np.argmax(d, axis=1))
+        inds = np.arange(N)
+        return cls(q[branch, inds] * (0.5 / np.sqrt(t[branch, inds]))[:,np.newaxis])
+
+    @classmethod
+    def from_rpy(cls, roll, pitch, yaw, axes='rxyz'):
+        """ Construct QuaternionArray from [N] Euler angles """
+        try:
+            firstaxis, parity, repetition, frame = tf._AXES2TUPLE[axes.lower()]
+        except (AttributeError, KeyError):
+            _ = tf._TUPLE2AXES[axes]
+            firstaxis, parity, repetition, frame = axes
+
+        i = firstaxis
+        j = tf._NEXT_AXIS[i+parity]
+        k = tf._NEXT_AXIS[i-parity+1]
+
+        ai, aj, ak = np.broadcast_arrays(*[np.asarray(a, dtype=np.float64).ravel()
+                                           for a in (roll, pitch, yaw)])
+        if frame:
+            ai, ak = ak, ai
+        if parity:
+            aj = -aj
+
+        ci, si = np.cos(ai / 2.0), np.sin(ai / 2.0)
+        cj, sj = np.cos(aj / 2.0), np.sin(aj / 2.0)
+        ck, sk = np.cos(ak / 2.0), np.sin(ak / 2.0)
+        cc, cs = ci*ck, ci*sk
+        sc, ss = si*ck, si*sk
+
+        q = np.empty((len(ai), 4), dtype=np.float64)
+        if repetition:
+            q[:,i] = cj*(cs + sc)
+            q[:,j] = sj*(cc + ss)
+            q[:,k] = sj*(cs - sc)
+            q[:,3] = cj*(cc - ss)
+        else:
+            q[:,i] = cj*sc - sj*cs
+            q[:,j] = cj*ss + sj*cc
+            q[:,k] = cj*cs - sj*sc
+            q[:,3] = cj*cc + sj*ss
+        if parity:
+            q[:,j] *= -1
+
+        return cls(q)
+
+    @classmethod
+    def from_angle_axis(cls, theta, axis):
+        """ Construct QuaternionArray from [N] angles and [N x 3] axes """
+        theta = np.asarray(theta, dtype=np.float64).reshape(-1,1)
+        axis = np.asarray(axis, dtype=np.float64).reshape(-1,3)
+        norm = np.linalg.norm(axis, axis=1).reshape(-1,1)
+        degenerate = (norm == 0).ravel()
+        norm[degenerate] = 1.0
+
+        t = np.sin(theta / 2) / norm
+        q = np.empty((max(len(theta), len(axis)), 4), dtype=np.float64)
+        q[:,:3], q[:,3:] = axis * t, np.cos(theta / 2)
+        q[np.broadcast_to(degenerate, len(q))] = (0, 0, 0, 1)
+        return cls(q)
+
+    # Properties
+
+    @classmethod
+    def identity(cls, N=1):
+        return cls(np.tile([0.,0.,0.,1.], (N,1)))
+
+    @property
+    def matrix(self):
+        """ Returns [N x 4 x 4] transformation matrices """
+        return self.to_matrix()
+
+    @property
+    def R(self):
+        """ Returns [N x 3 x 3] rotation matrices """
+        x, y, z, w = self.q[:,0], self.q[:,1], self.q[:,2], self.q[:,3]
+        xx, yy, zz = x*x, y*y, z*z
+        xy, xz, yz = x*y, x*z, y*z
+        wx, wy, wz = w*x, w*y, w*z
+        R = np.empty((len(self.q), 3, 3), dtype=np.float64)
+        R[:,0,0], R[:,0,1], R[:,0,2] = 1 - 2*(yy+zz), 2*(xy-wz), 2*(xz+wy)
+        R[:,1,0], R[:,1,1], R[:,1,2] = 2*(xy+wz), 1 - 2*(xx+zz), 2*(yz-wx)
+        R[:,2,0], R[:,2,1], R[:,2,2] = 2*(xz-wy), 2*(yz+wx), 1 - 2*(xx+yy)
+        return R
+
+    @property
+    def wxyz(self):
+        return self.to_wxyz()
+
+    @property
+    def xyzw(self):
+        return self.to_xyzw()
+
+    @property
+    def rpy(self):
+        return self.to_rpy()
+
+
 ###############################################################################
 if __name__ == "__main__":
     import random
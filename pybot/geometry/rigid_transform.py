@@ -6,7 +6,8 @@ General-purpose class for rigid-body transformations.
 
 import numpy as np
 import transformations as tf
-from pybot.geometry.quaternion import Quaternion
+import lie
+from pybot.geometry.quaternion import Quaternion, QuaternionArray
 
 ###############################################################################
 def normalize_vec(v): 
@@ -98,8 +99,14 @@ class RigidTransform(object):
     
     quat: Quaternion/Rotation (xyzw)
     tvec: Translation (xyz)
+
+    The rotation matrix and translation used for transforming
+    points are cached lazily, and invalidated whenever quat or
+    tvec are re-assigned (in-place edits are not tracked).
     
     """
+    __slots__ = ['quat_', 'tvec_', 'Rt_']
+
     def __init__(self, xyzw=[0.,0.,0.,1.], tvec=[0.,0.,0.]):
         """ Initialize a RigidTransform with Quaternion and 3D Position """
         self.quat = Quaternion(xyzw)
@@ -111,6 +118,15 @@ class RigidTransform(object):
              np.array_str(self.tvec, precision=2, suppress_small=True))
         # return 'quat: %s, tvec: %s' % (self.quat, self.tvec)
 
+    def __getstate__(self): 
+        state = dict(getattr(self, '__dict__', {}))
+        state.update(quat=self.quat, tvec=self.tvec)
+        return state
+
+    def __setstate__(self, state): 
+        for k, v in state.iteritems(): 
+            setattr(self, k, v)
+
     def __mul__(self, other):
         """ 
         Left-multiply RigidTransform with another rigid transform
@@ -123,8 +139,36 @@ class RigidTransform(object):
         if isinstance(other, RigidTransform):
             return self.oplus(other)
         else:          
-            X = np.hstack([other, np.ones((len(other),1))]).T
-            return (np.dot(self.matrix, X).T)[:,:3]
+            return self.transform(other)
+
+    def _invalidate_cache(self): 
+        self.Rt_ = {}
+
+    def _cached_Rt(self, dtype=np.float64): 
+        """ Returns the cached (R^T, t) in the requested precision """
+        try: 
+            return self.Rt_[dtype]
+        except KeyError: 
+            R = self.quat.to_matrix()[:3,:3]
+            self.Rt_[dtype] = (np.ascontiguousarray(R.T, dtype=dtype), 
+                               np.asarray(self.tvec, dtype=dtype))
+            return self.Rt_[dtype]
+
+    def transform(self, X, out=None): 
+        """
+        Transform [N x 3] point set (X_2 = p_21 * X_1) via X R^T + t
+        with the cached rotation and translation. float32 points are
+        transformed in single precision, everything else in double.
+
+        out: Optional preallocated [N x 3] output buffer (C-contiguous,
+             and of the same dtype as the transformed points)
+        """
+        X = np.asarray(X)
+        dtype = np.float32 if X.dtype == np.float32 else np.float64
+        RT, t = self._cached_Rt(dtype)
+        out = np.dot(X.astype(dtype, copy=False).reshape(-1,3), RT, out=out)
+        out += t
+        return out
 
     def __rmul__(self, other): 
         raise NotImplementedError('Right multiply not implemented yet!')                    
@@ -155,7 +199,7 @@ class RigidTransform(object):
 
     def rotate_vec(self, v): 
         if v.ndim == 2: 
-            return np.vstack(map(lambda v_: self.quat.rotate(v_), v))
+            return QuaternionArray(self.quat).rotate(v)
         else: 
             assert(v.ndim == 1 or (v.ndim == 2 and v.shape[0] == 1))
             return self.quat.rotate(v)
@@ -185,6 +229,21 @@ class RigidTransform(object):
     #     oinv = other.inverse()
     #     return oinv.oplus(self)
 
+    # Lie group (SE(3)) operations
+
+    def log(self): 
+        """ Logarithm map to the se(3) tangent vector (w, v) [6] """
+        return lie.se3_log_quat(self.quat.q, self.tvec)[0]
+
+    @classmethod
+    def exp(cls, xi): 
+        """ Exponential map from the se(3) tangent vector (w, v) [6] """
+        q, t = lie.se3_exp_quat(xi)
+        return cls(q[0], t[0])
+
+    def adjoint(self): 
+        """ Adjoint [6 x 6] of the transformation """
+        return lie.se3_adjoint(self.matrix)[0]
 
     # (To) Conversions
 
@@ -259,6 +318,24 @@ class RigidTransform(object):
     def translation(self):
         return self.tvec
 
+    @property
+    def quat(self): 
+        return self.quat_
+
+    @quat.setter
+    def quat(self, quat): 
+        self.quat_ = quat
+        self._invalidate_cache()
+
+    @property
+    def tvec(self): 
+        return self.tvec_
+
+    @tvec.setter
+    def tvec(self, tvec): 
+        self.tvec_ = tvec
+        self._invalidate_cache()
+
     @classmethod
     def identity(cls):
         return cls()
@@ -267,6 +344,209 @@ class RigidTransform(object):
     def matrix(self): 
         return self.to_matrix()
 
+###############################################################################
+class RigidTransformArray(object):
+    """
+    Array-backed SE(3) rigid transform class that stores N poses as
+    contiguous arrays, and allows vectorized compounding, inversion,
+    and conversion of the entire set of poses.
+
+    quat: QuaternionArray/Rotations [N x 4] (xyzw)
+    tvec: Translations [N x 3] (xyz)
+
+    """
+    __slots__ = ['quat', 'tvec']
+
+    def __init__(self, xyzw=[[0.,0.,0.,1.]], tvec=[[0.,0.,0.]]):
+        """ Initialize a RigidTransformArray with [N x 4] Quaternions and [N x 3] Positions """
+        self.quat = QuaternionArray(xyzw)
+        self.tvec = np.array(tvec, dtype=np.float64).reshape(-1,3)
+        if len(self.quat) != len(self.tvec):
+            raise ValueError('RigidTransformArray quaternions and translations '
+                             'length mismatch {:} != {:}'.format(len(self.quat), len(self.tvec)))
+
+    def __repr__(self):
+        return 'RigidTransformArray: %i poses' % len(self)
+
+    def __len__(self):
+        return len(self.tvec)
+
+    def __getstate__(self):
+        return {'quat': self.quat, 'tvec': self.tvec}
+
+    def __setstate__(self, state):
+        self.quat, self.tvec = state['quat'], state['tvec']
+
+    def __getitem__(self, index):
+        """
+        Integer indexing returns a RigidTransform, while slicing,
+        or array indexing returns a RigidTransformArray
+        """
+        if isinstance(index, (int, np.integer)):
+            return RigidTransform(self.quat.q[index], self.tvec[index])
+        return RigidTransformArray(self.quat.q[index], self.tvec[index])
+
+    def __iter__(self):
+        for idx in xrange(len(self)):
+            yield self[idx]
+
+    def __mul__(self, other):
+        """
+        Left-multiply RigidTransformArray with another rigid transform
+
+        Variants:
+           RigidTransform(Array): Identical to oplus operation
+           ndarray: transform [M x 3] point set with each of
+                    the N poses, returns [N x M x 3]
+
+        """
+        if isinstance(other, (RigidTransform, RigidTransformArray, list)):
+            return self.oplus(other)
+        else:
+            return self.quat.rotate(other, outer=True) + self.tvec[:,np.newaxis,:]
+
+    # Basic operations
+
+    def inverse(self):
+        """ Returns a new RigidTransformArray that corresponds to the inverse of each pose """
+        qinv = self.quat.inverse()
+        return RigidTransformArray(qinv, qinv.rotate(-self.tvec))
+
+    def oplus(self, other):
+        """
+        Compound poses element-wise, i.e. p_i * o_i. Arrays with a
+        single pose (or RigidTransform) are broadcasted.
+        """
+        if isinstance(other, RigidTransform):
+            other = RigidTransformArray(other.quat.q, other.tvec)
+        elif isinstance(other, list):
+            other = RigidTransformArray.from_list(other)
+        elif not isinstance(other, RigidTransformArray):
+            raise TypeError("Type inconsistent", type(other), other.__class__)
+
+        t = self.quat.rotate(other.tvec) + self.tvec
+        r = self.quat * other.quat
+        return RigidTransformArray(r, t)
+
+    def ominus(self, other):
+        """
+        Returns the poses of self with respect to other,
+        i.e. o_i.inverse() * p_i
+        """
+        if isinstance(other, RigidTransform):
+            other = RigidTransformArray(other.quat.q, other.tvec)
+        return other.inverse().oplus(self)
+
+    def relative(self, step=1):
+        """
+        Returns the [N-step] relative poses between every pose and
+        the one that is step-poses ahead, i.e. p_i.inverse() * p_(i+step)
+        """
+        if step < 1:
+            raise ValueError('RigidTransformArray.relative step must be >= 1, '
+                             'provided {:}'.format(step))
+        return self[step:].ominus(self[:-step])
+
+    def rotate_vec(self, v):
+        return self.quat.rotate(v)
+
+    # Lie group (SE(3)) operations
+
+    def log(self):
+        """ Logarithm map to se(3) tangent vectors (w, v) [N x 6] """
+        return lie.se3_log_quat(self.quat.q, self.tvec)
+
+    @classmethod
+    def exp(cls, xi):
+        """ Exponential map from se(3) tangent vectors (w, v) [N x 6] """
+        return cls(*lie.se3_exp_quat(xi))
+
+    def adjoint(self):
+        """ Adjoints [N x 6 x 6] of the transformations """
+        return lie.se3_adjoint(self.to_matrix())
+
+    # (To) Conversions
+
+    def to_matrix(self):
+        """ Returns [N x 4 x 4] homogenous matrices of the form [R t; 0 1] """
+        result = self.quat.to_matrix()
+        result[:,:3,3] = self.tvec
+        return result
+
+    def to_Rt(self):
+        """ Returns rotations R [N x 3 x 3], and translational vectors t [N x 3] """
+        return self.quat.R, self.tvec.copy()
+
+    def to_rpyxyz(self, axes='rxyz'):
+        return np.hstack([self.quat.to_rpy(axes=axes), self.tvec])
+
+    def to_list(self):
+        """ Returns a list of RigidTransforms """
+        return [RigidTransform(q, t) for (q, t) in zip(self.quat.q, self.tvec)]
+
+    # (From) Conversions
+
+    @classmethod
+    def from_rpyxyz(cls, roll, pitch, yaw, x, y, z, axes='rxyz'):
+        q = QuaternionArray.from_rpy(roll, pitch, yaw, axes=axes)
+        return cls(q, np.vstack([x, y, z]).T)
+
+    @classmethod
+    def from_Rt(cls, R, t):
+        return cls(QuaternionArray.from_matrix(R), t)
+
+    @classmethod
+    def from_matrix(cls, T):
+        """ From [N x 4 x 4] or [N x 3 x 4] homogenous matrices """
+        T = np.asarray(T)
+        T = T.reshape((-1,) + T.shape[-2:])
+        return cls(QuaternionArray.from_matrix(T), T[:,:3,3])
+
+    @classmethod
+    def from_list(cls, poses):
+        """ From a list of RigidTransforms """
+        if not len(poses):
+            return cls(np.empty((0,4)), np.empty((0,3)))
+        return cls(np.vstack([p.quat.q for p in poses]),
+                   np.vstack([p.tvec for p in poses]))
+
+    @classmethod
+    def identity(cls, N=1):
+        return cls(QuaternionArray.identity(N), np.zeros((N,3)))
+
+    # Properties
+    @property
+    def wxyz(self):
+        return self.quat.wxyz
+
+    @property
+    def xyzw(self):
+        return self.quat.xyzw
+
+    @property
+    def R(self):
+        return self.quat.R
+
+    @property
+    def t(self):
+        return self.tvec
+
+    @property
+    def orientation(self):
+        return self.quat
+
+    @property
+    def rotation(self):
+        return self.quat
+
+    @property
+    def translation(self):
+        return self.tvec
+
+    @property
+    def matrix(self):
+        return self.to_matrix()
+
 ###############################################################################
 class DualQuaternion(object):
     """
@@ -274,6 +554,8 @@ class DualQuaternion(object):
     and provides common transformations that are commonly seen in geometric problems.
         
     """
+    __slots__ = ['real', 'dual']
+
     def __init__(self, xyzw=[0.,0.,0.,1.], tvec=[0.,0.,0.]):
         """ Initialize a RigidTransform with Quaternion and 3D Position """
         self.real = Quaternion(xyzw)
@@ -390,10 +672,42 @@ class DualQuaternion(object):
     
 ###############################################################################
 class Sim3(RigidTransform): 
+    """
+    Sim(3) similarity transform class, stored as a rotation, 
+    translation and (inverse) scale. 
+
+    Points are transformed with the upper [3 x 4] block of 
+    to_matrix() [R/scale t; 0 1/scale], i.e. x -> R x / scale + t. 
+    The Lie group (Sim(3)) operations use the same transformation, 
+    as the similarity matrix [s R t; 0 1] with s = 1 / scale.
+    
+    """
+    __slots__ = ['scale_']
+
     def __init__(self, xyzw=[0.,0.,0.,1.], tvec=[0.,0.,0.], scale=1.0):    
         RigidTransform.__init__(self, xyzw=xyzw, tvec=tvec)
         self.scale = scale
 
+    @property
+    def scale(self): 
+        return self.scale_
+
+    @scale.setter
+    def scale(self, scale): 
+        self.scale_ = scale
+        self._invalidate_cache()
+
+    def _cached_Rt(self, dtype=np.float64): 
+        """ Returns the cached (R^T / scale, t), i.e. the 
+        upper [3 x 4] block of to_matrix() """
+        try: 
+            return self.Rt_[dtype]
+        except KeyError: 
+            R = self.quat.to_matrix()[:3,:3] / self.scale
+            self.Rt_[dtype] = (np.ascontiguousarray(R.T, dtype=dtype), 
+                               np.asarray(self.tvec, dtype=dtype))
+            return self.Rt_[dtype]
+
     @classmethod
     def from_matrix(cls, T):
         sR_t = np.eye(4)
@@ -407,11 +721,52 @@ class Sim3(RigidTransform):
         result[:3, :3] /= self.scale
         return result
 
+    # Lie group (Sim(3)) operations
+
+    def to_similarity(self): 
+        """ Returns 4x4 similarity matrix [sR t; 0 1], with s = 1 / scale """
+        result = self.to_matrix()
+        result[3, 3] = 1.0
+        return result
+
+    @classmethod
+    def from_similarity(cls, T): 
+        """ From 4x4 similarity matrix [sR t; 0 1], with scale = 1 / s """
+        s = np.cbrt(np.linalg.det(T[:3,:3]))
+        R = np.eye(4)
+        R[:3,:3] = T[:3,:3] / s
+        return cls(Quaternion.from_matrix(R), T[:3,3], scale=1.0 / s)
+
+    def log(self): 
+        """ Logarithm map to the sim(3) tangent vector (w, v, -log(scale)) [7] """
+        return lie.sim3_log(self.to_similarity())[0]
+
+    @classmethod
+    def exp(cls, xi): 
+        """ Exponential map from the sim(3) tangent vector (w, v, -log(scale)) [7] """
+        return cls.from_similarity(lie.sim3_exp(xi)[0])
+
+    def adjoint(self): 
+        """ Adjoint [7 x 7] of the similarity transformation """
+        return lie.sim3_adjoint(self.to_similarity())[0]
+
+    def __getstate__(self): 
+        state = RigidTransform.__getstate__(self)
+        state.update(scale=self.scale)
+        return state
+
 class Pose(RigidTransform): 
+    __slots__ = ['id']
+
     def __init__(self, pid, xyzw=[0.,0.,0.,1.], tvec=[0.,0.,0.]):
         RigidTransform.__init__(self, xyzw=xyzw, tvec=tvec)
         self.id = pid
 
+    def __getstate__(self): 
+        state = RigidTransform.__getstate__(self)
+        state.update(id=self.id)
+        return state
+
     @classmethod
     def from_rigid_transform(cls, pid, pose):
         return cls(pid, pose.quat, pose.tvec)
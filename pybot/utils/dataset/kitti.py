@@ -11,7 +11,7 @@ from pybot.utils.dataset_readers import natural_sort, \
     FileReader, DatasetReader, ImageDatasetReader, \
     StereoDatasetReader, VelodyneDatasetReader
 
-from pybot.geometry.rigid_transform import RigidTransform
+from pybot.geometry.rigid_transform import RigidTransformArray
 from pybot.vision.camera_utils import StereoCamera
 
 def kitti_stereo_calib(sequence, scale=1.0): 
@@ -32,17 +32,19 @@ def kitti_stereo_calib(sequence, scale=1.0):
 #     baseline_px = 386.1448 * scale
 #     return get_calib_params(f, f, cx, cy, baseline_px=baseline_px)
 
-def kitti_load_poses(fn): 
-    X = (np.fromfile(fn, dtype=np.float64, sep=' ')).reshape(-1,12)
-    return map(lambda p: RigidTransform.from_Rt(p[:3,:3], p[:3,3]), 
-                map(lambda x: x.reshape(3,4), X))
+def kitti_load_poses(fn, as_array=False): 
+    X = (np.fromfile(fn, dtype=np.float64, sep=' ')).reshape(-1,3,4)
+    poses = RigidTransformArray.from_matrix(X)
+    return poses if as_array else poses.to_list()
 
 def kitti_poses_to_str(poses): 
     return "\r\n".join(map(lambda x: " ".join(map(str, 
                                                   (x.matrix[:3,:4]).flatten())), poses))
 
 def kitti_poses_to_mat(poses): 
-    return np.vstack(map(lambda x: (x.matrix[:3,:4]).flatten(), poses)).astype(np.float64)
+    if not isinstance(poses, RigidTransformArray): 
+        poses = RigidTransformArray.from_list(poses)
+    return poses.to_matrix()[:,:3,:4].reshape(-1,12)
 
 
 class KITTIDatasetReader(object): 
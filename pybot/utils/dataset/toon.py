@@ -10,14 +10,13 @@ from pybot.utils.dataset_readers import natural_sort, \
     read_dir, DatasetReader, ImageDatasetReader, StereoDatasetReader
 from pybot.utils.db_utils import AttrDict
 
-from pybot.geometry.rigid_transform import Quaternion, RigidTransform
+from pybot.geometry.rigid_transform import RigidTransformArray
 
-def load_poses(fn): 
+def load_poses(fn, as_array=False): 
     """ Retrieve poses """ 
     P = np.loadtxt(os.path.expanduser(fn), dtype=np.float64)
-    P1 = P.reshape(-1,12)
-    P = [Rt.reshape(3,4) for Rt in P1]
-    return [RigidTransform.from_Rt(item[:3,:3], item[:3,3]) for item in P]
+    poses = RigidTransformArray.from_matrix(P.reshape(-1,3,4))
+    return poses if as_array else poses.to_list()
 
 
 def save_poses(fn, poses): 
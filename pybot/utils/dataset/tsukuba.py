@@ -11,10 +11,10 @@ from pybot.utils.db_utils import AttrDict
 
 from pybot.vision.image_utils import im_resize
 from pybot.vision.camera_utils import StereoCamera
-from pybot.geometry.rigid_transform import Quaternion, RigidTransform
+from pybot.geometry.rigid_transform import RigidTransformArray
 from pybot.externals.lcm import draw_utils
 
-def tsukuba_load_poses(fn): 
+def tsukuba_load_poses(fn, as_array=False): 
     """ 
     Retrieve poses
     X Y Z R P Y - > X -Y -Z R -P -Y
@@ -23,12 +23,12 @@ def tsukuba_load_poses(fn):
         p[0]*.01,-p[1]*.01,-p[2]*.01, axes='sxyz') for p in P ]
 
     """ 
-    P = np.loadtxt(os.path.expanduser(fn), dtype=np.float64, delimiter=',')
-    return [ RigidTransform.from_rpyxyz(np.pi, 0, 0, 0, 0, 0) * \
-             RigidTransform.from_rpyxyz(
-                 np.deg2rad(p[3]),np.deg2rad(p[4]),np.deg2rad(p[5]),
-                 p[0]*.01,p[1]*.01,p[2]*.01, axes='sxyz') * \
-             RigidTransform.from_rpyxyz(np.pi, 0, 0, 0, 0, 0) for p in P ]
+    P = np.loadtxt(os.path.expanduser(fn), dtype=np.float64, delimiter=',').reshape(-1,6)
+    flip = RigidTransformArray.from_rpyxyz(np.pi, 0, 0, 0, 0, 0)
+    poses = flip.oplus(RigidTransformArray.from_rpyxyz(
+        np.deg2rad(P[:,3]),np.deg2rad(P[:,4]),np.deg2rad(P[:,5]),
+        P[:,0]*.01,P[:,1]*.01,P[:,2]*.01, axes='sxyz')).oplus(flip)
+    return poses if as_array else poses.to_list()
     
     # return [ RigidTransform.from_rpyxyz(
     #     np.deg2rad(p[3]),-np.deg2rad(p[4]),-np.deg2rad(p[5]),
@@ -5,9 +5,11 @@ import numpy as np
 from collections import deque, namedtuple
 from abc import ABCMeta, abstractmethod
 
-from itertools import imap
+from itertools import imap, izip
 from pybot.utils.misc import print_green, print_red
 from pybot.utils.misc import Counter, Accumulator, CounterWithPeriodicCallback 
+from pybot.geometry.rigid_transform import RigidTransform, RigidTransformArray
+from pybot.geometry.quaternion import QuaternionArray
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -276,6 +278,187 @@ class KeyframeSampler(PoseSampler):
 #                                                       on_sampled_cb=on_sampled_cb, verbose=verbose)
 
 
+class Trajectory(object): 
+    """
+    Time-indexed trajectory that stores sorted timestamps [N], and
+    the corresponding poses as contiguous arrays (quaternions [N x 4] 
+    and translations [N x 3]). 
+
+    Poses at arbitrary query timestamps are looked up in batch via
+    binary search (np.searchsorted), followed by vectorized slerp of
+    the rotations and linear interpolation of the translations.
+    
+    Streaming appends are amortized O(1) via geometrically grown
+    buffers, and maxlen (if provided) retains only the most recent
+    poses. 
+    """
+    def __init__(self, timestamps=[], poses=None, maxlen=None): 
+        self.maxlen_ = maxlen
+        self.st_, self.end_ = 0, 0
+        self.ts_ = np.empty(0, dtype=np.float64)
+        self.xyzw_ = np.empty((0,4), dtype=np.float64)
+        self.tvec_ = np.empty((0,3), dtype=np.float64)
+
+        if poses is not None: 
+            self.extend(timestamps, poses)
+
+    def __repr__(self): 
+        return 'Trajectory: {:} poses [{:}, {:}]'.format(
+            len(self), *((self.ts_[self.st_], self.ts_[self.end_-1]) 
+                         if len(self) else (None, None)))
+
+    def __len__(self): 
+        return self.end_ - self.st_
+
+    def __getitem__(self, index): 
+        """
+        Integer indexing returns (t, RigidTransform), while slicing, 
+        or array indexing returns a Trajectory
+        """
+        if isinstance(index, (int, np.integer)): 
+            return self.timestamps[index], self.poses[index]
+        return Trajectory(self.timestamps[index], self.poses[index])
+
+    def __iter__(self): 
+        for t, pose in izip(self.timestamps, self.poses): 
+            yield t, pose
+
+    @staticmethod
+    def _to_array(poses): 
+        if isinstance(poses, RigidTransformArray): 
+            return poses
+        elif isinstance(poses, RigidTransform): 
+            return RigidTransformArray(poses.quat.q, poses.tvec)
+        elif isinstance(poses, (list, tuple)): 
+            return RigidTransformArray.from_list(poses)
+        raise TypeError('Trajectory expects RigidTransform(Array) or list of RigidTransforms, '
+                        'provided {:}'.format(type(poses)))
+
+    def _reserve(self, n): 
+        """ Ensure capacity for n more poses, compacting / growing buffers if needed """
+        size, capacity = len(self), len(self.ts_)
+        if self.end_ + n <= capacity: 
+            return
+
+        if size + n > capacity // 2: 
+            capacity = max(16, 2 * capacity, size + n)
+        ts = np.empty(capacity, dtype=np.float64)
+        xyzw = np.empty((capacity,4), dtype=np.float64)
+        tvec = np.empty((capacity,3), dtype=np.float64)
+        ts[:size] = self.timestamps
+        xyzw[:size] = self.xyzw
+        tvec[:size] = self.tvec
+        self.ts_, self.xyzw_, self.tvec_ = ts, xyzw, tvec
+        self.st_, self.end_ = 0, size
+
+    def append(self, t, pose): 
+        """ Append a single timestamped pose (RigidTransform) """
+        self.extend([t], pose)
+
+    def extend(self, timestamps, poses): 
+        """
+        Append timestamps [N] and poses (RigidTransformArray, or list
+        of RigidTransforms). Out-of-order timestamps are merged in, so
+        that the trajectory is always sorted in time. 
+        """
+        ts = np.asarray(timestamps, dtype=np.float64).ravel()
+        poses = Trajectory._to_array(poses)
+        if len(ts) != len(poses): 
+            raise ValueError('Trajectory timestamps and poses length mismatch {:} != {:}'
+                             .format(len(ts), len(poses)))
+        if not len(ts): 
+            return
+
+        xyzw, tvec = poses.quat.q, poses.tvec
+        if (len(ts) > 1 and (np.diff(ts) < 0).any()) or \
+           (len(self) and ts[0] < self.ts_[self.end_-1]): 
+            # Out-of-order insertion (stable w.r.t existing poses)
+            ts = np.hstack([self.timestamps, ts])
+            xyzw = np.vstack([self.xyzw, xyzw])
+            tvec = np.vstack([self.tvec, tvec])
+            inds = np.argsort(ts, kind='mergesort')
+            ts, xyzw, tvec = ts[inds], xyzw[inds], tvec[inds]
+            self.st_, self.end_ = 0, 0
+
+        self._reserve(len(ts))
+        st, end = self.end_, self.end_ + len(ts)
+        self.ts_[st:end], self.xyzw_[st:end], self.tvec_[st:end] = ts, xyzw, tvec
+        self.end_ = end
+
+        # Retain only the latest maxlen poses
+        if self.maxlen_ is not None and len(self) > self.maxlen_: 
+            self.st_ = self.end_ - self.maxlen_
+
+    def query(self, t, return_valid=False): 
+        """
+        Interpolate poses at timestamps t [M] (slerp/lerp between the
+        bracketing poses). Timestamps outside the trajectory are
+        clamped to the first/last pose, and are marked invalid in the
+        (optionally) returned valid mask [M]. 
+
+        Returns RigidTransformArray [M] (or RigidTransform for scalar t)
+        """
+        if not len(self): 
+            raise RuntimeError('Trajectory is empty, cannot query poses')
+
+        scalar = np.isscalar(t)
+        t = np.asarray(t, dtype=np.float64).ravel()
+        ts = self.timestamps
+        valid = (t >= ts[0]) & (t <= ts[-1])
+
+        if len(self) == 1: 
+            inds = np.zeros(len(t), dtype=np.int64)
+            poses = self.poses[inds]
+        else: 
+            # Bracketing indices [i0, i1] and weights towards i1
+            i1 = np.clip(np.searchsorted(ts, t, side='right'), 1, len(ts)-1)
+            i0 = i1 - 1
+            dt = ts[i1] - ts[i0]
+            w = np.clip((t - ts[i0]) / np.where(dt > 0, dt, 1.0), 0, 1)
+
+            q0, q1 = QuaternionArray(self.xyzw[i0]), QuaternionArray(self.xyzw[i1])
+            t0, t1 = self.tvec[i0], self.tvec[i1]
+            poses = RigidTransformArray(q0.slerp(q1, w), t0 + w.reshape(-1,1) * (t1 - t0))
+
+        if scalar: 
+            poses, valid = poses[0], valid[0]
+        return (poses, valid) if return_valid else poses
+
+    def window(self, t0, t1): 
+        """ Sub-trajectory with timestamps within [t0, t1] """
+        ts = self.timestamps
+        st, end = np.searchsorted(ts, t0, side='left'), np.searchsorted(ts, t1, side='right')
+        return self[st:end]
+
+    def resample(self, rate): 
+        """ Resample trajectory at a fixed rate (Hz) over its time span """
+        if not len(self): 
+            return Trajectory()
+        ts = self.timestamps
+        n = int(np.floor((ts[-1] - ts[0]) * rate + 1e-9)) + 1
+        t = ts[0] + np.arange(n, dtype=np.float64) / rate
+        return Trajectory(t, self.query(t))
+
+    @classmethod
+    def from_list(cls, timestamps, poses, maxlen=None): 
+        return cls(timestamps, RigidTransformArray.from_list(poses), maxlen=maxlen)
+
+    @property
+    def timestamps(self): 
+        return self.ts_[self.st_:self.end_]
+
+    @property
+    def xyzw(self): 
+        return self.xyzw_[self.st_:self.end_]
+
+    @property
+    def tvec(self): 
+        return self.tvec_[self.st_:self.end_]
+
+    @property
+    def poses(self): 
+        return RigidTransformArray(self.xyzw, self.tvec)
+
 class PoseAccumulator(Accumulator): 
     def __init__(self, maxlen=100, relative=False): 
         Accumulator.__init__(self, maxlen=maxlen)
@@ -304,12 +487,19 @@ class PoseInterpolator(PoseAccumulator):
 
         self.relative_ = relative
         self.init_ = None
+        self.trajectory_ = Trajectory(maxlen=maxlen)
         
-    def add(self, pose): 
+    def add(self, t, pose): 
         super(PoseAccumulator, self).accumulate(pose)
+        self.trajectory_.append(t, pose)
 
-    def query(self, pose): 
-        raise NotImplementedError()
+    def query(self, t): 
+        """ Interpolated pose(s) at timestamp(s) t """
+        return self.trajectory_.query(t)
+
+    @property
+    def trajectory(self): 
+        return self.trajectory_
 
 class SkippedPoseAccumulator(PoseAccumulator): 
     def __init__(self, skip=10, **kwargs): 
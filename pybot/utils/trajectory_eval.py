@@ -0,0 +1,298 @@
+"""
+Trajectory evaluation (ATE/RPE/KITTI segment errors), vectorized over
+pose arrays.
+
+    ATE: Absolute trajectory error after SE(3)/Sim(3) (Umeyama) alignment
+    RPE: Relative pose error over frame or distance windows
+    KITTI: Average translation / rotation errors over path segments of
+           100, 200, ..., 800 m (as in the KITTI odometry devkit)
+
+All poses are expected to be time-synchronized, i.e. est[i] and gt[i]
+correspond to the same timestamp.
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import os.path
+import numpy as np
+
+from pybot.utils.db_utils import AttrDict
+from pybot.geometry.rigid_transform import RigidTransformArray
+from pybot.geometry.quaternion import QuaternionArray
+
+KITTI_SEGMENT_LENGTHS = (100, 200, 300, 400, 500, 600, 700, 800)
+
+###############################################################################
+def _to_array(poses):
+    if isinstance(poses, RigidTransformArray):
+        return poses
+    return RigidTransformArray.from_list(list(poses))
+
+def _check_poses(gt, est):
+    gt, est = _to_array(gt), _to_array(est)
+    if len(gt) != len(est):
+        raise ValueError('Ground truth and estimated poses length mismatch {:} != {:}'
+                         .format(len(gt), len(est)))
+    return gt, est
+
+def rotation_angle(poses):
+    """ Rotation angles [N] (in radians) of the poses """
+    q = poses.quat.q
+    return 2 * np.arctan2(np.linalg.norm(q[:,:3], axis=1), np.fabs(q[:,3]))
+
+def trajectory_distances(poses):
+    """ Cumulative distance [N] travelled along the trajectory """
+    d = np.linalg.norm(np.diff(_to_array(poses).tvec, axis=0), axis=1)
+    return np.hstack([0, np.cumsum(d)])
+
+def error_stats(errors):
+    """ Summary statistics for errors [N] """
+    errors = np.asarray(errors, dtype=np.float64)
+    if not len(errors):
+        return AttrDict(rmse=np.nan, mean=np.nan, median=np.nan,
+                        std=np.nan, min=np.nan, max=np.nan, count=0)
+    return AttrDict(rmse=np.sqrt(np.mean(errors ** 2)), mean=np.mean(errors),
+                    median=np.median(errors), std=np.std(errors),
+                    min=np.min(errors), max=np.max(errors), count=len(errors))
+
+###############################################################################
+# Alignment
+
+def umeyama_alignment(X, Y, with_scale=False):
+    """
+    Least-squares similarity transform (Umeyama, 1991) that aligns
+    points X [N x 3] to Y [N x 3], i.e. Y ~ s * R X + t.
+
+    Returns R [3 x 3], t [3], s (s=1 if with_scale=False)
+    """
+    X, Y = np.asarray(X, dtype=np.float64), np.asarray(Y, dtype=np.float64)
+    if X.shape != Y.shape or X.ndim != 2 or X.shape[1] != 3:
+        raise ValueError('Umeyama alignment expects [N x 3] point sets of equal size, '
+                         'provided {:} and {:}'.format(X.shape, Y.shape))
+    if len(X) < 3:
+        raise ValueError('Umeyama alignment requires at least 3 points, provided {:}'
+                         .format(len(X)))
+
+    mx, my = X.mean(axis=0), Y.mean(axis=0)
+    Xc, Yc = X - mx, Y - my
+    var_x = np.sum(Xc ** 2) / len(X)
+
+    # Cross-covariance and its SVD (reflection-corrected)
+    U, D, Vt = np.linalg.svd(np.dot(Yc.T, Xc) / len(X))
+    S = np.ones(3)
+    if np.linalg.det(U) * np.linalg.det(Vt) < 0:
+        S[2] = -1
+
+    R = np.dot(U * S, Vt)
+    s = np.dot(D, S) / var_x if with_scale else 1.0
+    t = my - s * np.dot(R, mx)
+    return R, t, s
+
+def align_trajectory(gt, est, align='se3'):
+    """
+    Aligns the estimated poses to the ground truth poses with
+    SE(3) (align='se3'), Sim(3) (align='sim3'), or no alignment
+    (align=None).
+
+    Returns the aligned poses, and alignment (R, t, s)
+    """
+    gt, est = _check_poses(gt, est)
+    if align is None:
+        return est, (np.eye(3), np.zeros(3), 1.0)
+    if align not in ('se3', 'sim3'):
+        raise ValueError('Unknown alignment {:}, use se3/sim3/None'.format(align))
+
+    R, t, s = umeyama_alignment(est.tvec, gt.tvec, with_scale=(align == 'sim3'))
+    q = QuaternionArray.from_matrix(R)
+    aligned = RigidTransformArray(q * est.quat, s * np.dot(est.tvec, R.T) + t)
+    return aligned, (R, t, s)
+
+###############################################################################
+# Errors
+
+def absolute_trajectory_error(gt, est, align='se3'):
+    """
+    Absolute trajectory error (translational) [N] after aligning
+    the estimated trajectory to the ground truth
+    """
+    gt, est = _check_poses(gt, est)
+    aligned, _ = align_trajectory(gt, est, align=align)
+    return np.linalg.norm(aligned.tvec - gt.tvec, axis=1)
+
+def relative_pose_pairs(gt, delta=1, unit='frames'):
+    """
+    Index pairs (i, j) [M], such that j is delta frames ahead
+    of i (unit='frames'), or is the first frame that is delta
+    meters along the ground truth path from i (unit='m')
+    """
+    gt = _to_array(gt)
+    if unit == 'frames':
+        i = np.arange(max(len(gt) - int(delta), 0))
+        return i, i + int(delta)
+    elif unit == 'm':
+        dist = trajectory_distances(gt)
+        j = np.searchsorted(dist, dist + delta, side='left')
+        i, = np.where(j < len(gt))
+        return i, j[i]
+    raise ValueError('Unknown unit {:}, use frames/m'.format(unit))
+
+def relative_pose_error(gt, est, delta=1, unit='frames'):
+    """
+    Relative pose error between ground truth and estimated
+    motions over windows of delta frames / meters.
+
+    Returns translational [M] and rotational (radians) [M] errors
+    """
+    gt, est = _check_poses(gt, est)
+    i, j = relative_pose_pairs(gt, delta=delta, unit=unit)
+    dgt = gt[j].ominus(gt[i])
+    dest = est[j].ominus(est[i])
+    err = dest.ominus(dgt)
+    return np.linalg.norm(err.tvec, axis=1), rotation_angle(err)
+
+def kitti_segment_errors(gt, est, lengths=KITTI_SEGMENT_LENGTHS, step_size=10,
+                         frame_rate=10.0):
+    """
+    KITTI odometry segment errors (devkit evaluate_odometry):
+    for every step_size-th frame, and each segment length,
+    compute the normalized translational (m/m) and rotational
+    (rad/m) errors of the relative motion over the segment.
+
+    Returns AttrDict(first_frame, length, t_err, r_err, speed) [M]
+    """
+    gt, est = _check_poses(gt, est)
+    dist = trajectory_distances(gt)
+    lengths = np.float64(lengths)
+
+    # Last frame for each (first frame, length) pair
+    first = np.arange(0, len(gt), step_size)
+    first, length = [a.ravel() for a in np.meshgrid(first, lengths, indexing='ij')]
+    last = np.searchsorted(dist, dist[first] + length, side='right')
+    valid = last < len(gt)
+    first, length, last = first[valid], length[valid], last[valid]
+
+    err = gt[last].ominus(gt[first]).ominus(est[last].ominus(est[first]))
+    return AttrDict(first_frame=first, length=length,
+                    t_err=np.linalg.norm(err.tvec, axis=1) / length,
+                    r_err=rotation_angle(err) / length,
+                    speed=length / ((last - first + 1) / frame_rate))
+
+def kitti_summary(errors, lengths=KITTI_SEGMENT_LENGTHS):
+    """
+    Average translational (%) and rotational (deg/m) errors,
+    overall and per segment length
+    """
+    by_length = AttrDict([
+        (int(l), AttrDict(t_err=np.mean(errors.t_err[errors.length == l]) * 100,
+                          r_err=np.rad2deg(np.mean(errors.r_err[errors.length == l]))))
+        for l in lengths if np.any(errors.length == l)
+    ])
+    return AttrDict(t_err=np.mean(errors.t_err) * 100 if len(errors.t_err) else np.nan,
+                    r_err=np.rad2deg(np.mean(errors.r_err)) if len(errors.r_err) else np.nan,
+                    lengths=by_length)
+
+def evaluate_trajectory(gt, est, align='se3', delta=1, unit='frames', kitti=False):
+    """ Evaluate ATE, RPE (and optionally KITTI segment errors) """
+    gt, est = _check_poses(gt, est)
+    rpe_t, rpe_r = relative_pose_error(gt, est, delta=delta, unit=unit)
+    result = AttrDict(ate=error_stats(absolute_trajectory_error(gt, est, align=align)),
+                      rpe_trans=error_stats(rpe_t), rpe_rot=error_stats(np.rad2deg(rpe_r)))
+    if kitti:
+        result.kitti = kitti_summary(kitti_segment_errors(gt, est))
+    return result
+
+###############################################################################
+# Command-line evaluation of multiple sequences
+
+def load_poses(fn, fmt='kitti'):
+    """ Load poses (as RigidTransformArray) for the supported formats """
+    fn = os.path.expanduser(fn)
+    if fmt == 'kitti':
+        from pybot.utils.dataset.kitti import kitti_load_poses
+        return kitti_load_poses(fn, as_array=True)
+    elif fmt == 'toon':
+        from pybot.utils.dataset.toon import load_poses as toon_load_poses
+        return toon_load_poses(fn, as_array=True)
+    elif fmt == 'tsukuba':
+        from pybot.utils.dataset.tsukuba import tsukuba_load_poses
+        return tsukuba_load_poses(fn, as_array=True)
+    raise ValueError('Unknown pose format {:}, use kitti/toon/tsukuba'.format(fmt))
+
+def evaluate_files(gt_fn, est_fn, fmt='kitti', **kwargs):
+    return evaluate_trajectory(load_poses(gt_fn, fmt=fmt),
+                               load_poses(est_fn, fmt=fmt), **kwargs)
+
+def _evaluate_files_star(args):
+    gt_fn, est_fn, fmt, kwargs = args
+    return evaluate_files(gt_fn, est_fn, fmt=fmt, **kwargs)
+
+def evaluate_sequences(gt_fns, est_fns, fmt='kitti', processes=None, **kwargs):
+    """
+    Evaluate multiple sequences in parallel processes
+    (processes=1 evaluates sequentially)
+    """
+    jobs = [(gt_fn, est_fn, fmt, kwargs) for gt_fn, est_fn in zip(gt_fns, est_fns)]
+    if processes == 1 or len(jobs) <= 1:
+        return map(_evaluate_files_star, jobs)
+
+    from multiprocessing import Pool
+    pool = Pool(processes=processes)
+    try:
+        return pool.map(_evaluate_files_star, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+def format_result(name, result):
+    s = '{:}\n\tATE (m): rmse {:.4f}, mean {:.4f}, median {:.4f}, max {:.4f}\n' \
+        '\tRPE trans (m): rmse {:.4f}, mean {:.4f}\n' \
+        '\tRPE rot (deg): rmse {:.4f}, mean {:.4f}'\
+        .format(name, result.ate.rmse, result.ate.mean, result.ate.median, result.ate.max,
+                result.rpe_trans.rmse, result.rpe_trans.mean,
+                result.rpe_rot.rmse, result.rpe_rot.mean)
+    if 'kitti' in result:
+        s += '\n\tKITTI: t_err {:.4f} %, r_err {:.6f} deg/m'\
+             .format(result.kitti.t_err, result.kitti.r_err)
+    return s
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Evaluate estimated trajectories against ground truth (ATE/RPE/KITTI)')
+    parser.add_argument(
+        '-g', '--gt', type=str, required=True, nargs='+',
+        help="Ground truth pose file(s)")
+    parser.add_argument(
+        '-e', '--est', type=str, required=True, nargs='+',
+        help="Estimated pose file(s), in the same order as --gt")
+    parser.add_argument(
+        '-f', '--format', type=str, default='kitti', choices=['kitti', 'toon', 'tsukuba'],
+        help="Pose file format")
+    parser.add_argument(
+        '-a', '--align', type=str, default='se3', choices=['se3', 'sim3', 'none'],
+        help="Trajectory alignment for ATE")
+    parser.add_argument(
+        '-d', '--delta', type=float, default=1,
+        help="RPE window (in --unit)")
+    parser.add_argument(
+        '-u', '--unit', type=str, default='frames', choices=['frames', 'm'],
+        help="RPE window unit")
+    parser.add_argument(
+        '--kitti', action='store_true',
+        help="Compute KITTI segment errors")
+    parser.add_argument(
+        '-j', '--processes', type=int, default=None,
+        help="Number of parallel processes (default: cpu count)")
+    args = parser.parse_args()
+
+    if len(args.gt) != len(args.est):
+        raise ValueError('Provide the same number of ground truth and estimated files')
+
+    results = evaluate_sequences(args.gt, args.est, fmt=args.format, processes=args.processes,
+                                 align=None if args.align == 'none' else args.align,
+                                 delta=args.delta if args.unit == 'm' else int(args.delta),
+                                 unit=args.unit, kitti=args.kitti)
+    for est_fn, result in zip(args.est, results):
+        print(format_result(est_fn, result))
@@ -0,0 +1,198 @@
+"""
+In-process transform tree (similar to a tf buffer) with time-stamped
+edges, that does not require a running ROS master.
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import numpy as np
+
+from pybot.geometry.rigid_transform import RigidTransform, RigidTransformArray
+from pybot.utils.pose_utils import Trajectory
+
+class TransformTree(object):
+    """
+    Tree of coordinate frames, where each child frame is attached
+    to its parent via a time-indexed edge (Trajectory of the
+    child's pose in the parent frame, i.e. p_parent_child), or a
+    static (time-independent) edge.
+
+    lookup(from_frame, to_frame, t) returns the pose of to_frame
+    expressed in from_frame (p_from_to), similar to
+    tf.TransformListener.lookupTransform(from_frame, to_frame, t).
+    Edge chains between frame pairs are cached, along with fully
+    composed static relations.
+    """
+    def __init__(self):
+        self.parent_ = {}
+        self.edges_ = {}
+        self.static_ = {}
+
+        self.chain_cache_ = {}
+        self.static_cache_ = {}
+
+    def __repr__(self):
+        return 'TransformTree: {:} frames, {:} edges ({:} static)'.format(
+            len(self.frames), len(self.parent_), len(self.static_))
+
+    def __contains__(self, frame):
+        return frame in self.parent_ or frame in self.parent_.itervalues()
+
+    def _invalidate_cache(self):
+        self.chain_cache_ = {}
+        self.static_cache_ = {}
+
+    def _set_parent(self, parent, child):
+        if parent == child:
+            raise ValueError('TransformTree frame {:} cannot be its own parent'.format(child))
+
+        # Re-parenting replaces the existing edge
+        if self.parent_.get(child, None) != parent:
+            self.parent_[child] = parent
+            self.edges_.pop(child, None)
+            self.static_.pop(child, None)
+            self._invalidate_cache()
+
+    def add(self, parent, child, t, pose, static=False):
+        """ Add a single transform (RigidTransform) p_parent_child at time t """
+        self.extend(parent, child, [t], pose, static=static)
+
+    def extend(self, parent, child, timestamps, poses, static=False):
+        """
+        Add time-stamped transforms p_parent_child in bulk, with
+        timestamps [N] and poses (RigidTransformArray, or list of
+        RigidTransforms). Static edges retain only the latest pose.
+        """
+        self._set_parent(parent, child)
+        if static:
+            poses = Trajectory(timestamps, poses)
+            self.edges_.pop(child, None)
+            self.static_[child] = poses[-1][1]
+            self.static_cache_ = {}
+            return
+
+        self.static_.pop(child, None)
+        if child not in self.edges_:
+            self.edges_[child] = Trajectory()
+        self.edges_[child].extend(timestamps, poses)
+
+    def _ancestors(self, frame):
+        chain = [frame]
+        while chain[-1] in self.parent_:
+            chain.append(self.parent_[chain[-1]])
+            if len(chain) > len(self.parent_) + 1:
+                raise RuntimeError('TransformTree has a loop at frame {:}'.format(frame))
+        return chain
+
+    def chain(self, from_frame, to_frame):
+        """
+        Returns the edges (child frames) from the common ancestor to
+        from_frame, and from the common ancestor to to_frame
+        """
+        key = (from_frame, to_frame)
+        if key in self.chain_cache_:
+            return self.chain_cache_[key]
+
+        if from_frame not in self or to_frame not in self:
+            raise KeyError('TransformTree does not contain frame {:}'
+                           .format(from_frame if from_frame not in self else to_frame))
+        a, b = self._ancestors(from_frame), self._ancestors(to_frame)
+        common = set(a).intersection(b)
+        if not len(common):
+            raise KeyError('TransformTree frames {:} and {:} are not connected'
+                           .format(from_frame, to_frame))
+
+        # Edges are identified by their child frames, ordered from
+        # the common ancestor downwards
+        ia = min(a.index(f) for f in common)
+        ib = b.index(a[ia])
+        self.chain_cache_[key] = (a[:ia][::-1], b[:ib][::-1])
+        return self.chain_cache_[key]
+
+    def is_static(self, from_frame, to_frame):
+        up, down = self.chain(from_frame, to_frame)
+        return all(f in self.static_ for f in up + down)
+
+    def latest_common_time(self, from_frame, to_frame):
+        """
+        Latest time at which all (non-static) edges between the
+        frames are available (None for static relations)
+        """
+        up, down = self.chain(from_frame, to_frame)
+        ts = [self.edges_[f].timestamps[-1] for f in up + down if f in self.edges_]
+        return min(ts) if len(ts) else None
+
+    def time_range(self, from_frame, to_frame):
+        """ Time range [t0, t1] within which the relation can be interpolated """
+        up, down = self.chain(from_frame, to_frame)
+        ts = [self.edges_[f].timestamps for f in up + down if f in self.edges_]
+        if not len(ts):
+            return (-np.inf, np.inf)
+        return (max(t[0] for t in ts), min(t[-1] for t in ts))
+
+    def _compose(self, frames, t):
+        """ Compose edges (from the common ancestor downwards) at times t """
+        p = None
+        for f in frames:
+            if f in self.static_:
+                e = self.static_[f]
+                e = RigidTransformArray(e.quat.q, e.tvec)
+            else:
+                e = self.edges_[f].query(t)
+            p = e if p is None else p.oplus(e)
+        return p
+
+    def lookup(self, from_frame, to_frame, t=None, extrapolate=False):
+        """
+        Pose of to_frame expressed in from_frame (p_from_to) at
+        time(s) t, interpolated across all the edges in the chain.
+        t=None uses the latest common time of the relation.
+
+        Returns RigidTransform (for scalar t), or RigidTransformArray [N]
+        """
+        if from_frame == to_frame and from_frame in self:
+            return RigidTransform.identity() if t is None or np.isscalar(t) \
+                else RigidTransformArray.identity(len(np.ravel(t)))
+
+        # Fully static relations are composed once, and cached
+        if self.is_static(from_frame, to_frame):
+            key = (from_frame, to_frame)
+            if key not in self.static_cache_:
+                self.static_cache_[key] = self._lookup(from_frame, to_frame, None)[0]
+            p = self.static_cache_[key]
+            if t is None or np.isscalar(t):
+                return p
+            return RigidTransformArray(np.tile(p.quat.q, (len(np.ravel(t)),1)),
+                                       np.tile(p.tvec, (len(np.ravel(t)),1)))
+
+        scalar = t is None or np.isscalar(t)
+        if t is None:
+            t = self.latest_common_time(from_frame, to_frame)
+        elif not extrapolate:
+            t0, t1 = self.time_range(from_frame, to_frame)
+            tq = np.ravel(t)
+            if np.any(tq < t0) or np.any(tq > t1):
+                raise ValueError('TransformTree lookup {:} => {:} requires extrapolation, '
+                                 'queried [{:}, {:}] outside [{:}, {:}]'
+                                 .format(from_frame, to_frame, tq.min(), tq.max(), t0, t1))
+
+        p = self._lookup(from_frame, to_frame, np.ravel(t))
+        return p[0] if scalar else p
+
+    def _lookup(self, from_frame, to_frame, t):
+        up, down = self.chain(from_frame, to_frame)
+        n = 1 if t is None else len(t)
+        p_a_from, p_a_to = self._compose(up, t), self._compose(down, t)
+        if p_a_from is None:
+            p_a_from = RigidTransformArray.identity(n)
+        if p_a_to is None:
+            p_a_to = RigidTransformArray.identity(n)
+        return p_a_to.ominus(p_a_from)
+
+    @property
+    def frames(self):
+        return set(self.parent_.keys()).union(self.parent_.values())
+
+    @property
+    def parents(self):
+        return dict(self.parent_)
@@ -1,18 +1,24 @@
 # Author: Sudeep Pillai <spillai@csail.mit.edu>
 # License: MIT
 
+import os
 import time
 import cv2
 import numpy as np
 
+from itertools import izip, islice
+from collections import deque
+
 from scipy.cluster.vq import vq, kmeans2
 from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
 
 from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.mixture import GMM
 
 from pybot.vision.color_utils import get_random_colors
 from pybot.utils.db_utils import AttrDict
+from pybot.vision.hamming_utils import hamming_distance, hamming_nearest, kmajority
 
 from pybot_vision import flair_code
 
@@ -31,6 +37,14 @@ def normalize_hist(hist, norm_method='global-l2'):
     [2] Segmentation Driven Object Detection with Fisher Vectors, Cinbis et al
 
     """
+    return normalize_hists(hist[np.newaxis], norm_method=norm_method)[0]
+
+def normalize_hists(hists, norm_method='global-l2'): 
+    """
+    Batch normalize_hist over the first axis of hists [n x ...]
+    """
+    n = len(hists)
+    l2 = lambda h: np.sqrt((h.reshape(n,-1) ** 2).sum(axis=1)).reshape((n,) + (1,) * (h.ndim-1))
 
     # Component-wise mass normalization 
     if norm_method == 'component-wise-mass': 
@@ -38,21 +52,31 @@ def normalize_hist(hist, norm_method='global-l2'):
 
     # Component-wise L2 normalization
     elif norm_method == 'component-wise-l2': 
-        return hist / np.max(np.linalg.norm(hist, axis=1), 1e-12)
+        return hists / np.maximum(np.linalg.norm(hists, axis=-1), 1e-12)[...,np.newaxis]
 
     # Global L2 normalization
     elif norm_method == 'global-l2': 
-        return hist / (np.linalg.norm(hist) + 1e-12)
+        return hists / (l2(hists) + 1e-12)
 
     # Square rooting / Power Normalization with alpha = 0.5
     elif norm_method == 'square-rooting': 
         # Power-normalization followed by L2 normalization as in [2]
-        hist = np.sign(hist) * np.sqrt(np.fabs(hist))
-        return hist / (np.linalg.norm(hist) + 1e-12)
+        hists = np.sign(hists) * np.sqrt(np.fabs(hists))
+        return hists / (l2(hists) + 1e-12)
 
     else: 
         raise NotImplementedError('Unknown normalization_method %s' % norm_method)            
 
+def one_hot(labels, K, columns=None, N=None): 
+    """ 
+    Sparse [K x N] one-hot assignment matrix for labels [M] in [0, K), 
+    of columns [M] (default arange(N), with N = M)
+    """
+    M = len(labels)
+    columns = np.arange(M) if columns is None else columns
+    N = M if N is None else N
+    return csr_matrix((np.ones(M, dtype=np.float32), (labels, columns)), shape=(K, N))
+
 
 def bow(data, code, K): 
     """
@@ -71,6 +95,36 @@ def bow_histogram(data, codebook, pts=None, shape=None):
     code_hist = bow(data, code, codebook.shape[0])
     return code_hist
 
+def spatial_pyramid_bins(pts, rects, levels=(1,2,4)): 
+    """
+    Spatial pyramid bins of pts [N x 2] within each of the rects
+    [B x 4] (x1, y1, x2, y2), over all levels. 
+
+    Returns (rows, bins), where rows index into pts, and bins are 
+    in [0, B * nbins) ordered as [rect, level, ybin, xbin], with 
+    nbins = sum(levels ** 2) bins per rect
+    """
+    pts = np.asarray(pts).reshape(-1,2).astype(np.int64)
+    rects = np.asarray(rects).reshape(-1,4).astype(np.int64)
+    nbins = sum(level * level for level in levels)
+    
+    # Ownership of each pt w.r.t each rect
+    inside = (pts[:,0] >= rects[:,0,np.newaxis]) & (pts[:,0] <= rects[:,2,np.newaxis]) & \
+             (pts[:,1] >= rects[:,1,np.newaxis]) & (pts[:,1] <= rects[:,3,np.newaxis])
+    ridx, rows = np.nonzero(inside)
+    xs, ys = pts[rows,0] - rects[ridx,0], pts[rows,1] - rects[ridx,1]
+    W, H = rects[ridx,2] - rects[ridx,0] + 1, rects[ridx,3] - rects[ridx,1] + 1
+
+    # For each pt, and each level find the x and y bin
+    bins, offset = [], 0
+    for level in levels: 
+        xbin, ybin = (xs * level) // W, (ys * level) // H
+        bins.append(ridx * nbins + offset + ybin * level + xbin)
+        offset += level * level
+
+    return np.tile(rows, len(levels)), np.concatenate(bins) if len(bins) \
+        else np.empty(0, dtype=np.int64)
+
 def bow_project(data, codebook, pts=None, shape=None, levels=(1,2,4)): 
     """
     Project the descriptions on to the codebook/vocabulary, 
@@ -78,38 +132,24 @@ def bow_project(data, codebook, pts=None, shape=None, levels=(1,2,4)):
     [N x 1] => [1 x K] histogram
 
     Otherwise, if kpts and bbox shape specified, perform spatial pooling
+    (quantizing data once, and pooling all levels at once)
     """
 
     if pts is None or shape is None: 
         return bow_histogram(data, codebook)
     else: 
-        # Compute histogram for each spatial level
-        # assert(pts.dtype == np.int32)
-        pts = pts.astype(np.int32)
-        xmin, ymin = shape[0], shape[1]
-        xs, ys = pts[:,0]-xmin, pts[:,1]-ymin
-
-        # Ownership bin 
-        # For each pt, and each level find the x and y bin
-        # and assign to appropriate bin
-        # nbins = np.sum(np.array(self.levels) ** 2)
-
-        # levels = [1, 2, 4]
         assert(len(pts) == len(data))
-        hist = []
-        for j,level in enumerate(levels): 
-            # Determine the bin each point belongs to given level, and assign
-            xdim, ydim = int(np.floor((shape[2]-shape[0]) * 1. / level + 1)), int(np.floor((shape[3]-shape[1]) * 1. / level + 1))
-            xbin, ybin = xs / xdim, ys / ydim
-            bin_idx = ybin * level + xbin
-
-            # Compute histogram for each bin                
-            for lbin in range(level * level): 
-                inds, = np.where(bin_idx == lbin)
-                hist.append(bow_histogram(data[inds], codebook, pts=pts[inds], shape=shape))
+        K = codebook.shape[0]
+        nbins = sum(level * level for level in levels)
+        code, dist = vq(data, codebook)
+        rows, bins = spatial_pyramid_bins(pts, shape, levels=levels)
+
+        # Histogram for each spatial bin [nbins x K]
+        hist = np.bincount(bins * K + code[rows], minlength=nbins * K)
+        hist = normalize_hists(hist.reshape(nbins, K).astype(np.float32), norm_method='global-l2')
 
         # Stack all histograms together
-        return np.hstack(hist)
+        return hist.ravel()
 
 def bow_codebook(data, K=64): 
     km = MiniBatchKMeans(n_clusters=K, init='k-means++', 
@@ -117,6 +157,144 @@ def bow_codebook(data, K=64):
                          verbose=False).fit(data)
     return km.cluster_centers_
 
+def _iter_descriptors(chunks): 
+    """
+    Iterate over descriptor chunks [N x D], where chunks is an 
+    iterable of arrays, or of lists of arrays (e.g. IterDB.iterchunks)
+    """
+    for chunk in chunks: 
+        if not isinstance(chunk, np.ndarray): 
+            chunk = [c for c in chunk if c is not None and len(c)]
+            if not len(chunk): 
+                continue
+            chunk = np.vstack(chunk)
+        if len(chunk): 
+            yield chunk
+
+class StreamingKMeans(object): 
+    """
+    Streaming (out-of-core) mini-batch k-means, that consumes 
+    descriptor chunks from an iterator. 
+    [1] Web-scale k-means clustering, D. Sculley, In Proc. WWW, 2010. 
+
+    Each center is updated with the mean of its assigned batch 
+    descriptors, with a per-center learning rate 1 / counts. 
+    Training state is periodically checkpointed (every 
+    checkpoint_every chunks) to checkpoint, and resumed from it. 
+    """
+    def __init__(self, K=64, batch_size=10000, checkpoint=None, checkpoint_every=100, seed=0): 
+        self.K = K
+        self.batch_size = batch_size
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.rng_ = np.random.RandomState(seed)
+
+        self.centers_ = None
+        self.counts_ = np.zeros(K, dtype=np.int64)
+        self.n_seen_ = 0
+        self.n_chunks_ = 0
+
+        if checkpoint is not None and os.path.exists(checkpoint): 
+            self._restore(AttrDict.load(checkpoint))
+            print('Resuming {:} from checkpoint {:}'.format(self, checkpoint))
+
+    def __repr__(self): 
+        return 'StreamingKMeans: K={:}, seen={:}, chunks={:}'.format(self.K, self.n_seen_, self.n_chunks_)
+
+    def _assign(self, X, chunksize=1024): 
+        """ Closest center [N] via ||x||^2 - 2 x.c + ||c||^2 """
+        C = self.centers_
+        cc = np.square(C).sum(axis=1)
+        return np.concatenate([(cc - 2 * X[i:i+chunksize].dot(C.T)).argmin(axis=1) 
+                               for i in xrange(0, len(X), chunksize)])
+
+    def _init_centers(self, X): 
+        """ k-means++ seeding from X [N x D] """
+        C = np.empty((self.K, X.shape[1]), dtype=np.float32)
+        C[0] = X[self.rng_.randint(len(X))]
+        d2 = np.square(X - C[0]).sum(axis=1)
+        for k in xrange(1, self.K): 
+            p = d2 / d2.sum() if d2.sum() > 0 else None
+            C[k] = X[self.rng_.choice(len(X), p=p)]
+            d2 = np.minimum(d2, np.square(X - C[k]).sum(axis=1))
+        return C
+
+    def partial_fit(self, X): 
+        """ Update centers with descriptors X [N x D] """
+        X = np.asarray(X, dtype=np.float32)
+        if self.centers_ is None: 
+            if len(X) < self.K: 
+                raise ValueError('StreamingKMeans requires at least K={:} descriptors '
+                                 'in the first chunk, provided {:}'.format(self.K, len(X)))
+            self.centers_ = self._init_centers(X[:max(self.batch_size, self.K)])
+
+        for i in xrange(0, len(X), self.batch_size): 
+            B = X[i:i+self.batch_size]
+            labels = self._assign(B)
+            n = np.bincount(labels, minlength=self.K)
+            sums = one_hot(labels, self.K).dot(B)
+
+            # c <- c + (sum - n c) / counts
+            self.counts_ += n
+            updated = n > 0
+            self.centers_[updated] += (sums[updated] - n[updated,np.newaxis] * self.centers_[updated]) / \
+                                      self.counts_[updated,np.newaxis]
+
+            # Re-seed centers that have not been assigned any descriptors
+            empty, = np.where(self.counts_ == 0)
+            if len(empty): 
+                self.centers_[empty] = B[self.rng_.choice(len(B), len(empty))]
+            self.n_seen_ += len(B)
+        return self
+
+    def fit(self, chunks): 
+        """
+        Train on descriptor chunks (iterable of [N x D] arrays, or of 
+        lists of arrays, e.g. IterDB.iterchunks). When resuming from 
+        a checkpoint, the chunks already consumed are skipped (without 
+        stacking their descriptors). 
+        """
+        for chunk in islice(chunks, self.n_chunks_, None): 
+            for X in _iter_descriptors([chunk]): 
+                self.partial_fit(X)
+            self.n_chunks_ += 1
+            if self.checkpoint is not None and self.n_chunks_ % self.checkpoint_every == 0: 
+                self.save(self.checkpoint)
+        if self.checkpoint is not None: 
+            self.save(self.checkpoint)
+        return self
+
+    @property
+    def cluster_centers_(self): 
+        return self.centers_
+
+    def to_dict(self): 
+        return AttrDict(centers=self.centers_, counts=self.counts_, 
+                        n_seen=self.n_seen_, n_chunks=self.n_chunks_, 
+                        rng_state=self.rng_.get_state(), 
+                        params=AttrDict(K=self.K, batch_size=self.batch_size))
+
+    def _restore(self, db): 
+        if int(db.params.K) != self.K: 
+            raise ValueError('StreamingKMeans checkpoint K={:} does not match K={:}'
+                             .format(int(db.params.K), self.K))
+        self.centers_ = np.asarray(db.centers, dtype=np.float32)
+        self.counts_ = np.asarray(db.counts, dtype=np.int64)
+        self.n_seen_, self.n_chunks_ = int(db.n_seen), int(db.n_chunks)
+        self.rng_.set_state(db.rng_state)
+
+    def save(self, path): 
+        self.to_dict().save(path)
+
+def bow_codebook_streaming(chunks, K=64, batch_size=10000, checkpoint=None, checkpoint_every=100): 
+    """
+    Build [K x D] codebook from descriptor chunks, without holding
+    them in memory (see StreamingKMeans)
+    """
+    km = StreamingKMeans(K=K, batch_size=batch_size, 
+                         checkpoint=checkpoint, checkpoint_every=checkpoint_every).fit(chunks)
+    return km.cluster_centers_
+
 def flair_project(data, codebook, pts=None, shape=None, method='bow', levels=(1,2,4), step=4): 
     W, H = np.max(shape[:, -2:], axis=0)
 
@@ -125,15 +303,208 @@ def flair_project(data, codebook, pts=None, shape=None, method='bow', levels=(1,
                       W=int(W+5), H=int(H+5), K=codebook.shape[0], 
                       step=step, levels=np.array(list(levels), dtype=np.int32), encoding={'bow':0, 'vlad':1, 'fisher':2}[method])
 
+# =====================================================================
+# Hierarchical vocabulary tree
+# ---------------------------------------------------------------------
+
+class VocabularyTree(object): 
+    """
+    Hierarchical k-means vocabulary tree 
+    [1] Scalable recognition with a vocabulary tree, 
+    D. Nister and H. Stewenius, In Proc. CVPR, 2006. 
+
+    Each node is split into (at most) branch children with k-means 
+    (k-majority on Hamming distance for binary uint8 descriptors), 
+    up to depth levels, resulting in (at most) branch ** depth words
+    (leaves). Descriptors are quantized by greedily descending the 
+    tree, with O(depth * branch) distance evaluations. 
+
+    Nodes are stored in a compact array-based layout: 
+        centers_:   [M x D] node centers (node 0 is the root)
+        children_:  [M x branch] child node indices (-1 if none)
+        words_:     [M] word index of leaf nodes (-1 for internal nodes)
+    """
+    def __init__(self, branch=10, depth=4, binary=False, iterations=10, seed=0): 
+        if branch < 2 or depth < 1: 
+            raise ValueError('VocabularyTree requires branch >= 2, and depth >= 1, '
+                             'provided branch={:}, depth={:}'.format(branch, depth))
+        self.branch_ = branch
+        self.depth_ = depth
+        self.binary_ = binary
+        self.iterations_ = iterations
+        self.seed_ = seed
+
+        self.centers_ = None
+        self.children_ = None
+        self.words_ = None
+
+    def __repr__(self): 
+        return 'VocabularyTree: branch={:}, depth={:}, binary={:}, words={:}'.format(
+            self.branch_, self.depth_, self.binary_, self.K if self.ready() else None)
+
+    def ready(self): 
+        return self.centers_ is not None
+
+    def _distances(self, X, C): 
+        """ Distances between data X [N x D] and centers C [B x D], or per-row [N x B x D] """
+        if C.ndim == 2: 
+            C = C[np.newaxis]
+        if self.binary_: 
+            return hamming_distance(X[:,np.newaxis,:], C)
+        return np.square(X[:,np.newaxis,:].astype(np.float32) - C).sum(axis=-1)
+
+    def _assign(self, X, C, chunksize=4096): 
+        return np.concatenate([self._distances(X[i:i+chunksize], C).argmin(axis=1) 
+                               for i in xrange(0, len(X), chunksize)])
+
+    def _kmeans(self, X, rng): 
+        """ Cluster X into (at most) branch clusters, returning centers and labels """
+        B = self.branch_
+        C = X[rng.choice(len(X), B, replace=False)]
+        for it in xrange(self.iterations_): 
+            labels = self._assign(X, C)
+            counts = np.bincount(labels, minlength=B)
+            assignment = one_hot(labels, B)
+            if self.binary_: 
+                # k-majority: bitwise majority vote of members
+                votes = assignment.dot(np.unpackbits(X, axis=1).astype(np.float32))
+                Cn = np.packbits(votes * 2 > counts[:,np.newaxis], axis=1)
+            else: 
+                Cn = (assignment.dot(X.astype(np.float32)) / 
+                      np.maximum(counts, 1)[:,np.newaxis]).astype(X.dtype)
+
+            # Re-seed empty clusters
+            empty, = np.where(counts == 0)
+            Cn[empty] = X[rng.choice(len(X), len(empty), replace=False)]
+            if np.all(Cn == C): 
+                break
+            C = Cn
+
+        labels = self._assign(X, C)
+        valid = np.bincount(labels, minlength=B) > 0
+        return C, labels, valid
+
+    def build(self, data): 
+        """
+        Build the tree from data [N x D] (float, or packed binary uint8), 
+        or from the data collected by a VocabBuilder
+        """
+        if isinstance(data, VocabBuilder): 
+            data = data.data
+        data = np.asarray(data)
+        if self.binary_ and data.dtype != np.uint8: 
+            raise TypeError('VocabularyTree (binary) requires uint8 descriptors, '
+                            'provided {:}'.format(data.dtype))
+        if not self.binary_: 
+            data = data.astype(np.float32)
+
+        st = time.time()
+        rng = np.random.RandomState(self.seed_)
+        B, D = self.branch_, data.shape[1]
+
+        # Breadth-first construction, with nodes as (index, depth, data indices)
+        centers = [np.zeros(D, dtype=data.dtype)]
+        children = [np.full(B, -1, dtype=np.int32)]
+        queue = [(0, 0, np.arange(len(data)))]
+        while len(queue): 
+            node, depth, inds = queue.pop(0)
+            if depth >= self.depth_ or len(inds) < B: 
+                continue
+            C, labels, valid = self._kmeans(data[inds], rng)
+            for b in np.where(valid)[0]: 
+                children[node][b] = len(centers)
+                centers.append(C[b])
+                children.append(np.full(B, -1, dtype=np.int32))
+                queue.append((len(centers)-1, depth+1, inds[labels == b]))
+
+        self.centers_ = np.vstack(centers)
+        self.children_ = np.vstack(children)
+
+        # Leaves are words
+        leaves = (self.children_ < 0).all(axis=1)
+        leaves[0] = len(self.centers_) == 1
+        self.words_ = np.full(len(self.centers_), -1, dtype=np.int32)
+        self.words_[leaves] = np.arange(leaves.sum())
+
+        print('Vocabulary tree construction from data {:} => {:} took {:5.3f} s'
+              .format(data.shape, self, time.time() - st))
+        return self
+
+    def quantize(self, data, chunksize=4096): 
+        """ Quantize data [N x D] to words [N], by descending the tree """
+        if not self.ready(): 
+            raise RuntimeError('VocabularyTree is not built yet, run build() first!')
+
+        data = np.asarray(data)
+        if not self.binary_: 
+            data = data.astype(np.float32)
+        nodes = np.zeros(len(data), dtype=np.int32)
+        for depth in xrange(self.depth_): 
+            kids = self.children_[nodes]
+            active, = np.where(kids.max(axis=1) >= 0)
+            if not len(active): 
+                break
+            for i in xrange(0, len(active), chunksize): 
+                inds = active[i:i+chunksize]
+                k = kids[inds]
+                dist = self._distances(data[inds], self.centers_[np.maximum(k, 0)])
+                dist = np.where(k >= 0, dist, np.iinfo(np.int32).max if self.binary_ else np.inf)
+                nodes[inds] = k[np.arange(len(inds)), dist.argmin(axis=1)]
+        return self.words_[nodes].astype(np.int64)
+
+    @property
+    def K(self): 
+        """ Number of words (leaves) """
+        return int((self.words_ >= 0).sum())
+
+    @property
+    def codebook(self): 
+        """ Word (leaf) centers [K x D] """
+        return self.centers_[self.words_ >= 0]
+
+    def to_dict(self): 
+        return AttrDict(centers=self.centers_, children=self.children_, words=self.words_, 
+                        params=AttrDict(branch=self.branch_, depth=self.depth_, binary=int(self.binary_), 
+                                        iterations=self.iterations_, seed=self.seed_))
+
+    @classmethod
+    def from_dict(cls, db): 
+        params = db.params
+        vtree = cls(branch=int(params.branch), depth=int(params.depth), binary=bool(params.binary), 
+                    iterations=int(params.iterations), seed=int(params.seed))
+        vtree.centers_ = np.asarray(db.centers)
+        vtree.children_ = np.asarray(db.children, dtype=np.int32)
+        vtree.words_ = np.asarray(db.words, dtype=np.int32)
+        return vtree
+
+    def save(self, path): 
+        self.to_dict().save(path)
+
+    @classmethod
+    def load(cls, path): 
+        return cls.from_dict(AttrDict.load(path))
+
 # =====================================================================
 # General-purpose bag-of-words interfaces
 # ---------------------------------------------------------------------
 
 class VocabBuilder(object): 
-    def __init__(self, D, K=300, N=100000):
+    """
+    Collects (at most) N descriptors [N x D] for vocabulary training. 
+    By default, the first N descriptors are retained, and the vocabulary
+    is considered built once they are collected (full). With 
+    reservoir=True, the collected descriptors are a uniform random
+    sample of all the descriptors added so far (reservoir sampling), 
+    and the vocabulary is only considered built once finalize() is called. 
+    Descriptors are stored as dtype (e.g. uint8 for binary, or float32). 
+    """
+    def __init__(self, D, K=300, N=100000, reservoir=False, seed=0, dtype=np.uint8):
         self.D_ = D
         self.K_ = K
         self.built_ = False
+        self.reservoir_ = reservoir
+        self.rng_ = np.random.RandomState(seed)
+        self.seen_ = 0
         print('Initializing vocabulary builder K={:}, D={:}'.format(K,D))
 
         # Binary Vocab builder 
@@ -144,21 +515,49 @@ class VocabBuilder(object):
         self.N_ = N
         if N: 
             self.vocab_len_ = 0
-            self.vocab_data_ = np.empty((N, D), dtype=np.uint8)
+            self.vocab_data_ = np.empty((N, D), dtype=dtype)
         
     def add(self, desc):
-        if self.built_: 
+        if self.built: 
             return
  
         if self.vocab_len_ < self.N_:
             Nd = len(desc)
             st, end = self.vocab_len_, min(self.vocab_len_ + Nd, self.N_)
             self.vocab_data_[st:end] = desc[:end-st]
-            self.vocab_len_ += len(desc)
+            self.vocab_len_ = end
+            self.seen_ += end-st
+            desc = desc[end-st:]
             print('Vocabulary building: {:}/{:}'.format(self.vocab_len_, self.N_))
-        else: 
-            print('Vocabulary built')
-            self.built_ = True
+
+        # Reservoir sampling (Algorithm R): the i-th descriptor
+        # replaces a random slot with probability N / (i+1)
+        if self.reservoir_ and len(desc): 
+            j = (self.rng_.random_sample(len(desc)) * 
+                 (self.seen_ + np.arange(1, len(desc)+1))).astype(np.int64)
+            replace = j < self.N_
+            self.vocab_data_[j[replace]] = desc[replace]
+            self.seen_ += len(desc)
+
+    def finalize(self): 
+        """ Stop collecting descriptors, and return the collected data [N x D] """
+        if not self.built_: 
+            print('Vocabulary built from {:} samples of {:} descriptors'.format(len(self.data), self.seen_))
+        self.built_ = True
+        return self.data
+
+    @property
+    def full(self): 
+        return self.vocab_len_ >= self.N_
+
+    @property
+    def reservoir(self): 
+        return self.reservoir_
+
+    @property
+    def seen(self): 
+        """ Total number of descriptors added """
+        return self.seen_
 
         # else: 
         #     # Build vocab if not built already
@@ -174,6 +573,11 @@ class VocabBuilder(object):
     @property
     def vocab_data(self): 
         return self.vocab_data_
+
+    @property
+    def data(self): 
+        """ Collected vocabulary training data [N x D] """
+        return self.vocab_data_[:self.vocab_len_]
             
     # def project(self, desc): 
     #     return self.voc_.getClusterAssignments()
@@ -201,26 +605,48 @@ class VocabBuilder(object):
 
     @property
     def built(self): 
-        return self.built_
+        return self.built_ or (not self.reservoir_ and self.full)
 
 
 class BoWVectorizer(object): 
     default_params = AttrDict(K=64, levels=(1,2,4), 
-                              method='vlad', quantizer='kdtree', norm_method='square-rooting')
+                              method='vlad', quantizer='kdtree', norm_method='square-rooting', 
+                              branch=10, depth=4, binary=None)
     def __init__(self, K=64, levels=(1,2,4), 
-                 method='vlad', quantizer='kdtree', norm_method='square-rooting'): 
+                 method='vlad', quantizer='kdtree', norm_method='square-rooting', 
+                 branch=10, depth=4, binary=None): 
+        """
+        quantizer: 'vq', 'kdtree', 'vocab-tree' (hierarchical 
+        vocabulary tree with branch ** depth words, K is ignored, built 
+        on hamming distances for binary descriptors: binary=True, or 
+        binary=None with uint8 data), 
+        or 'hamming' (k-majority codebook and hamming distance
+        quantization, for binary uint8 descriptors)
+        """
         self.K = K
         self.levels = levels
         self.method, self.quantizer = method, quantizer
         self.norm_method = norm_method
+        self.branch, self.depth = branch, depth
+        self.binary = binary
         self.codebook = None
+        self.vtree = None
 
     def _build_codebook(self, data): 
         """
         Build [K x D] codebook/vocabulary from data
         """
         st = time.time()
-        self.codebook = bow_codebook(data, K=self.K)
+        if self.quantizer == 'vocab-tree': 
+            if self.binary is None: 
+                self.binary = data.dtype == np.uint8
+            self.vtree = VocabularyTree(branch=self.branch, depth=self.depth, 
+                                        binary=bool(self.binary)).build(data)
+            self.codebook, self.K = self.vtree.codebook, self.vtree.K
+        elif self.quantizer == 'hamming': 
+            self.codebook = kmajority(data, K=self.K)
+        else: 
+            self.codebook = bow_codebook(data, K=self.K)
         print 'Vocab construction from data %s (%s KB, %s) => codebook %s took %5.3f s' % \
             (data.shape, data.nbytes / 1024, data.dtype, self.codebook.shape, time.time() - st)
         print 'Codebook: %s' % ('GOOD' if np.isfinite(self.codebook).all() else 'BAD')
@@ -261,15 +687,37 @@ class BoWVectorizer(object):
             # self._build_codebook(np.vstack(data))
             self._build_codebook(data)
 
-    def build_incremental(self, data, N=100000): 
+    def build_streaming(self, chunks, batch_size=10000, checkpoint=None, checkpoint_every=100): 
+        """
+        Build a codebook/vocabulary from descriptor chunks (iterable of 
+        [N x D] arrays, or IterDB.iterchunks), with streaming mini-batch 
+        k-means that is checkpointed to, and resumed from checkpoint
+        """
+        st = time.time()
+        self.codebook = bow_codebook_streaming(chunks, K=self.K, batch_size=batch_size, 
+                                               checkpoint=checkpoint, checkpoint_every=checkpoint_every)
+        print 'Streaming vocab construction => codebook %s took %5.3f s' % \
+            (self.codebook.shape, time.time() - st)
+        self.index_codebook()
+
+    def build_incremental(self, data, N=100000, finalize=False, min_seen=None, reservoir=False): 
+        """
+        Collect N descriptors over calls, and build the codebook once N 
+        descriptors have been added, when finalize=True, or once min_seen 
+        descriptors have been added (if provided). With reservoir=True, 
+        a uniform random sample of N descriptors is collected until 
+        finalize=True, or min_seen. 
+        """
         if not hasattr(self, 'vbuilder__'): 
-            self.vbuilder__ = VocabBuilder(data.shape[1], K=-1, N=N)
+            self.vbuilder__ = VocabBuilder(data.shape[1], K=-1, N=N, reservoir=reservoir, 
+                                           dtype=data.dtype)
 
-        if not self.vbuilder__.built: 
-            self.vbuilder__.add(data)
-        else: 
-            train_data = self.vbuilder__.vocab_data
-            self.build(train_data)
+        vbuilder = self.vbuilder__
+        if vbuilder.built: 
+            return
+        vbuilder.add(data)
+        if finalize or (min_seen is not None and vbuilder.seen >= min_seen) or vbuilder.built: 
+            self.build(vbuilder.finalize())
         
     @staticmethod
     def compute_index(codebook): 
@@ -277,6 +725,12 @@ class BoWVectorizer(object):
 
     def index_codebook(self): 
         # Index codebook for quick querying
+        if self.quantizer == 'vocab-tree' and self.vtree is not None: 
+            self.index = self.vtree
+            return
+        elif self.quantizer == 'hamming': 
+            self.index = None
+            return
         st = time.time()
         self.index = BoWVectorizer.compute_index(self.codebook)
         print 'Indexing codebook %s took %5.3f s' % (self.codebook.shape, time.time() - st)
@@ -285,6 +739,8 @@ class BoWVectorizer(object):
     def from_dict(cls, db, index=None): 
         bowv = cls(**db.params)
         bowv.codebook = db.codebook
+        if 'vtree' in db: 
+            bowv.vtree = VocabularyTree.from_dict(db.vtree)
         if index is None: 
             bowv.index_codebook()
         else: 
@@ -298,7 +754,12 @@ class BoWVectorizer(object):
         return cls.from_dict(db)
 
     def to_dict(self): 
-        return AttrDict(codebook=self.codebook, params=AttrDict(K=self.K, levels=self.levels, method=self.method, norm_method=self.norm_method))
+        db = AttrDict(codebook=self.codebook, params=AttrDict(K=self.K, levels=self.levels, method=self.method, norm_method=self.norm_method, 
+                                                              quantizer=self.quantizer, branch=self.branch, depth=self.depth, 
+                                                              binary=self.binary))
+        if self.vtree is not None: 
+            db.vtree = self.vtree.to_dict()
+        return db
 
     def save(self, path): 
         db = self.to_dict()
@@ -313,30 +774,64 @@ class BoWVectorizer(object):
             code, dist = vq(data, self.codebook)
         elif self.quantizer == 'kdtree': 
             dist, code = self.index.query(data, k=1)
+        elif self.quantizer == 'vocab-tree': 
+            code = self.vtree.quantize(data)
+        elif self.quantizer == 'hamming': 
+            code, dist = hamming_nearest(data, self.codebook)
         else: 
-            raise NotImplementedError('Quantizer %s not implemented. Use vq or kdtree!' % self.quantizer)
+            raise NotImplementedError('Quantizer %s not implemented. Use vq, kdtree, vocab-tree or hamming!' % self.quantizer)
 
         return code
 
-    def get_histogram(self, data): 
+    def _encode(self, data, code, labels, n, rows=None): 
         """
-        Project the descriptions on to the codebook/vocabulary, 
-        returning the histogram of words
-        [N x 1] => [1 x K] histogram
+        Encode data [N x D] with codes [N] into n histograms, 
+        where data[rows] (rows [M], default all) are pooled 
+        into histograms labels [M] in [0, n), returning [n x F]
         """
+        rows = np.arange(len(data)) if rows is None else rows
         if self.method == 'vq' or self.method == 'bow': 
-            code = self.get_code(data)
-            code_hist = self.bow(data, code, self.K)
+            hists = np.bincount(labels * self.K + code[rows], minlength=n * self.K)
+            return normalize_hists(hists.reshape(n, self.K).astype(np.float32), norm_method='global-l2')
         elif self.method == 'vlad': 
-            code = self.get_code(data)
-            code_hist = self.vlad(data, code)
+            return self._vlad(data, code, labels, n, rows=rows)
         elif self.method == 'fisher': 
-            code = self.get_code(data)
-            code_hist = self.fisher(data, code)
+            return self._fisher(data, labels, n, rows=rows)
         else: 
             raise NotImplementedError('''Histogram method %s not implemented. '''
                                       '''Use vq/bow or vlad or fisher!''' % self.method)            
-        return code_hist
+
+    def get_histogram(self, data): 
+        """
+        Project the descriptions on to the codebook/vocabulary, 
+        returning the histogram of words
+        [N x 1] => [1 x K] histogram
+        """
+        return self.get_histograms([data])[0]
+
+    def get_histograms(self, data_list): 
+        """
+        Batch get_histogram for n images, with descriptors 
+        data_list [[N_1 x D], ... [N_n x D]], quantized at once
+        [n x F] feature matrix
+        """
+        n = len(data_list)
+        labels = np.repeat(np.arange(n), [len(d) for d in data_list])
+        data = np.vstack([np.asarray(d).reshape(-1, self.dimension_size) for d in data_list])
+        code = self.get_code(data) if len(data) else np.empty(0, dtype=np.int64)
+        return self._encode(data, code, labels, n)
+
+    def transform(self, data_list, pts_list=None, shapes=None): 
+        """
+        Batch project for n images, returning the [n x F] feature 
+        matrix, spatially pooled if pts_list (and shapes) are specified 
+        """
+        if pts_list is None: 
+            return self.get_histograms(data_list)
+        if shapes is None: 
+            shapes = [None] * len(data_list)
+        return np.vstack([self.project(data, pts=pts, shape=shape) 
+                          for data, pts, shape in zip(data_list, pts_list, shapes)])
 
     def visualize(self, img, data, pts, level=0, code=None): 
         """
@@ -369,35 +864,22 @@ class BoWVectorizer(object):
         if shape is None: 
             shape = (np.min(pts[:,0]), np.min(pts[:,1]), np.max(pts[:,0]), np.max(pts[:,1]))
 
-        # Compute histogram for each spatial level
-        # assert(pts.dtype == np.int32)
-        pts = pts.astype(np.int32)
-        xmin, ymin = shape[0], shape[1]
-        xs, ys = pts[:,0]-xmin, pts[:,1]-ymin
-
-        # Ownership bin 
-        # For each pt, and each level find the x and y bin
-        # and assign to appropriate bin
-        # nbins = np.sum(np.array(self.levels) ** 2)
-
-        # levels = [1, 2, 4]
-        hist = []
-        for j,level in enumerate(self.levels): 
-            # Determine the bin each point belongs to given level, and assign
-            xdim, ydim = (shape[2]-shape[0]+1) / level, (shape[3]-shape[1]+1) / level
-            xbin, ybin = xs / xdim, ys / ydim
-            bin_idx = ybin * level + xbin
-
-            # Compute histogram for each bin                
-            for lbin in range(level * level): 
-                inds, = np.where(bin_idx == lbin)
-                hist.append(self.get_histogram(data[inds]))
+        return self.project_rois(data, pts, [shape])[0]
+
+    def project_rois(self, data, pts, rects): 
+        """
+        Spatially pooled projection of the descriptions within 
+        each of the rects [B x 4] (x1, y1, x2, y2) of the same image, 
+        quantizing data once, and pooling all levels and rects at once
+        [N x D] => [B x (nbins F)], with nbins = sum(levels ** 2)
+        """
+        rects = np.asarray(rects).reshape(-1,4)
+        B, nbins = len(rects), sum(level * level for level in self.levels)
+        code = self.get_code(data) if len(data) else np.empty(0, dtype=np.int64)
+        rows, bins = spatial_pyramid_bins(pts, rects, levels=self.levels)
+        hists = self._encode(data, code, bins, B * nbins, rows=rows)
+        return hists.reshape(B, -1)
 
-        # Stack all histograms together
-        return np.hstack(hist)
-                    
-                
-            
     @staticmethod
     def normalize(hist, norm_method='global-l2'): 
         return normalize_hist(hist, norm_method=norm_method)
@@ -412,52 +894,76 @@ class BoWVectorizer(object):
         Herve Jegou, Matthijs Douze, Cordelia Schmid and Patrick Perez
         Proc. IEEE CVPR 10, June, 2010.
         """
-        residuals = np.zeros(self.codebook.shape, dtype=np.float32)
-
-        # Accumulate residuals [K x D]
-        for cidx, c in enumerate(code):
-            residuals[c] += data[cidx] - self.codebook[c]
+        return self._vlad(data, code, np.zeros(len(code), dtype=np.int64), 1)[0]
+
+    def _vlad(self, data, code, labels, n, rows=None): 
+        K, D = self.codebook.shape[:2]
+        rows = np.arange(len(data)) if rows is None else rows
+
+        # Accumulate residuals [n x K x D], as sums of 
+        # assigned data, less the assigned centers
+        idx = labels * K + code[rows]
+        sums = one_hot(idx, n * K, columns=rows, N=len(data)).dot(data.astype(np.float32)) \
+               if len(idx) else np.zeros((n * K, D), dtype=np.float32)
+        counts = np.bincount(idx, minlength=n * K).astype(np.float32)
+        residuals = (sums - counts[:,np.newaxis] * np.tile(self.codebook, (n, 1))).reshape(n, K, D)
        
         # Normalize [ Component-wise L2 / SSR followed by L2 normalization]
-        residuals = BoWVectorizer.normalize(residuals, norm_method=self.norm_method)
-        residuals = BoWVectorizer.normalize(residuals, norm_method='global-l2')
+        residuals = normalize_hists(residuals, norm_method=self.norm_method)
+        residuals = normalize_hists(residuals, norm_method='global-l2')
             
-        # Vectorize [1 x (KD)]
-        return residuals.ravel()
+        # Vectorize [n x (KD)]
+        return residuals.reshape(n, -1).astype(np.float32)
 
-    def fisher(self, data, code): 
+    def fisher(self, data, code=None): 
         """
         [1] Fisher kenrels on visual vocabularies for image categorizaton. 
         F. Perronnin and C. Dance. In Proc. CVPR, 2006.
         [2] Improving the fisher kernel for large-scale image classification. 
         Florent Perronnin, Jorge Sanchez, and Thomas Mensink. In Proc. ECCV, 2010.
+
+        Gradients are accumulated over all mixture components 
+        (posterior-weighted), hence code is unused. 
         """
+        return self._fisher(data, np.zeros(len(data), dtype=np.int64), 1)[0]
 
+    def _fisher(self, data, labels, n, rows=None): 
         # Fisher vector encoding
         K, D = self.gmm.means_.shape[:2]
-        residuals_v = np.zeros(shape=(K,D), dtype=np.float32)
-        residuals_u = np.zeros(shape=(K,D), dtype=np.float32)
+        mu, w = self.gmm.means_, self.gmm.weights_
+        sigma_inv = 1.0 / (np.sqrt(self.gmm.covars_) + 1e-12)
+        rows = np.arange(len(data)) if rows is None else rows
 
         # Posterior prob. of data under each mixture [N x K]
-        posteriors = self.gmm.predict_proba(data)
-        
-        # Inverse sqrt of covariance [K x K] 
-        sigma_inv = 1.0 / (np.sqrt(self.gmm.covars_) + 1e-12)
+        posteriors = self.gmm.predict_proba(data) if len(data) else np.empty((0, K))
+
+        # Zeroth, first and second order posterior-weighted statistics 
+        # for each histogram [n x K], [n x K x D], via the sparse 
+        # [nK x N] matrix of posteriors of data[rows] pooled into labels
+        if len(rows): 
+            P = csr_matrix((posteriors[rows].ravel(), 
+                            ((labels[:,np.newaxis] * K + np.arange(K)).ravel(), np.repeat(rows, K))), 
+                           shape=(n * K, len(data)))
+            S0 = np.asarray(P.sum(axis=1)).reshape(n, K, 1)
+            S1 = P.dot(data).reshape(n, K, D)
+            S2 = P.dot(np.square(data, dtype=np.float64)).reshape(n, K, D)
+        else: 
+            S0, S1, S2 = np.zeros((n, K, 1)), np.zeros((n, K, D)), np.zeros((n, K, D))
 
-        # Accumulate residuals [K x D]
-        for cidx, c in enumerate(code):
-            residuals_v[c] += posteriors[cidx,c] * (data[cidx] - self.codebook[c]) * sigma_inv[c]
-            residuals_u[c] += posteriors[cidx,c] * np.square((data[cidx] - self.codebook[c]) * sigma_inv[c] - 1)
+        # Gradients w.r.t. means and (diagonal) std. deviations [n x K x D]
+        residuals_v = (S1 - S0 * mu) * sigma_inv
+        residuals_u = (S2 - 2 * mu * S1 + S0 * mu * mu) * sigma_inv ** 2 - S0
 
-        for c in range(len(residuals_v)):
-            residuals_v[c] *= 1.0 / (len(data) * np.sqrt(self.gmm.weights_[c]) + 1e-12)
-            residuals_u[c] *= 1.0 / (len(data) * np.sqrt(2 * self.gmm.weights_[c]) + 1e-12)
+        Ns = np.maximum(np.bincount(labels, minlength=n), 1)[:,np.newaxis,np.newaxis]
+        residuals_v *= 1.0 / (Ns * np.sqrt(w)[:,np.newaxis] + 1e-12)
+        residuals_u *= 1.0 / (Ns * np.sqrt(2 * w)[:,np.newaxis] + 1e-12)
 
         # Normalize
-        residuals = BoWVectorizer.normalize(np.vstack([residuals_v, residuals_u]), norm_method=self.norm_method)
+        residuals = normalize_hists(np.concatenate([residuals_v, residuals_u], axis=1), 
+                                    norm_method=self.norm_method)
 
-        # Vectorize [1 x (2KD)]
-        return residuals.ravel()
+        # Vectorize [n x (2KD)]
+        return residuals.reshape(n, -1).astype(np.float32)
 
     @property
     def dictionary_size(self): 
@@ -467,3 +973,254 @@ class BoWVectorizer(object):
     def dimension_size(self): 
         return self.codebook.shape[1]
 
+
+
+# =====================================================================
+# Inverted-index image retrieval
+# ---------------------------------------------------------------------
+
+def _ranges(starts, ends): 
+    """ Concatenated indices of the ranges [starts, ends), and their lengths """
+    lengths = ends - starts
+    inds = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + \
+           np.arange(lengths.sum())
+    return inds, lengths
+
+def _posting_segment(words, frames, tf): 
+    """
+    Postings segment (words [U], offsets [U+1], frames [n], tf [n]) 
+    over the unique words, from postings (words, frames, tf) [n]. 
+    The (stable) sort keeps frames ordered within each word. 
+    """
+    order = np.argsort(words, kind='mergesort')
+    words, frames, tf = words[order], frames[order], tf[order]
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(words)) + 1]) if len(words) \
+             else np.empty(0, dtype=np.int64)
+    return words[starts], np.append(starts, len(words)), frames, tf
+
+class InvertedIndex(object): 
+    """
+    Inverted-file index over visual words with TF-IDF weighting, 
+    for retrieving previously inserted frames similar to a query. 
+    [1] Video Google: A text retrieval approach to object matching in videos, 
+    J. Sivic and A. Zisserman, In Proc. ICCV, 2003. 
+    
+    Frames (word codes from BoWVectorizer.get_code, or VocabularyTree.quantize)
+    are inserted incrementally into pending postings, that are flushed 
+    (once they exceed flush_size) into log-structured segments. Each
+    segment is a CSR-like layout over its words: 
+        words:      [U] (sorted) unique words of the segment
+        offsets:    [U+1] start of each word's postings
+        frames:     [n] frame index of each posting
+        tf:         [n] term frequency of the word within the frame
+    and segments of similar size are merged, so that there are only 
+    O(log n) segments. Queries only visit the postings of their words. 
+
+    Each frame is associated with an arbitrary key (e.g. TangoDB/BagDB 
+    frame index or timestamp). Scores are cosine similarities between 
+    tf-idf weighted histograms. The idf and frame norms are refreshed 
+    whenever the number of frames grows by refresh_ratio, and frames 
+    inserted in between are weighted with the latest idf. 
+    """
+    def __init__(self, K, flush_size=4096, refresh_ratio=0.25): 
+        self.K = K
+        self.segments_ = []
+        self.keys_ = []
+
+        # Pending (unflushed) postings, as (words, frames, tf)
+        self.pending_ = []
+        self.npending_ = 0
+        self.flush_size_ = flush_size
+
+        # Document frequencies, and the idf and frame norms (norms_ 
+        # is over-allocated) as of the latest refresh with refreshed_ frames
+        self.df_ = np.zeros(K, dtype=np.int64)
+        self.idf_ = np.zeros(K, dtype=np.float32)
+        self.norms_ = np.empty(0, dtype=np.float32)
+        self.refreshed_ = 0
+        self.refresh_ratio_ = refresh_ratio
+
+        # History of top matches for temporal consistency
+        self.history_ = deque(maxlen=16)
+
+    def __repr__(self): 
+        return 'InvertedIndex: K={:}, frames={:}, postings={:}'.format(
+            self.K, len(self), sum(len(s[2]) for s in self.segments_) + self.npending_)
+
+    def __len__(self): 
+        return len(self.keys_)
+
+    @property
+    def keys(self): 
+        return self.keys_
+
+    def _histogram(self, code): 
+        """ Unique words [W], and their term frequencies [W] """
+        code = np.asarray(code, dtype=np.int64).ravel()
+        if len(code) and (code.min() < 0 or code.max() >= self.K): 
+            raise ValueError('InvertedIndex words must be in [0, {:}), '
+                             'provided [{:}, {:}]'.format(self.K, code.min(), code.max()))
+        counts = np.bincount(code, minlength=self.K)
+        words, = np.where(counts)
+        return words, (counts[words] / float(max(len(code), 1))).astype(np.float32)
+
+    def add(self, code, key=None): 
+        """ Insert frame with word codes [N], returns the frame index """
+        idx = len(self.keys_)
+        words, tf = self._histogram(code)
+        self.pending_.append((words, np.full(len(words), idx, dtype=np.int32), tf))
+        self.npending_ += len(words)
+        self.df_[words] += 1
+        self.keys_.append(idx if key is None else key)
+
+        # Norm of the frame with the latest idf
+        if len(self.norms_) <= idx: 
+            norms = np.zeros(max(2 * len(self.norms_), 64), dtype=np.float32)
+            norms[:idx] = self.norms_[:idx]
+            self.norms_ = norms
+        self.norms_[idx] = np.linalg.norm(tf * self.idf_[words])
+
+        if self.npending_ >= self.flush_size_: 
+            self._flush()
+        return idx
+
+    def extend(self, codes, keys=None): 
+        """ Insert several frames with word codes [[N_1], ... [N_n]] """
+        keys = [None] * len(codes) if keys is None else keys
+        return [self.add(code, key=key) for code, key in izip(codes, keys)]
+
+    def _flush(self): 
+        """ Flush pending postings into a new segment, and merge segments of similar size """
+        if self.npending_: 
+            self.segments_.append(_posting_segment(*[np.concatenate(p) for p in zip(*self.pending_)]))
+        self.pending_, self.npending_ = [], 0
+        while len(self.segments_) > 1 and \
+              len(self.segments_[-2][2]) < 2 * len(self.segments_[-1][2]): 
+            self._merge(len(self.segments_) - 2)
+
+    def _merge(self, i): 
+        """ Merge segments i and i+1 (frames of segment i precede those of i+1) """
+        (wa, oa, fa, ta), (wb, ob, fb, tb) = self.segments_[i:i+2]
+        words = np.concatenate([np.repeat(wa, np.diff(oa)), np.repeat(wb, np.diff(ob))])
+        self.segments_[i:i+2] = [_posting_segment(words, np.concatenate([fa, fb]), 
+                                                  np.concatenate([ta, tb]))]
+
+    def _refresh(self): 
+        """ Flush pending postings, and recompute idf and frame norms """
+        self._flush()
+
+        # idf = log(N / df), and L2 norms of the tf-idf histograms
+        self.idf_ = np.log(float(max(len(self), 1)) / np.maximum(self.df_, 1)).astype(np.float32)
+        norms = np.zeros(len(self), dtype=np.float64)
+        for words, offsets, frames, tf in self.segments_: 
+            w = tf * np.repeat(self.idf_[words], np.diff(offsets))
+            norms += np.bincount(frames, weights=w * w, minlength=len(self))
+        self.norms_ = np.sqrt(norms).astype(np.float32)
+        self.refreshed_ = len(self)
+
+    def score(self, code): 
+        """ Cosine similarity of the query (word codes [N]) to all frames [n] """
+        if len(self) > (1. + self.refresh_ratio_) * self.refreshed_: 
+            self._refresh()
+
+        words, tf = self._histogram(code)
+        q = tf * self.idf_[words]
+        q /= max(np.linalg.norm(q), 1e-12)
+        q *= self.idf_[words]
+
+        # Sparse accumulation over the query words' postings, in 
+        # each segment (and the pending postings)
+        scores = np.zeros(len(self), dtype=np.float64)
+        for swords, offsets, frames, tf in self.segments_: 
+            j = np.minimum(np.searchsorted(swords, words), len(swords)-1)
+            found = swords[j] == words
+            inds, lengths = _ranges(offsets[j[found]], offsets[j[found]+1])
+            scores += np.bincount(frames[inds], weights=np.repeat(q[found], lengths) * tf[inds], 
+                                  minlength=len(self))
+        if self.npending_ and len(words): 
+            pwords, pframes, ptf = [np.concatenate(p) for p in zip(*self.pending_)]
+            j = np.minimum(np.searchsorted(words, pwords), len(words)-1)
+            found = words[j] == pwords
+            scores += np.bincount(pframes[found], weights=q[j[found]] * ptf[found], 
+                                  minlength=len(self))
+        return (scores / np.maximum(self.norms_[:len(self)], 1e-12)).astype(np.float32)
+
+    def query(self, code, k=10, exclude_recent=0): 
+        """
+        Top-k frames for the query (word codes [N]), ignoring the 
+        most recently inserted exclude_recent frames. 
+        Returns frame indices [k] and scores [k] (descending)
+        """
+        scores = self.score(code)
+        n = max(len(scores) - exclude_recent, 0)
+        k = min(k, n)
+        if k <= 0: 
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        inds = np.argpartition(-scores[:n], k-1)[:k]
+        inds = inds[np.argsort(-scores[inds], kind='mergesort')]
+        return inds, scores[inds]
+
+    def query_consistent(self, code, k=10, exclude_recent=0, window=3, consistency=2, min_score=0.): 
+        """
+        Top-k query, retaining only matches that are temporally
+        consistent, i.e. the previous consistency queries each had
+        a match within window frames of it. The history of
+        matches is updated with every call (call reset() when
+        the query sequence is discontinuous).
+        """
+        inds, scores = self.query(code, k=k, exclude_recent=exclude_recent)
+        keep = scores > min_score
+        inds, scores = inds[keep], scores[keep]
+        self.history_.append(inds)
+
+        if len(self.history_) <= consistency: 
+            return inds[:0], scores[:0]
+        consistent = np.ones(len(inds), dtype=np.bool)
+        for prev in list(self.history_)[-consistency-1:-1]: 
+            if not len(prev): 
+                return inds[:0], scores[:0]
+            consistent &= (np.abs(inds[:,np.newaxis] - prev[np.newaxis,:]) <= window).any(axis=1)
+        return inds[consistent], scores[consistent]
+
+    def reset(self): 
+        self.history_.clear()
+
+    def save(self, path): 
+        """
+        Save to directory path, as individual .npy arrays that
+        can be memory-mapped on load. The postings are merged 
+        into a single CSR-like layout over all K words. 
+        """
+        self._refresh()
+        while len(self.segments_) > 1: 
+            self._merge(len(self.segments_) - 2)
+        words, offsets, frames, tf = self.segments_[0] if len(self.segments_) else \
+                                     _posting_segment(*[np.empty(0, dtype=d) for d in (np.int64, np.int32, np.float32)])
+        counts = np.zeros(self.K, dtype=np.int64)
+        counts[words] = np.diff(offsets)
+
+        if not os.path.exists(path): 
+            os.makedirs(path)
+        for name, arr in [('offsets', np.concatenate([[0], np.cumsum(counts)])), ('frames', frames), 
+                          ('tf', tf), ('idf', self.idf_), ('norms', self.norms_[:len(self)]), 
+                          ('keys', np.asarray(self.keys_))]: 
+            np.save(os.path.join(path, '{:}.npy'.format(name)), arr)
+        print('Saved {:} to {:}'.format(self, path))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'): 
+        """
+        Load from directory path, memory-mapping the postings (by default). 
+        Further insertions copy the postings into memory when merged. 
+        """
+        load = lambda name: np.load(os.path.join(path, '{:}.npy'.format(name)), mmap_mode=mmap_mode)
+        offsets = load('offsets')
+        index = cls(len(offsets) - 1)
+        index.df_ = np.diff(offsets).astype(np.int64)
+        words, = np.where(index.df_)
+        if len(words): 
+            index.segments_ = [(words, np.append(offsets[words], offsets[-1]), load('frames'), load('tf'))]
+        index.idf_, index.norms_ = load('idf'), load('norms')
+        index.keys_ = np.load(os.path.join(path, 'keys.npy'), allow_pickle=True).tolist()
+        index.refreshed_ = len(index.keys_)
+        return index
@@ -1,9 +1,12 @@
 # Author: Sudeep Pillai <spillai@csail.mit.edu>
 # License: MIT
 
+import os
 import cv2
+import hashlib
 
 import numpy as np
+from collections import OrderedDict
 from numpy.linalg import det, norm
 import numpy.matlib as npm
 from scipy import linalg
@@ -11,7 +14,8 @@ from scipy import linalg
 from pybot.vision.color_utils import get_color_by_label
 from pybot.vision.image_utils import to_color
 from pybot.utils.db_utils import AttrDict
-from pybot.geometry.rigid_transform import Quaternion, RigidTransform
+from pybot.utils.io_utils import mkdir_p
+from pybot.geometry.rigid_transform import Quaternion, RigidTransform, RigidTransformArray
 
 kinect_v1_params = AttrDict(
     K_depth = np.array([[576.09757860, 0, 319.5],
@@ -106,14 +110,115 @@ def construct_D(k1=0, k2=0, k3=0, p1=0, p2=0):
     """
     return np.float64([k1,k2,p1,p2,k3])
 
-def undistort_image(im, K, D): 
+class UndistortRectifyMapCache(object): 
     """
+    Cache of undistortion / rectification maps (cv2.initUndistortRectifyMap), 
+    keyed by (K, D, R, P, shape, scale). Maps are stored in fixed-point 
+    (CV_16SC2) format for faster cv2.remap, held in memory with LRU 
+    eviction (up to maxlen maps), and optionally persisted to disk
+    (in directory) across processes / runs. 
+    """
+    def __init__(self, maxlen=16, directory=None): 
+        self.maxlen_ = maxlen
+        self.directory_ = os.path.expanduser(directory) if directory is not None else None
+        self.maps_ = OrderedDict()
+        if self.directory_ is not None and not os.path.exists(self.directory_): 
+            mkdir_p(self.directory_)
+
+    def __len__(self): 
+        return len(self.maps_)
+
+    def __repr__(self): 
+        return 'UndistortRectifyMapCache: {:} maps (maxlen={:}, directory={:})'\
+            .format(len(self), self.maxlen_, self.directory_)
+
+    def clear(self): 
+        self.maps_.clear()
+
+    @staticmethod
+    def key(K, D, R, P, shape, scale=1.0): 
+        h = hashlib.sha1()
+        for item in (K, D, R, P, shape[:2], scale): 
+            h.update(np.ascontiguousarray(item, dtype=np.float64).tostring())
+        return h.hexdigest()
+
+    def get(self, K, D, R=None, P=None, shape=None, scale=1.0): 
+        """
+        Returns fixed-point maps (map1 [H x W x 2] int16, map2 [H x W] uint16) 
+        for cv2.remap, for images of shape (H,W) scaled by scale
+        """
+        if shape is None: 
+            raise ValueError('UndistortRectifyMapCache requires image shape (H,W)')
+        K = np.float64(K)
+        D = np.float64(D) if D is not None else np.zeros(5)
+        R = np.float64(R) if R is not None else np.eye(3)
+        P = np.float64(P) if P is not None else K
+
+        key = UndistortRectifyMapCache.key(K, D, R, P, shape, scale)
+        try: 
+            maps = self.maps_.pop(key)
+        except KeyError: 
+            maps = self._load(key)
+            if maps is None: 
+                maps = self._compute(K, D, R, P, shape, scale)
+                self._save(key, maps)
+
+        # Most-recently used is last, evict the oldest
+        self.maps_[key] = maps
+        while len(self.maps_) > self.maxlen_: 
+            self.maps_.popitem(last=False)
+        return maps
+
+    @staticmethod
+    def _compute(K, D, R, P, shape, scale): 
+        if scale != 1.0: 
+            S = np.diag([scale, scale, 1.0])
+            K, P = S.dot(K), S.dot(P)
+        H, W = np.int32(np.float64(shape[:2]) * scale)
+        return cv2.initUndistortRectifyMap(K, D, R, P, (W, H), cv2.CV_16SC2)
+
+    def _load(self, key): 
+        if self.directory_ is None: 
+            return None
+        fn = os.path.join(self.directory_, '{:}.npz'.format(key))
+        if not os.path.exists(fn): 
+            return None
+        try: 
+            data = np.load(fn)
+            return (data['map1'], data['map2'])
+        except Exception as e: 
+            print('{:} :: Failed to load {:}, recomputing: {:}'.format(self.__class__.__name__, fn, e))
+            return None
+
+    def _save(self, key, maps): 
+        if self.directory_ is None: 
+            return
+        np.savez(os.path.join(self.directory_, '{:}.npz'.format(key)), map1=maps[0], map2=maps[1])
+
+# Default (in-memory) cache shared by the undistort / rectify helpers
+undistort_map_cache = UndistortRectifyMapCache()
+
+def undistort_rectify_maps(K, D, R=None, P=None, shape=None, scale=1.0, cache=None): 
+    """ Cached (fixed-point) undistortion / rectification maps """
+    return (cache if cache is not None else undistort_map_cache).get(
+        K, D, R=R, P=P, shape=shape, scale=scale)
+
+def undistort_image(im, K, D, cache=None): 
+    """
+    Undistort image with (cached) fixed-point undistortion maps
+
     Optionally: 
         newcamera, roi = cv2.getOptimalNewCameraMatrix(self.K, self.D, (W,H), 0) 
     """
-    H,W = im.shape[:2]
-    Kprime, roi = cv2.getOptimalNewCameraMatrix(K, D, (W,H), 1, (W,H))
-    return cv2.undistort(im, K, D, None, K)
+    map1, map2 = undistort_rectify_maps(K, D, shape=im.shape[:2], cache=cache)
+    return cv2.remap(im, map1, map2, cv2.INTER_LINEAR)
+
+def rectify_image(im, K, D, R, P, interpolation=cv2.INTER_LINEAR, cache=None): 
+    """
+    Undistort and rectify image with (cached) fixed-point maps
+    """
+    map1, map2 = undistort_rectify_maps(K, D, R=R, P=P, shape=im.shape[:2], cache=cache)
+    return cv2.remap(im, map1, map2, interpolation)
 
 # def camera_from_P(P): 
     
@@ -263,8 +368,8 @@ class CameraIntrinsic(object):
         Z = colvec(xyZ[:,2])
         return self.ray(xyZ[:,:2], undistort=undistort) * Z
         
-    def undistort(self, im): 
-        return undistort_image(im, self.K, self.D)
+    def undistort(self, im, cache=None): 
+        return undistort_image(im, self.K, self.D, cache=cache)
 
     def undistort_points(self, pts): 
         """
@@ -311,6 +416,10 @@ class CameraExtrinsic(RigidTransform):
         RigidTransform.__init__(self, xyzw=p.quat.to_xyzw(), tvec=p.tvec)
         self.__cached_inverse = None
 
+    def _invalidate_cache(self): 
+        super(CameraExtrinsic, self)._invalidate_cache()
+        self.__cached_inverse = None
+
     def inverse(self): 
         if self.__cached_inverse is None: 
             self.__cached_inverse = super(CameraExtrinsic, self).inverse()
@@ -459,7 +568,7 @@ class Camera(CameraIntrinsic, CameraExtrinsic):
         Transform points in camera frame, and check z-vector: 
         [p_c = T_cw * p_w]
         """
-        return (self.extrinsics * X)[:,2]
+        return self.transform(X)[:,2]
 
     def factor(self): 
         """
@@ -552,6 +661,130 @@ class Camera(CameraIntrinsic, CameraExtrinsic):
     def load(cls, filename):
         raise NotImplementedError()
 
+class CameraArray(object): 
+    """
+    Stack of M cameras, with intrinsics K [M x 3 x 3], distortion 
+    D [M x 5] (k1,k2,p1,p2,k3), image shapes [M x 2] (H,W) and
+    extrinsics as a RigidTransformArray [M] (same convention as 
+    Camera, i.e. X_c = R X_w + t). 
+
+    Allows N points to be projected into all the M cameras 
+    in a single vectorized pass (see project, visibility).
+    """
+    def __init__(self, K, poses, D=None, shape=None): 
+        self.K = np.asarray(K, dtype=np.float64).reshape(-1,3,3)
+        self.poses = poses if isinstance(poses, RigidTransformArray) \
+                     else RigidTransformArray.from_list(poses)
+        if len(self.K) == 1 and len(self.poses) > 1: 
+            self.K = np.tile(self.K, (len(self.poses),1,1))
+        if len(self.K) != len(self.poses): 
+            raise ValueError('CameraArray intrinsics and poses length mismatch {:} != {:}'
+                             .format(len(self.K), len(self.poses)))
+
+        # Distortion [M x 5], padded / truncated to (k1,k2,p1,p2,k3)
+        self.D = np.zeros((len(self.K),5), dtype=np.float64)
+        if D is not None: 
+            D = np.atleast_2d(np.asarray(D, dtype=np.float64))[:,:5]
+            self.D[:,:D.shape[1]] = D
+        self.shape = np.int32(np.broadcast_to(np.reshape(shape, (-1,2)), (len(self.K),2))) \
+                     if shape is not None else None
+
+    def __repr__(self): 
+        return 'CameraArray: {:} cameras'.format(len(self))
+
+    def __len__(self): 
+        return len(self.K)
+
+    def __getitem__(self, index): 
+        """ Integer indexing returns a Camera, otherwise a CameraArray """
+        if isinstance(index, (int, np.integer)): 
+            p = self.poses[index]
+            R, t = p.to_Rt()
+            return Camera(self.K[index], R, t, D=self.D[index], 
+                          shape=self.shape[index] if self.shape is not None else None)
+        return CameraArray(self.K[index], self.poses[index], D=self.D[index], 
+                           shape=self.shape[index] if self.shape is not None else None)
+
+    @classmethod
+    def from_cameras(cls, cameras): 
+        """ Stack a list of Cameras """
+        if any(c.shape is None for c in cameras): 
+            shape = None
+        else: 
+            shape = np.vstack([c.shape[:2] for c in cameras])
+        return cls(np.float64([c.K for c in cameras]), 
+                   RigidTransformArray.from_list(cameras), 
+                   D=np.vstack([np.hstack([np.ravel(c.D)[:5], np.zeros(5)])[:5] for c in cameras]), 
+                   shape=shape)
+
+    @property
+    def fx(self): 
+        return self.K[:,0,0]
+
+    @property
+    def fy(self): 
+        return self.K[:,1,1]
+
+    @property
+    def cx(self): 
+        return self.K[:,0,2]
+
+    @property
+    def cy(self): 
+        return self.K[:,1,2]
+
+    def transform(self, X): 
+        """ Transform [N x 3] points into each of the cameras' frame [M x N x 3] """
+        return self.poses * np.asarray(X, dtype=np.float64).reshape(-1,3)
+
+    def project(self, X, check_bounds=True, min_depth=0.1, max_depth=np.inf, distort=True): 
+        """
+        Project [N x 3] points into all the M cameras
+
+        Returns: 
+            pts: Image coordinates [M x N x 2]
+            depths: Depths of the points in each camera [M x N]
+            visible: Visibility mask [M x N] (within min/max depth, 
+                     and image bounds if check_bounds=True)
+        """
+        if check_bounds and self.shape is None: 
+            raise ValueError('check_bounds cannot proceed. CameraArray.shape is not set')
+
+        Xc = self.transform(X)
+        depths = Xc[:,:,2]
+        visible = (depths >= min_depth) & (depths <= max_depth)
+
+        with np.errstate(divide='ignore', invalid='ignore'): 
+            x, y = Xc[:,:,0] / depths, Xc[:,:,1] / depths
+
+        # Distortion (OpenCV model, as in cv2.projectPoints)
+        if distort and np.any(self.D): 
+            k1, k2, p1, p2, k3 = [d[:,np.newaxis] for d in self.D.T]
+            x2, y2, xy = x * x, y * y, x * y
+            r2 = x2 + y2
+            radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+            x, y = x * radial + 2 * p1 * xy + p2 * (r2 + 2 * x2), \
+                   y * radial + p1 * (r2 + 2 * y2) + 2 * p2 * xy
+
+        pts = np.empty(Xc.shape[:2] + (2,), dtype=np.float64)
+        pts[:,:,0] = self.fx[:,np.newaxis] * x + self.cx[:,np.newaxis]
+        pts[:,:,1] = self.fy[:,np.newaxis] * y + self.cy[:,np.newaxis]
+
+        if check_bounds: 
+            H, W = self.shape[:,0,np.newaxis], self.shape[:,1,np.newaxis]
+            visible &= (pts[:,:,0] >= 0) & (pts[:,:,0] < W) & \
+                       (pts[:,:,1] >= 0) & (pts[:,:,1] < H)
+        return pts, depths, visible
+
+    def visibility(self, X, **kwargs): 
+        """ Visibility mask [M x N] of [N x 3] points in each camera """
+        return self.project(X, **kwargs)[2]
+
+    def covisibility(self, X, **kwargs): 
+        """ Number of co-visible points [M x M] between every pair of cameras """
+        vis = self.visibility(X, **kwargs).astype(np.int32)
+        return np.dot(vis, vis.T)
+
 class StereoCamera(Camera): 
     def __init__(self, lcamera, rcamera, baseline): 
         if not isinstance(lcamera, Camera) or not isinstance(rcamera, Camera): 
@@ -652,6 +885,14 @@ class StereoCamera(Camera):
         right = self.right.scaled(scale)
         return StereoCamera(left, right, baseline=self.baseline)
 
+    def rectify(self, left_im, right_im, interpolation=cv2.INTER_LINEAR, cache=None): 
+        """
+        Rectify frames passed as (left, right), with cached 
+        undistortion / rectification maps 
+        """
+        return [rectify_image(im, cam.K, cam.D, cam.R, cam.P, interpolation=interpolation, cache=cache)
+                for im, cam in zip([left_im, right_im], [self.left, self.right])]
+
     def disparity_from_plane(self, rows, height): 
         """
         Computes the disparity image from expected height for each of
@@ -831,9 +1072,9 @@ def check_visibility(camera, pts_w, zmin=0, zmax=100):
     hangle, vangle = np.arctan2(v[:,0], v[:,2]), np.arctan2(-v[:,1], v[:,2])
 
     # Provides inds mask for all points that are within fov
-    return np.fabs(hangle) < camera.fov[0] * 0.5 and \
-        np.fabs(vangle) < camera.fov[1] * 0.5 and \
-        z >= zmin and z <= zmax
+    return (np.fabs(hangle) < camera.fov[0] * 0.5) & \
+        (np.fabs(vangle) < camera.fov[1] * 0.5) & \
+        (z >= zmin) & (z <= zmax)
 
 def get_median_depth(camera, pts, subsample=10): 
     """ 
@@ -844,32 +1085,82 @@ def get_median_depth(camera, pts, subsample=10):
     """
     return np.median((camera * pts[::subsample])[:,2])
 
+def _project_with_depth(camera, pts, subsample=10): 
+    """ Project points in a single pass, returns (pts2d, depths, within-bounds) """
+    pts2d, depths, valid = CameraArray.from_cameras([camera]).project(
+        pts[::subsample], check_bounds=True, min_depth=-np.inf)
+    return pts2d[0], depths[0], valid[0]
+
 def get_bounded_projection(camera, pts, subsample=10): 
     """ Project points and only return points that are within image bounds """
-
-    # Project points
-    pts2d = camera.project(pts[::subsample].astype(np.float32))
-
-    # Only return points within-image bounds
-    valid = np.bitwise_and(np.bitwise_and(pts2d[:,0] >= 0, pts2d[:,0] < camera.shape[1]), \
-                           np.bitwise_and(pts2d[:,1] >= 0, pts2d[:,1] < camera.shape[0]))
+    pts2d, _, valid = _project_with_depth(camera, pts, subsample=subsample)
     return pts2d[valid], valid
 
-def get_discretized_projection(camera, pts, subsample=10, discretize=4): 
-
-    vis = np.ones(shape=(camera.shape[0]/discretize, camera.shape[1]/discretize), dtype=np.float32) * 10000.0
-    pts2d, valid = get_bounded_projection(camera, pts, subsample=subsample)
+def zbuffer_projection(camera, pts, colors=None, downsample=1, splat_radius=0, 
+                       min_depth=0.1, max_depth=np.inf, empty_depth=0): 
+    """
+    Z-buffered rasterization of [N x 3] points into the camera, 
+    i.e. each pixel retains the nearest point that projects onto it. 
 
-    if True: 
-        pts3d = pts[valid]
-        depth = (camera * pts3d[::subsample])[:,2]
-        vis[pts2d[::subsample,1], pts2d[::subsample,0]] = depth 
-    else: 
-        pts2d = pts2d.astype(np.int32) / discretize
-        depth = get_median_depth(camera, pts, subsample=subsample)
-        vis[pts2d[:,1], pts2d[:,0]] = depth 
+    downsample: Render at 1/downsample of the camera resolution
+    splat_radius: Each point covers a (2r+1) x (2r+1) pixel window
+    
+    Returns: 
+       depth: Depth image [H x W] (empty_depth where empty)
+       index: Index of the rendered point [H x W] (-1 where empty)
+       color: Color image [H x W x C] (only if colors [N x C] provided)
+    """
+    if camera.shape is None: 
+        raise ValueError('zbuffer_projection cannot proceed. Camera.shape is not set')
+    H, W = camera.shape[0] // downsample, camera.shape[1] // downsample
+
+    pts2d, depths, valid = _project_with_depth(camera, pts, subsample=1)
+    valid &= (depths >= min_depth) & (depths <= max_depth)
+    inds, = np.where(valid)
+    u = np.floor(pts2d[inds,0] / downsample).astype(np.int64)
+    v = np.floor(pts2d[inds,1] / downsample).astype(np.int64)
+    
+    # Splat each point onto its neighboring pixels
+    if splat_radius > 0: 
+        r = np.arange(-splat_radius, splat_radius+1)
+        dx, dy = [d.ravel() for d in np.meshgrid(r, r)]
+        u, v = (u[:,np.newaxis] + dx).ravel(), (v[:,np.newaxis] + dy).ravel()
+        inds = np.repeat(inds, len(dx))
+    inb = (u >= 0) & (u < W) & (v >= 0) & (v < H)
+    u, v, inds = u[inb], v[inb], inds[inb]
+
+    # Z-buffer: sort by (pixel, depth), and retain the 
+    # first (nearest) point for every pixel. Two-pass stable 
+    # argsort is considerably faster than lexsort for large N
+    lin = v * W + u
+    order = np.argsort(depths[inds])
+    order = order[np.argsort(lin[order], kind='mergesort')]
+    lin, inds = lin[order], inds[order]
+    first = np.ones(len(lin), dtype=np.bool)
+    first[1:] = lin[1:] != lin[:-1]
+    lin, inds = lin[first], inds[first]
+
+    depth_im = np.full(H * W, empty_depth, dtype=np.float32)
+    depth_im[lin] = depths[inds]
+    index_im = np.full(H * W, -1, dtype=np.int64)
+    index_im[lin] = inds
+    if colors is None: 
+        return depth_im.reshape(H, W), index_im.reshape(H, W)
+    
+    colors = np.asarray(colors)
+    color_im = np.zeros((H * W,) + colors.shape[1:], dtype=colors.dtype)
+    color_im[lin] = colors[inds]
+    return depth_im.reshape(H, W), index_im.reshape(H, W), \
+        color_im.reshape((H, W) + colors.shape[1:])
 
-    return vis, depth
+def get_discretized_projection(camera, pts, subsample=10, discretize=4): 
+    """
+    Discretized (z-buffered) depth image of the sub-sampled points, 
+    and the depths of the rendered points
+    """
+    vis, index = zbuffer_projection(camera, pts[::subsample], downsample=discretize, 
+                                    empty_depth=10000.0)
+    return vis, vis[index >= 0]
 
 def get_object_bbox(camera, pts, subsample=10, scale=1.0, min_height=10, min_width=10): 
     """
@@ -881,7 +1172,8 @@ def get_object_bbox(camera, pts, subsample=10, scale=1.0, min_height=10, min_wid
 
     """
 
-    pts2d, valid = get_bounded_projection(camera, pts, subsample=subsample)
+    pts2d, depths, valid = _project_with_depth(camera, pts, subsample=subsample)
+    pts2d = pts2d[valid]
 
     if not len(pts2d): 
         return [None] * 3
@@ -895,7 +1187,7 @@ def get_object_bbox(camera, pts, subsample=10, scale=1.0, min_height=10, min_wid
     if (xmed >= 0 and ymed >= 0 and xmed <= camera.shape[1] and ymed < camera.shape[0]) and \
        (y1-y0) >= min_height and (x1-x0) >= min_width: 
 
-        depth = get_median_depth(camera, pts, subsample=subsample)
+        depth = np.median(depths)
         if depth < 0: return [None] * 3
         # assert(depth >= 0), "Depth is less than zero, add check for this."
 
@@ -3,7 +3,20 @@
 
 import cv2
 import numpy as np
+from scipy.spatial import cKDTree
+from multiprocessing.pool import ThreadPool
+
 from pybot.utils.db_utils import AttrDict
+from pybot.vision.image_utils import ImageFrame
+
+# Thread pools shared across detectors, keyed by the number of threads
+_thread_pools = {}
+
+def thread_pool(threads): 
+    """ Shared (module-level) thread pool with the given number of threads """
+    if threads not in _thread_pools: 
+        _thread_pools[threads] = ThreadPool(threads)
+    return _thread_pools[threads]
 
 def finite_and_within_bounds(xys, shape): 
     H, W = shape[:2]
@@ -12,17 +25,133 @@ def finite_and_within_bounds(xys, shape):
     return np.bitwise_and(np.isfinite(xys).all(axis=1), 
                           reduce(lambda x,y: np.bitwise_and(x,y), [xys[:,0] >= 0, xys[:,0] < W, 
                                                                    xys[:,1] >= 0, xys[:,1] < H]))
+# Compact structured-array keypoint representation, 
+# converted to [cv2.KeyPoint, ... ] only at the OpenCV boundary
+kpt_dtype = np.dtype([('x', np.float32), ('y', np.float32), ('size', np.float32), 
+                      ('angle', np.float32), ('response', np.float32), ('octave', np.int32)])
+
+def make_kpts(pts, size=1, angle=-1, response=0, octave=0): 
+    """ Structured keypoints from [N x 2] pts (and scalar or [N] attributes) """
+    pts = np.asarray(pts).reshape(-1,2)
+    kpts = np.empty(len(pts), dtype=kpt_dtype)
+    kpts['x'], kpts['y'] = pts[:,0], pts[:,1]
+    kpts['size'], kpts['angle'] = size, angle
+    kpts['response'], kpts['octave'] = response, octave
+    return kpts
+
+def kpts_to_struct(kpts): 
+    """ Structured keypoints from [cv2.KeyPoint, ... ] """
+    N = len(kpts)
+    out = np.empty(N, dtype=kpt_dtype)
+    if not N: 
+        return out
+    pts = cv2.KeyPoint_convert(kpts) if hasattr(cv2, 'KeyPoint_convert') \
+          else np.float32([ kp.pt for kp in kpts ])
+    pts = pts.reshape(-1,2)
+    out['x'], out['y'] = pts[:,0], pts[:,1]
+    for field in ('size', 'angle', 'response', 'octave'): 
+        out[field] = np.fromiter((getattr(kp, field) for kp in kpts), 
+                                 dtype=kpt_dtype[field], count=N)
+    return out
+
+def struct_to_kpts(kpts): 
+    """ [cv2.KeyPoint, ... ] from structured keypoints """
+    return [cv2.KeyPoint(x, y, size, angle, response, octave) 
+            for (x, y, size, angle, response, octave) in kpts.tolist()]
+
+def is_kpts_struct(kpts): 
+    return isinstance(kpts, np.ndarray) and kpts.dtype == kpt_dtype
+
 def to_kpt(pt, size=1): 
     return cv2.KeyPoint(pt[0], pt[1], size)
 
 def to_kpts(pts, size=1): 
+    if is_kpts_struct(pts): 
+        return struct_to_kpts(pts)
     return [cv2.KeyPoint(pt[0], pt[1], size) for pt in pts]
     
 def to_pts(kpts): 
+    if is_kpts_struct(kpts): 
+        return np.vstack([kpts['x'], kpts['y']]).T.astype(np.float32).reshape(-1,2)
     return np.float32([ kp.pt for kp in kpts ]).reshape(-1,2)
 
 def kpts_to_array(kpts): 
-    return np.float32([ kp.pt for kp in kpts ]).reshape(-1,2)
+    return to_pts(kpts)
+
+def _anms_radii(pts, responses, c_robust=0.9, nn=16, chunksize=256): 
+    """ 
+    Suppression radius of each point, i.e. distance to the nearest 
+    point with response_i < c_robust * response_j (inf if none)
+    """
+    N = len(pts)
+    radii = np.full(N, np.inf)
+
+    # Nearest stronger point among the nn nearest neighbors (sorted by distance)
+    d, j = cKDTree(pts).query(pts, k=min(nn, N))
+    d, j = d.reshape(N,-1), j.reshape(N,-1)
+    stronger = responses[:,np.newaxis] < c_robust * responses[j]
+    found = stronger.any(axis=1)
+    radii[found] = d[found, stronger[found].argmax(axis=1)]
+
+    # Exhaustive search for the rest (chunked), against only the 
+    # (few) sufficiently stronger points, i.e. a prefix of the 
+    # points sorted by decreasing (non-negative) response
+    rest, = np.where(~found)
+    order = np.argsort(-responses, kind='mergesort')
+    sx, sy, sr = pts[order,0], pts[order,1], responses[order]
+    counts = np.searchsorted(-sr, -responses[rest] / c_robust, side='left')
+    rest, counts = rest[np.argsort(counts)], np.sort(counts)
+    for i in xrange(0, len(rest), chunksize): 
+        inds, n = rest[i:i+chunksize], counts[i:i+chunksize].max()
+        if not n: 
+            continue
+        D = (pts[inds,0,np.newaxis] - sx[np.newaxis,:n]) ** 2 + \
+            (pts[inds,1,np.newaxis] - sy[np.newaxis,:n]) ** 2
+        D[responses[inds,np.newaxis] >= c_robust * sr[np.newaxis,:n]] = np.inf
+        radii[inds] = np.sqrt(D.min(axis=1))
+    return radii
+
+def _anms_grid(pts, responses, k): 
+    """ 
+    Grid approximation to ANMS: retain the strongest point in 
+    each of ~k cells, and fill up with the next strongest 
+    """
+    order = np.argsort(-responses, kind='mergesort')
+    lo, hi = pts.min(axis=0), pts.max(axis=0)
+    cell = max(np.sqrt(np.prod(hi - lo + 1) / k), 1)
+    cells = ((pts[order] - lo) // cell).astype(np.int64)
+    lin = cells[:,1] * (cells[:,0].max() + 1) + cells[:,0]
+
+    # First (strongest) point per cell, in order of response
+    _, first = np.unique(lin, return_index=True)
+    best = np.zeros(len(order), dtype=np.bool)
+    best[first] = True
+    return np.r_[order[best], order[~best]][:k]
+
+def anms(pts, responses, k, c_robust=0.9, method='kdtree'): 
+    """
+    Adaptive non-maximal suppression (Brown et al., Multi-image matching 
+    using multi-scale oriented patches, CVPR 2005). 
+
+    Select k well-spread points with the largest suppression radii, where 
+    the radius of a point is the distance to its nearest sufficiently 
+    stronger point. method: 'kdtree' (exact), or 'grid' (approximate)
+
+    Returns indices [k] of the selected points
+    """
+    pts, responses = np.asarray(pts, dtype=np.float64).reshape(-1,2), np.asarray(responses)
+    if k >= len(pts): 
+        return np.argsort(-responses, kind='mergesort')
+    if k <= 0: 
+        return np.empty(0, dtype=np.int64)
+
+    if method == 'kdtree': 
+        radii = _anms_radii(pts, responses, c_robust=c_robust)
+        return np.lexsort((-responses, -radii))[:k]
+    elif method == 'grid': 
+        return _anms_grid(pts, responses, k)
+    else: 
+        raise ValueError('Unknown ANMS method {:}, use kdtree or grid'.format(method))
 
 def get_dense_detector(step=4, levels=7, scale=np.sqrt(2)): 
     """
@@ -99,6 +228,18 @@ class FeatureDetector(object):
 
     Also, you can request for variable pyramid levels of detection, 
     and perform subpixel on the detected keypoints
+
+    selection='anms' retains well-spread features (adaptive non-maximal 
+    suppression, see anms) instead of the strongest ones (selection='response'), 
+    whenever features are subsampled (see select). 
+
+    For gftt and fast, native=True (default if OpenCV does not provide 
+    the Grid/PyramidAdaptedFeatureDetector adapters) splits the image 
+    into grid=(rows, cols) tiles, detects features on each tile (across
+    max_levels pyramid levels) on a shared pool of threads (see 
+    thread_pool), and retains the best max_corners / (rows * cols) 
+    features per tile by response. Tiles that are entirely covered by 
+    occupied cells of an occupancy grid (see detect) are skipped. 
     """
 
     default_params = AttrDict(grid=(12,10), max_corners=1200, 
@@ -114,16 +255,31 @@ class FeatureDetector(object):
                   'semi-dense': SemiDenseFeatureDetector }
 
     def __init__(self, method='fast', grid=(12,10), max_corners=1200, 
-                 max_levels=4, subpixel=False, params=fast_params):
+                 max_levels=4, subpixel=False, params=fast_params, 
+                 native=None, threads=4, selection='response'):
 
         # Determine detector type that implements detect
+        # (OpenCV 3+ constructs detectors via factory methods)
         try: 
-            self.detector_ = FeatureDetector.detectors[method](**params)
+            detector = FeatureDetector.detectors[method]
+            detector = getattr(cv2, detector.__name__ + '_create', detector)
+            self.detector_ = detector(**params)
         except Exception,e:
             raise RuntimeError('Unknown detector type: %s! Use from {:}, {:}'.format(FeatureDetector.detectors.keys(), e))
 
+        # Feature selection
+        if selection not in ('response', 'anms'): 
+            raise ValueError('Unknown selection {:}, use response or anms'.format(selection))
+        self.selection_ = selection
+
+        # Native tile-parallel grid and pyramid detection
+        self.native_ = (method == 'gftt' or method == 'fast') and \
+                       (native if native is not None else 
+                        not hasattr(cv2, 'GridAdaptedFeatureDetector'))
+        self.threads_ = threads
+
         # Only support grid and pyramid with gftt and fast
-        if (method == 'gftt' or method == 'fast'): 
+        if (method == 'gftt' or method == 'fast') and not self.native_: 
             # Establish pyramid
             if max_levels > 0: 
                 self.detector_ = cv2.PyramidAdaptedFeatureDetector(
@@ -160,17 +316,103 @@ class FeatureDetector(object):
     def detector(self): 
         return self.detector_
 
+    def _detect_tile(self, args): 
+        """ Detect and retain the best k features on a tile, across pyramid levels """
+        pyr, masks, (y0, y1, x0, x1), k = args
+        kpts = []
+        for l, im in enumerate(pyr): 
+            sy0, sy1, sx0, sx1 = y0 >> l, y1 >> l, x0 >> l, x1 >> l
+            mask = masks[l][sy0:sy1, sx0:sx1] if masks is not None else None
+            lkpts = kpts_to_struct(self.detector_.detect(im[sy0:sy1, sx0:sx1], mask=mask))
+            lkpts['x'] = (lkpts['x'] + sx0) * (1 << l)
+            lkpts['y'] = (lkpts['y'] + sy0) * (1 << l)
+            lkpts['size'] *= (1 << l)
+            lkpts['octave'] = l
+            kpts.append(lkpts)
+        kpts = np.concatenate(kpts)
+
+        if k > 0: 
+            kpts = self.select(kpts, k)
+        return kpts
+
+    def select(self, kpts, k): 
+        """ Select (at most) k structured keypoints, by response or ANMS """
+        if len(kpts) <= k: 
+            return kpts
+        if self.selection_ == 'anms': 
+            inds = anms(to_pts(kpts), kpts['response'], k)
+        else: 
+            inds = np.argsort(-kpts['response'], kind='mergesort')[:k]
+        return kpts[inds]
+
+    def _detect_native(self, im, mask=None, occupancy=None): 
+        H, W = im.shape[:2]
+
+        # Image and mask pyramids
+        pyr = im.pyramid(self.max_levels_) if isinstance(im, ImageFrame) else [im]
+        while len(pyr) <= self.max_levels_: 
+            pyr.append(cv2.pyrDown(pyr[-1]))
+        masks = None if mask is None else \
+                [mask] + [cv2.resize(mask, (p.shape[1], p.shape[0]), interpolation=cv2.INTER_NEAREST) 
+                          for p in pyr[1:]]
+
+        # Tiles, and features per tile
+        rows, cols = self.grid_ if self.grid_ is not None else (1, 1)
+        ys = np.linspace(0, H, rows+1).astype(np.int64)
+        xs = np.linspace(0, W, cols+1).astype(np.int64)
+        k = self.max_corners_ // (rows * cols) if self.max_corners_ else 0
+        tiles = [(pyr, masks, (ys[i], ys[i+1], xs[j], xs[j+1]), k) 
+                 for i in range(rows) for j in range(cols)]
+
+        # Skip tiles whose cells are all occupied
+        if occupancy is not None and occupancy[0] is not None: 
+            occ, c = occupancy
+            tiles = [tile for tile in tiles if not 
+                     occ[tile[2][0] // c:(tile[2][1] - 1) // c + 1, 
+                         tile[2][2] // c:(tile[2][3] - 1) // c + 1].all()]
+        if not len(tiles): 
+            return np.empty(0, dtype=kpt_dtype)
+
+        # Detect on tiles in parallel (OpenCV releases the GIL)
+        if self.threads_ > 1 and len(tiles) > 1: 
+            results = thread_pool(self.threads_).map(self._detect_tile, tiles)
+        else: 
+            results = map(self._detect_tile, tiles)
+
+        return np.concatenate(results)
+
+    def detect(self, im, mask=None, occupancy=None): 
+        """
+        Detect features, returning structured keypoints 
+        (kpt_dtype) for image or ImageFrame im 
+
+        occupancy: Optional (occupancy grid [H/c x W/c] (bool), cell size c)
+                   of regions that already have features (see 
+                   BaseKLT.occupancy). Native detection skips tiles 
+                   that are entirely occupied.
+        """
+        if self.native_: 
+            return self._detect_native(im, mask=mask, occupancy=occupancy)
+        
+        # Detect features (on the memoized grayscale image of frames)
+        if isinstance(im, ImageFrame): 
+            im = im.gray
+        return kpts_to_struct(self.detector.detect(im, mask=mask))
+
     def process(self, im, mask=None, return_keypoints=False): 
+        # Return keypoints, if necessary (directly 
+        # from the OpenCV detector, when possible)
+        if return_keypoints: 
+            if not self.native_: 
+                return self.detector.detect(im.gray if isinstance(im, ImageFrame) else im, mask=mask)
+            return struct_to_kpts(self.detect(im, mask=mask))
+
         # Detect features 
-        kpts = self.detector.detect(im, mask=mask)
-        pts = to_pts(kpts)
+        pts = to_pts(self.detect(im, mask=mask))
         
         # Perform sub-pixel if necessary
-        if self.subpixel_: self.subpixel_pts(im, pts)
-
-        # Return keypoints, if necessary
-        if return_keypoints: 
-            return kpts
+        if self.subpixel_ and len(pts): 
+            self.subpixel_pts(im.gray if isinstance(im, ImageFrame) else im, pts)
         
         return pts
 
@@ -0,0 +1,209 @@
+"""
+Hamming-space utilities for binary (ORB/BRIEF/BRISK) descriptors,
+stored as packed bits [N x D] uint8 (D bytes, i.e. 8D bits).
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import numpy as np
+from itertools import combinations
+from scipy.sparse import csr_matrix
+
+# Popcount lookup tables for 8-bit and 16-bit words
+_popcount8 = np.array([bin(j).count('1') for j in range(256)], dtype=np.uint8)
+_popcount16 = (_popcount8[np.arange(1 << 16) & 0xff] +
+               _popcount8[np.arange(1 << 16) >> 8]).astype(np.uint8)
+
+def _check_binary(desc):
+    desc = np.asarray(desc)
+    if desc.dtype != np.uint8 or desc.ndim != 2:
+        raise TypeError('Binary descriptors are required to be [N x D] uint8, '
+                        'provided {:} {:}'.format(desc.dtype, desc.shape))
+    return desc
+
+def pack64(desc):
+    """ Packed binary descriptors [N x D] uint8 => [N x ceil(D/8)] uint64 """
+    desc = _check_binary(desc)
+    N, D = desc.shape
+    W = (D + 7) // 8
+    if W * 8 != D:
+        desc = np.hstack([desc, np.zeros((N, W * 8 - D), dtype=np.uint8)])
+    return np.ascontiguousarray(desc).view(np.uint64)
+
+def popcount64(x):
+    """ Number of set bits summed over the last axis of uint64 array x """
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _popcount16[x.view(np.uint16)].sum(axis=-1, dtype=np.int32)
+
+def hamming_distance(a, b):
+    """ Hamming distance between (broadcastable) packed binary (uint8) descriptors """
+    x = np.bitwise_xor(a, b)
+    if x.shape[-1] % 8 == 0:
+        return popcount64(x.view(np.uint64))
+    return _popcount8[x].sum(axis=-1, dtype=np.int32)
+
+def unpack_bits(desc):
+    """ Packed binary descriptors [N x D] uint8 => bits [N x 8D] float32 """
+    return np.unpackbits(_check_binary(desc), axis=1).astype(np.float32)
+
+def hamming_cdist(A, B, blocksize=1024):
+    """
+    Pairwise hamming distances [N x M] between binary descriptors
+    A [N x D] and B [M x D], computed (in blocks of A) as
+    |a| + |b| - 2 a.b over the unpacked bits
+    """
+    Bb = unpack_bits(B)
+    nb = Bb.sum(axis=1)
+    out = np.empty((len(A), len(B)), dtype=np.int32)
+    for i in xrange(0, len(A), blocksize):
+        Ab = unpack_bits(A[i:i+blocksize])
+        out[i:i+blocksize] = Ab.sum(axis=1)[:,np.newaxis] + nb - 2 * Ab.dot(Bb.T)
+    return out
+
+def hamming_nearest(A, B, k=1, blocksize=1024):
+    """
+    Brute-force k-nearest neighbours in B [M x D] of binary descriptors
+    A [N x D]. Returns indices [N x k] and distances [N x k] (sorted),
+    or [N] for k=1
+    """
+    A, B = _check_binary(A), _check_binary(B)
+    k = min(k, len(B))
+    inds = np.empty((len(A), k), dtype=np.int64)
+    dists = np.empty((len(A), k), dtype=np.int32)
+    for i in xrange(0, len(A), blocksize):
+        d = hamming_cdist(A[i:i+blocksize], B, blocksize=blocksize)
+        if k == 1:
+            nn = d.argmin(axis=1)[:,np.newaxis]
+        else:
+            nn = np.argpartition(d, k-1, axis=1)[:,:k]
+            nn = nn[np.arange(len(d))[:,np.newaxis],
+                    np.argsort(d[np.arange(len(d))[:,np.newaxis], nn], axis=1, kind='mergesort')]
+        inds[i:i+blocksize] = nn
+        dists[i:i+blocksize] = d[np.arange(len(d))[:,np.newaxis], nn]
+    return (inds[:,0], dists[:,0]) if k == 1 else (inds, dists)
+
+def kmajority(data, K, iterations=10, seed=0):
+    """
+    k-majority clustering of binary descriptors data [N x D] uint8,
+    returning the [K x D] uint8 codebook (bitwise majority of members)
+    [1] Bags of binary words for fast place recognition in image sequences,
+    D. Galvez-Lopez and J. D. Tardos, IEEE T-RO, 2012.
+    """
+    data = _check_binary(data)
+    if len(data) < K:
+        raise ValueError('kmajority requires at least K={:} descriptors, '
+                         'provided {:}'.format(K, len(data)))
+    rng = np.random.RandomState(seed)
+    bits = unpack_bits(data)
+    C = data[rng.choice(len(data), K, replace=False)]
+    for it in xrange(iterations):
+        labels, _ = hamming_nearest(data, C)
+        counts = np.bincount(labels, minlength=K)
+        votes = csr_matrix((np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))),
+                           shape=(K, len(labels))).dot(bits)
+        Cn = np.packbits(votes * 2 > counts[:,np.newaxis], axis=1)
+
+        # Re-seed empty clusters
+        empty, = np.where(counts == 0)
+        Cn[empty] = data[rng.choice(len(data), len(empty), replace=False)]
+        if np.all(Cn == C):
+            break
+        C = Cn
+    return C
+
+class MultiIndexHash(object):
+    """
+    Multi-index hashing for exact nearest neighbour search in
+    hamming space.
+    [1] Fast exact search in hamming space with multi-index hashing,
+    M. Norouzi, A. Punjani, and D. J. Fleet, IEEE TPAMI, 2014.
+
+    The 8D-bit descriptors are split into m = D/2 16-bit substrings,
+    each indexed by a sorted table. Candidates within radius bits
+    of the query in any substring are verified with the full
+    distance; by the pigeonhole principle, a neighbour found within
+    m * (radius + 1) - 1 bits is exact. Queries without such a
+    neighbour fall back to brute-force search.
+    """
+    def __init__(self, desc, radius=1):
+        desc = _check_binary(desc)
+        if desc.shape[1] % 2:
+            raise ValueError('MultiIndexHash requires an even number of bytes, '
+                             'provided D={:}'.format(desc.shape[1]))
+        self.desc_ = desc
+        self.packed_ = pack64(desc)
+        self.radius_ = radius
+
+        # Sorted substring tables [m x M]
+        keys = np.ascontiguousarray(desc).view(np.uint16).T
+        self.order_ = np.argsort(keys, axis=1, kind='mergesort')
+        self.keys_ = keys[np.arange(len(keys))[:,np.newaxis], self.order_]
+
+        # Substring perturbations within radius bits
+        self.flips_ = np.array([sum(1 << b for b in bits)
+                                for r in range(radius+1)
+                                for bits in combinations(range(16), r)], dtype=np.uint16)
+
+    def __len__(self):
+        return len(self.desc_)
+
+    @property
+    def exact_distance(self):
+        """ Neighbours found within this distance are exact """
+        return self.keys_.shape[0] * (self.radius_ + 1)
+
+    def _candidates(self, Q):
+        """ Candidate (query, database) index pairs """
+        qkeys = np.ascontiguousarray(Q).view(np.uint16)
+        qs, ds = [], []
+        for j, table in enumerate(self.keys_):
+            probes = (qkeys[:,j,np.newaxis] ^ self.flips_).ravel()
+            lo = np.searchsorted(table, probes, side='left')
+            hi = np.searchsorted(table, probes, side='right')
+            lengths = hi - lo
+            inds = np.repeat(lo - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + \
+                   np.arange(lengths.sum())
+            qs.append(np.repeat(np.arange(len(probes)) // len(self.flips_), lengths))
+            ds.append(self.order_[j][inds])
+        return np.concatenate(qs), np.concatenate(ds)
+
+    def query(self, Q):
+        """
+        Exact nearest neighbour of binary descriptors Q [N x D]
+        in the database. Returns indices [N] and distances [N]
+        """
+        Q = _check_binary(Q)
+        inds = np.full(len(Q), -1, dtype=np.int64)
+        dists = np.full(len(Q), np.iinfo(np.int32).max, dtype=np.int32)
+
+        # Verify candidates, and retain the closest one per query
+        qs, ds = self._candidates(Q)
+        if len(qs):
+            d = popcount64(pack64(Q)[qs] ^ self.packed_[ds])
+            order = np.lexsort((ds, d, qs))
+            first = np.concatenate([[True], qs[order][1:] != qs[order][:-1]])
+            best = order[first]
+            inds[qs[best]], dists[qs[best]] = ds[best], d[best]
+
+        # Brute-force search for queries without an exact neighbour
+        missing, = np.where(dists >= self.exact_distance)
+        if len(missing):
+            inds[missing], dists[missing] = hamming_nearest(Q[missing], self.desc_)
+        return inds, dists
+
+def hamming_match(A, B, method='brute', max_distance=None):
+    """
+    Match binary descriptors A [N x D] to their nearest neighbours
+    in B [M x D], with brute-force ('brute') or multi-index hashing
+    ('mih') search. Returns indices into A [K], indices into B [K]
+    and distances [K], for matches within max_distance bits
+    """
+    if method == 'brute':
+        inds, dists = hamming_nearest(A, B)
+    elif method == 'mih':
+        inds, dists = MultiIndexHash(B).query(A)
+    else:
+        raise ValueError('Unknown hamming_match method {:}, use brute or mih'.format(method))
+
+    valid = np.ones(len(inds), dtype=np.bool) if max_distance is None else dists <= max_distance
+    return np.where(valid)[0], inds[valid], dists[valid]
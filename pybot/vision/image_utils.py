@@ -94,6 +94,8 @@ def to_color(im, flip_rb=False):
         return cv2.cvtColor(im, cv2.COLOR_RGB2BGR) if flip_rb else im.copy()
 
 def to_gray(im): 
+    if isinstance(im, ImageFrame): 
+        return im.gray
     if im.ndim == 3: 
         return cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
     else: 
@@ -117,11 +119,17 @@ def variance_of_laplacian(im):
     return cv2.Laplacian(im, cv2.CV_64F).var()
 
 def blur_measure(im): 
-    """ See cv::videostab::calcBlurriness """
+    """ 
+    See cv::videostab::calcBlurriness
+    (ImageFrame uses its memoized grayscale gradients)
+    """
 
     H, W = im.shape[:2]
-    gx = cv2.Sobel(im, cv2.CV_32F, 1, 0)
-    gy = cv2.Sobel(im, cv2.CV_32F, 0, 1)
+    if isinstance(im, ImageFrame): 
+        gx, gy = im.gradients()
+    else: 
+        gx = cv2.Sobel(im, cv2.CV_32F, 1, 0)
+        gy = cv2.Sobel(im, cv2.CV_32F, 0, 1)
     norm_gx, norm_gy = cv2.norm(gx), cv2.norm(gy)
     return 1.0 / ((norm_gx ** 2 + norm_gy ** 2) / (H * W + 1e-6))
 
@@ -153,6 +161,83 @@ def valid_pixels(im, valid):
     xs, ys = np.meshgrid(np.arange(W), np.arange(H))
     return np.dstack([xs[valid], ys[valid], im[valid]]).reshape(-1,3)
 
+class ImageFrame(object): 
+    """
+    Image with memoized derived products (grayscale, blurred, 
+    pyramid levels, gradients, scaled copies), so that multiple 
+    stages of a per-frame pipeline (detection, tracking, description, 
+    blur detection) share a single computation of each. 
+
+    Products are computed on first request and live as long as the 
+    frame (or until clear()); they are shared, and must not be 
+    modified in place. Components may memoize their own products 
+    with memoize(key, func).
+    """
+    def __init__(self, im, copy=False): 
+        self.im_ = np.copy(im) if copy else im
+        self.cache_ = {}
+
+    def __repr__(self): 
+        return 'ImageFrame: {:}, cached {:}'.format(self.im_.shape, sorted(self.cache_.keys()))
+
+    def memoize(self, key, func): 
+        """ Return the product for key, computing it (func()) if necessary """
+        try: 
+            return self.cache_[key]
+        except KeyError: 
+            value = self.cache_[key] = func()
+            return value
+
+    def clear(self): 
+        """ Release all derived products """
+        self.cache_ = {}
+
+    @property
+    def im(self): 
+        return self.im_
+
+    @property
+    def shape(self): 
+        return self.im_.shape
+
+    @property
+    def gray(self): 
+        return self.memoize('gray', lambda: self.im_ if self.im_.ndim == 2 else to_gray(self.im_))
+
+    def blurred(self, size=3): 
+        """ Gaussian blurred grayscale image """
+        return self.memoize(('blurred', size), lambda: gaussian_blur(self.gray, size=size))
+
+    def pyramid(self, levels=4): 
+        """ 
+        Grayscale image pyramid [L0, ..., L_levels], where each 
+        level is half the size of the previous (cv2.pyrDown)
+        """
+        pyr = [self.gray]
+        for l in range(1, levels+1): 
+            prev = pyr[-1]
+            pyr.append(self.memoize(('pyramid', l), lambda: cv2.pyrDown(prev)))
+        return pyr
+
+    def gradients(self, ksize=3): 
+        """ Grayscale Sobel gradients (gx, gy) in float32 """
+        return self.memoize(('gradients', ksize), lambda: (
+            cv2.Sobel(self.gray, cv2.CV_32F, 1, 0, ksize=ksize), 
+            cv2.Sobel(self.gray, cv2.CV_32F, 0, 1, ksize=ksize)))
+
+    def scaled(self, scale=0.5, interpolation=cv2.INTER_AREA): 
+        """ Scaled copy of the image (see im_resize) """
+        return self.memoize(('scaled', scale, interpolation), 
+                            lambda: im_resize(self.im_, scale=scale, interpolation=interpolation))
+
+def to_frame(im): 
+    """ Wrap image as an ImageFrame (frames are returned as is) """
+    return im if isinstance(im, ImageFrame) else ImageFrame(im)
+
+def to_image(im): 
+    """ Raw image of an ImageFrame (images are returned as is) """
+    return im.im if isinstance(im, ImageFrame) else im
+
 
 class MosaicBuilder(object): 
     def __init__(self, filename_template, maxlen=100, shape=(1600,900),
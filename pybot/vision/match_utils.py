@@ -0,0 +1,192 @@
+"""
+Vectorized descriptor matching (float and binary descriptors), returning
+index and distance arrays directly (instead of cv2.DMatch lists).
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from pybot.vision.hamming_utils import hamming_cdist, hamming_distance
+
+def is_binary(desc):
+    return np.asarray(desc).dtype == np.uint8
+
+def cdist(A, B, binary=None):
+    """
+    Pairwise descriptor distances [N x M] (float32), L2 for float
+    descriptors, and hamming for binary (uint8) descriptors
+    """
+    binary = is_binary(A) if binary is None else binary
+    if binary:
+        return hamming_cdist(A, B).astype(np.float32)
+    A, B = np.asarray(A, dtype=np.float32), np.asarray(B, dtype=np.float32)
+    d2 = np.square(A).sum(axis=1)[:,np.newaxis] - 2 * A.dot(B.T) + np.square(B).sum(axis=1)
+    return np.sqrt(np.maximum(d2, 0))
+
+def pair_distances(A, B, q, j, binary=None, chunksize=65536):
+    """ Descriptor distances [K] between pairs A[q] and B[j] (float32) """
+    binary = is_binary(A) if binary is None else binary
+    out = np.empty(len(q), dtype=np.float32)
+    for i in xrange(0, len(q), chunksize):
+        a, b = A[q[i:i+chunksize]], B[j[i:i+chunksize]]
+        out[i:i+chunksize] = hamming_distance(a, b) if binary else \
+                             np.sqrt(np.square(a.astype(np.float32) - b).sum(axis=1))
+    return out
+
+def epipolar_distance(F, pts1, pts2):
+    """
+    Distance of pts2 [.. x 2] from the epipolar lines F x1 of pts1 [.. x 2],
+    (broadcastable, e.g. [N x 1 x 2] and [1 x M x 2] for all pairs)
+    """
+    l = np.einsum('ij,...j->...i', F, np.concatenate([pts1, np.ones(pts1.shape[:-1] + (1,))], axis=-1))
+    return np.abs(l[...,0] * pts2[...,0] + l[...,1] * pts2[...,1] + l[...,2]) / \
+        np.maximum(np.hypot(l[...,0], l[...,1]), 1e-12)
+
+def _topk(q, j, d, n, k):
+    """
+    k smallest distances (and indices) [n x k] per query, from
+    candidate pairs (q, j) with distances d (inf/-1 if none)
+    """
+    inds = np.full((n, k), -1, dtype=np.int64)
+    dists = np.full((n, k), np.inf, dtype=np.float32)
+    if not len(q):
+        return inds, dists
+    order = np.lexsort((j, d, q))
+    q, j, d = q[order], j[order], d[order]
+    first = np.concatenate([[0], np.where(q[1:] != q[:-1])[0] + 1])
+    rank = np.arange(len(q)) - np.repeat(first, np.diff(np.concatenate([first, [len(q)]])))
+    keep = rank < k
+    inds[q[keep], rank[keep]], dists[q[keep], rank[keep]] = j[keep], d[keep]
+    return inds, dists
+
+class DescriptorMatcher(object):
+    """
+    Vectorized descriptor matcher, with Lowe's ratio test, and
+    mutual nearest-neighbour consistency.
+
+    Candidate matches are searched with:
+        brute:       blocked (tiled) brute-force distances, that keep
+                     memory bounded by blocksize x blocksize
+        kdtree:      cKDTree k-nearest neighbours (float descriptors)
+        vocab-tree:  descriptors quantized to the same word of the
+                     supplied vocabulary tree (e.g. bow_utils.VocabularyTree)
+
+    Search can be constrained to keypoints within radius pixels of
+    each other (grid search), or within epipolar_th pixels of the
+    epipolar line of the fundamental matrix F.
+    """
+    def __init__(self, method='brute', ratio=0.8, mutual=True, blocksize=1024,
+                 vtree=None, candidates=16):
+        if method not in ('brute', 'kdtree', 'vocab-tree'):
+            raise ValueError('Unknown DescriptorMatcher method {:}, '
+                             'use brute, kdtree, or vocab-tree'.format(method))
+        if method == 'vocab-tree' and vtree is None:
+            raise ValueError('DescriptorMatcher (vocab-tree) requires a vocabulary tree')
+        self.method = method
+        self.ratio = ratio
+        self.mutual = mutual
+        self.blocksize = blocksize
+        self.vtree = vtree
+        self.candidates = candidates
+
+    def _constraint(self, q, j, pts1, pts2, radius, F, epipolar_th):
+        """ Mask of (broadcastable) pairs q, j satisfying the search constraints """
+        mask = np.ones(np.broadcast(q, j).shape, dtype=np.bool)
+        if radius is not None:
+            mask &= (np.abs(pts1[q] - pts2[j]) <= radius).all(axis=-1)
+        if F is not None:
+            mask &= epipolar_distance(F, pts1[q], pts2[j]) <= epipolar_th
+        return mask
+
+    def _pairs(self, A, B, pts1, pts2, radius):
+        """ Candidate pairs (q, j) for the non-dense search methods """
+        if self.method == 'kdtree':
+            k = min(self.candidates, len(B))
+            _, j = cKDTree(B).query(A, k=k)
+            return np.repeat(np.arange(len(A)), k), j.ravel()
+        elif self.method == 'vocab-tree':
+            wa, wb = self.vtree.quantize(A), self.vtree.quantize(B)
+            order = np.argsort(wb, kind='mergesort')
+            lo = np.searchsorted(wb[order], wa, side='left')
+            lengths = np.searchsorted(wb[order], wa, side='right') - lo
+            inds = np.repeat(lo - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + \
+                   np.arange(lengths.sum())
+            return np.repeat(np.arange(len(A)), lengths), order[inds]
+        else:
+            # Grid (radius) constrained brute-force search
+            S = cKDTree(pts1).sparse_distance_matrix(cKDTree(pts2), radius, p=np.inf,
+                                                     output_type='coo_matrix')
+            return S.row.astype(np.int64), S.col.astype(np.int64)
+
+    def knn(self, A, B, k=2, pts1=None, pts2=None, radius=None, F=None, epipolar_th=1.0):
+        """
+        k-nearest neighbours in B [M x D] of descriptors A [N x D].
+        Returns indices [N x k] (-1 if none) and distances [N x k] (inf if none)
+        """
+        binary = is_binary(A)
+        constrained = radius is not None or F is not None
+        if constrained and (pts1 is None or pts2 is None):
+            raise ValueError('DescriptorMatcher constrained search requires pts1 and pts2')
+        if constrained:
+            pts1, pts2 = np.asarray(pts1, dtype=np.float64), np.asarray(pts2, dtype=np.float64)
+
+        if self.method != 'brute' or radius is not None:
+            q, j = self._pairs(A, B, pts1, pts2, radius)
+            if constrained:
+                valid = self._constraint(q, j, pts1, pts2, radius, F, epipolar_th)
+                q, j = q[valid], j[valid]
+            return _topk(q, j, pair_distances(A, B, q, j, binary=binary), len(A), k)
+
+        # Blocked brute-force, retaining the running k-best per query
+        bs = self.blocksize
+        inds = np.full((len(A), k), -1, dtype=np.int64)
+        dists = np.full((len(A), k), np.inf, dtype=np.float32)
+        for i in xrange(0, len(A), bs):
+            qi = np.arange(i, min(i+bs, len(A)))
+            for j0 in xrange(0, len(B), bs):
+                ji = np.arange(j0, min(j0+bs, len(B)))
+                D = cdist(A[qi], B[ji], binary=binary)
+                if constrained:
+                    D[~self._constraint(qi[:,np.newaxis], ji[np.newaxis,:],
+                                        pts1, pts2, radius, F, epipolar_th)] = np.inf
+                Dk = np.hstack([dists[qi], D])
+                Jk = np.hstack([inds[qi], np.tile(ji, (len(qi), 1))])
+                best = np.argpartition(Dk, k-1, axis=1)[:,:k]
+                rows = np.arange(len(qi))[:,np.newaxis]
+                best = best[rows, np.argsort(Dk[rows, best], axis=1, kind='mergesort')]
+                dists[qi], inds[qi] = Dk[rows, best], Jk[rows, best]
+
+        inds[~np.isfinite(dists)] = -1
+        return inds, dists
+
+    def match(self, desc1, desc2, pts1=None, pts2=None, radius=None, F=None, epipolar_th=1.0):
+        """
+        Match descriptors desc1 [N x D] to desc2 [M x D], with optional
+        keypoints pts1 [N x 2], pts2 [M x 2] for constrained search.
+        Returns indices into desc1 [K], indices into desc2 [K], and
+        distances [K]
+        """
+        desc1, desc2 = np.asarray(desc1), np.asarray(desc2)
+        empty = np.empty(0, dtype=np.int64)
+        if not len(desc1) or not len(desc2):
+            return empty, empty, np.empty(0, dtype=np.float32)
+
+        inds, dists = self.knn(desc1, desc2, k=2 if self.ratio is not None else 1,
+                               pts1=pts1, pts2=pts2, radius=radius, F=F, epipolar_th=epipolar_th)
+        valid = inds[:,0] >= 0
+        if self.ratio is not None:
+            valid &= dists[:,0] < self.ratio * dists[:,1]
+
+        if self.mutual:
+            rinds, _ = self.knn(desc2, desc1, k=1, pts1=pts2, pts2=pts1, radius=radius,
+                                F=F.T if F is not None else None, epipolar_th=epipolar_th)
+            valid &= rinds[np.maximum(inds[:,0], 0), 0] == np.arange(len(desc1))
+
+        idx1, = np.where(valid)
+        return idx1, inds[idx1,0], dists[idx1,0]
+
+def match_descriptors(desc1, desc2, method='brute', ratio=0.8, mutual=True, **kwargs):
+    """ Match descriptors with DescriptorMatcher(method, ratio, mutual).match(desc1, desc2, **kwargs) """
+    return DescriptorMatcher(method=method, ratio=ratio, mutual=mutual).match(desc1, desc2, **kwargs)
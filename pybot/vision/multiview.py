@@ -6,20 +6,20 @@ from collections import deque
 
 from pybot.vision.imshow_utils import imshow_cv
 from pybot.vision.camera_utils import Camera, CameraIntrinsic, CameraExtrinsic, plot_epipolar_line
-from pybot.vision.image_utils import to_gray, to_color, im_resize
+from pybot.vision.image_utils import to_color, im_resize, ImageFrame
 
 from pybot.vision.draw_utils import draw_features
 from pybot.vision.feature_detection import FeatureDetector
 
-class Frame(object): 
+class Frame(ImageFrame): 
+    """
+    Image with its camera, and memoized derived 
+    products (see ImageFrame)
+    """
     def __init__(self, im, camera): 
-        self.im_ = np.copy(im)
+        ImageFrame.__init__(self, im, copy=True)
         self.camera_ = camera
         
-    @property
-    def im(self): 
-        return self.im_
-
     @property
     def camera(self): 
         return self.camera_
@@ -51,22 +51,21 @@ class EpipolarViz(object):
             return
 
         if self.fixed_reference_: 
-            ref_im = self.ref_frame_.im
-            ref_camera = self.ref_frame_.camera
+            ref_frame = self.ref_frame_
             root = -1
         else: 
             assert(root >= 0 and root < len(self.frames_))
             try: 
-                ref_im = self.frames_[root].im
-                ref_camera = self.frames_[root].camera
+                ref_frame = self.frames_[root]
             except: 
                 raise RuntimeError("Unable to index to root")
+        ref_im, ref_camera = ref_frame.im, ref_frame.camera
 
         vis = {}
 
         # Detect features in the reference image
         try: 
-            pts = self.fdet_.process(to_gray(ref_im))
+            pts = self.fdet_.process(ref_frame)
             # pts = pts.reshape(len(pts)/4,-1,2).mean(axis=1)
         except: 
             return
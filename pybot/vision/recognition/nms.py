@@ -6,6 +6,7 @@
 # --------------------------------------------------------
 
 import numpy as np
+from scipy.spatial import cKDTree
 
 def nms(dets, thresh):
     x1 = dets[:, 0]
@@ -35,3 +36,215 @@ def nms(dets, thresh):
         order = order[inds + 1]
 
     return keep
+
+def iou(boxes1, boxes2):
+    """ Pairwise IoU [N x M] of boxes1 [N x 4] and boxes2 [M x 4] (x1, y1, x2, y2) """
+    x11, y11, x21, y21 = [boxes1[:,j:j+1] for j in range(4)]
+    x12, y12, x22, y22 = [boxes2[:,j] for j in range(4)]
+    w = np.minimum(x21, x22)
+    w -= np.maximum(x11, x12)
+    w += 1
+    h = np.minimum(y21, y22)
+    h -= np.maximum(y11, y12)
+    h += 1
+    np.maximum(w, 0, out=w)
+    np.maximum(h, 0, out=h)
+    inter = np.multiply(w, h, out=w)
+    union = (x21 - x11 + 1) * (y21 - y11 + 1) + (x22 - x12 + 1) * (y22 - y12 + 1)
+    union -= inter
+    return np.divide(inter, union, out=inter)
+
+def _nms_matrix(boxes, thresh, top_k):
+    """
+    Greedy suppression of score-sorted boxes [N x 4] with a precomputed
+    IoU matrix [N x N], iterating only over the retained boxes
+    """
+    ovr = iou(boxes, boxes)
+    suppressed = np.zeros(len(boxes), dtype=np.bool)
+    keep = []
+    i = 0
+    while len(keep) < top_k:
+        keep.append(i)
+        suppressed |= ovr[i] > thresh
+        rest = np.flatnonzero(~suppressed[i+1:])
+        if not len(rest):
+            break
+        i += 1 + rest[0]
+    return np.array(keep, dtype=np.int64)
+
+def _suppress_within(boxes, X, r, thresh):
+    """
+    Greedy suppression of score-sorted boxes [N x 4] among themselves,
+    over the sparse graph of overlapping pairs (scaled boxes X within
+    chebyshev distance r), as the fixed point of: a box is retained iff
+    none of its higher-scored overlapping boxes are retained
+    """
+    pairs = cKDTree(X).query_pairs(r, p=np.inf, output_type='ndarray')
+    if not len(pairs):
+        return np.ones(len(boxes), dtype=np.bool)
+    pairs = pairs[_pair_iou(boxes[pairs[:,0]], boxes[pairs[:,1]]) > thresh]
+    parent, child = pairs.min(axis=1), pairs.max(axis=1)
+
+    keep = np.ones(len(boxes), dtype=np.bool)
+    while True:
+        retained = np.ones(len(boxes), dtype=np.bool)
+        retained[child[keep[parent]]] = False
+        if np.all(retained == keep):
+            return keep
+        keep = retained
+
+def _pair_iou(boxes1, boxes2):
+    """ IoU [N] of corresponding boxes1 [N x 4] and boxes2 [N x 4] """
+    w = np.minimum(boxes1[:,2], boxes2[:,2]) - np.maximum(boxes1[:,0], boxes2[:,0]) + 1
+    h = np.minimum(boxes1[:,3], boxes2[:,3]) - np.maximum(boxes1[:,1], boxes2[:,1]) + 1
+    inter = np.maximum(w, 0) * np.maximum(h, 0)
+    return inter / ((boxes1[:,2] - boxes1[:,0] + 1) * (boxes1[:,3] - boxes1[:,1] + 1) +
+                    (boxes2[:,2] - boxes2[:,0] + 1) * (boxes2[:,3] - boxes2[:,1] + 1) - inter)
+
+def _nms_graph(boxes, thresh, top_k, blocksize):
+    """
+    Greedy suppression of score-sorted boxes [N x 4], over blocks
+    of blocksize boxes: each block is first suppressed by the
+    previously retained boxes, and then by itself.
+
+    Only spatially close pairs are compared, since IoU > thresh
+    requires |dx1|, |dx2| < (1 - thresh) max(w) and |dy1|, |dy2| <
+    (1 - thresh) max(h), i.e. the boxes scaled by the largest
+    width and height are within chebyshev distance (1 - thresh).
+    """
+    N = len(boxes)
+    wh = (boxes[:,2:4] - boxes[:,0:2] + 1).max(axis=0)
+    X = boxes / np.tile(wh, 2)
+    r = 1. - thresh
+    if r <= 0:
+        return np.arange(min(N, top_k))
+
+    keep = np.empty(0, dtype=np.int64)
+    for b0 in xrange(0, N, blocksize):
+        if len(keep) >= top_k:
+            break
+        blk = np.arange(b0, min(b0 + blocksize, N))
+
+        # Suppress by previously retained boxes
+        if len(keep):
+            S = cKDTree(X[blk]).sparse_distance_matrix(cKDTree(X[keep]), r, p=np.inf,
+                                                       output_type='coo_matrix')
+            rows, cols = S.row, S.col
+            overlaps = _pair_iou(boxes[blk[rows]], boxes[keep[cols]]) > thresh
+            alive = np.ones(len(blk), dtype=np.bool)
+            alive[rows[overlaps]] = False
+            blk = blk[alive]
+
+        # Suppress within block
+        if len(blk):
+            keep = np.concatenate([keep, blk[_suppress_within(boxes[blk], X[blk], r, thresh)]])
+    return keep[:top_k]
+
+def nms_fast(dets, thresh, top_k=None, method='graph', blocksize=1024):
+    """
+    Greedy NMS (same result as nms), returning (at most) the top_k
+    retained boxes, with early exit.
+       graph:  blocks of score-sorted boxes, compared only against
+               spatially close boxes (see _nms_graph)
+       matrix: precomputed [N x N] IoU matrix (for moderate N)
+    dets: [N x 5] (x1, y1, x2, y2, score), returns indices [K]
+    """
+    if not len(dets):
+        return np.empty(0, dtype=np.int64)
+    top_k = len(dets) if top_k is None else top_k
+    order = dets[:,4].argsort()[::-1]
+    boxes = dets[order,:4].astype(np.float64)
+
+    if method == 'matrix':
+        keep = _nms_matrix(boxes, thresh, top_k)
+    elif method == 'graph':
+        keep = _nms_graph(boxes, thresh, top_k, blocksize)
+    else:
+        raise ValueError('Unknown nms_fast method {:}, use graph, or matrix'.format(method))
+    return order[keep]
+
+def batched_nms(dets, labels, thresh, top_k=None, method='graph'):
+    """
+    Per-class NMS in a single call, by offsetting the boxes of each
+    class (labels [N]) so that boxes of different classes never overlap.
+    top_k applies to the total retained boxes across classes.
+    Returns indices [K]
+    """
+    if not len(dets):
+        return np.empty(0, dtype=np.int64)
+    _, labels = np.unique(labels, return_inverse=True)
+    offset = dets[:,:4].max() - min(dets[:,:4].min(), 0) + 2
+    shifted = dets.astype(np.float64, copy=True)
+    shifted[:,:4] += (labels * offset)[:,np.newaxis]
+    return nms_fast(shifted, thresh, top_k=top_k, method=method)
+
+def soft_nms(dets, thresh=0.3, sigma=0.5, method='linear', score_thresh=0.001,
+             top_k=None, max_matrix=4096):
+    """
+    Soft-NMS: instead of discarding overlapping boxes, decay their
+    scores by (1 - IoU) for IoU > thresh (linear), or by
+    exp(-IoU^2 / sigma) (gaussian). Boxes with decayed scores below
+    score_thresh are dropped; stops once top_k boxes are retained.
+    The IoU matrix is precomputed for N <= max_matrix.
+    [1] Soft-NMS: Improving Object Detection With One Line of Code,
+    N. Bodla, B. Singh, R. Chellappa, and L. S. Davis, In Proc. ICCV, 2017.
+
+    Returns indices [K], and their (decayed) scores [K]
+    """
+    if method not in ('linear', 'gaussian'):
+        raise ValueError('Unknown soft_nms method {:}, use linear or gaussian'.format(method))
+    top_k = len(dets) if top_k is None else top_k
+    boxes, scores = dets[:,:4], dets[:,4].astype(np.float64, copy=True)
+    ovr = iou(boxes, boxes) if len(dets) <= max_matrix else None
+
+    remaining = np.flatnonzero(scores >= score_thresh)
+    keep, keep_scores = [], []
+    while len(remaining) and len(keep) < top_k:
+        j = scores[remaining].argmax()
+        i = remaining[j]
+        keep.append(i)
+        keep_scores.append(scores[i])
+        remaining = np.delete(remaining, j)
+
+        o = ovr[i, remaining] if ovr is not None else iou(boxes[i:i+1], boxes[remaining])[0]
+        if method == 'linear':
+            scores[remaining] *= np.where(o > thresh, 1 - o, 1)
+        else:
+            scores[remaining] *= np.exp(-np.square(o) / sigma)
+        remaining = remaining[scores[remaining] >= score_thresh]
+    return np.array(keep, dtype=np.int64), np.array(keep_scores)
+
+def _random_dets(N, size=1000, seed=0):
+    rng = np.random.RandomState(seed)
+    xy = rng.uniform(0, size, (N, 2))
+    wh = rng.uniform(10, 100, (N, 2))
+    return np.hstack([xy, xy + wh, rng.uniform(0, 1, (N, 1))])
+
+if __name__ == "__main__":
+    import time
+
+    print('{:>8} {:>8} {:>12} {:>12} {:>8}'.format('N', 'kept', 'nms (s)', 'nms_fast (s)', 'speedup'))
+    for N in [1000, 10000, 50000]:
+        dets = _random_dets(N)
+        st = time.time(); keep0 = nms(dets, 0.3); t0 = time.time() - st
+        st = time.time(); keep1 = nms_fast(dets, 0.3); t1 = time.time() - st
+        assert np.all(np.array(keep0) == keep1)
+        print('{:8d} {:8d} {:12.4f} {:12.4f} {:7.1f}x'.format(N, len(keep1), t0, t1, t0 / t1))
+
+    dets = _random_dets(1000)
+    st = time.time(); keep = nms_fast(dets, 0.3, method='matrix'); t = time.time() - st
+    print('nms_fast (matrix, 1000 boxes): {:.4f} s'.format(t))
+    st = time.time(); keep = nms_fast(_random_dets(50000), 0.3, top_k=300); t = time.time() - st
+    print('nms_fast (top_k=300, 50000 boxes): {:.4f} s'.format(t))
+
+    dets, labels = _random_dets(10000), np.random.RandomState(1).randint(0, 20, 10000)
+    st = time.time()
+    keep0 = np.sort(np.concatenate([np.flatnonzero(labels == l)[nms(dets[labels == l], 0.3)]
+                                    for l in np.unique(labels)]))
+    t0 = time.time() - st
+    st = time.time(); keep1 = np.sort(batched_nms(dets, labels, 0.3)); t1 = time.time() - st
+    assert np.all(keep0 == keep1)
+    print('Per-class nms (20 classes, 10000 boxes): loop {:.4f} s, batched {:.4f} s'.format(t0, t1))
+
+    st = time.time(); keep, scores = soft_nms(_random_dets(1000), method='gaussian')
+    print('soft_nms (gaussian, 1000 boxes): {:} kept, {:.4f} s'.format(len(keep), time.time() - st))
@@ -22,7 +22,8 @@ from sklearn.cross_validation import train_test_split, ShuffleSplit
 
 import matplotlib.pyplot as plt
 from pybot.vision.geom_utils import brute_force_match, intersection_over_union
-from pybot.vision.image_utils import im_resize, gaussian_blur, median_blur, box_blur
+from pybot.vision.feature_detection import kpts_to_struct, is_kpts_struct, to_pts
+from pybot.vision.image_utils import im_resize, gaussian_blur, median_blur, box_blur, ImageFrame
 from pybot.utils.io_utils import memory_usage_psutil, format_time
 from pybot.utils.db_utils import AttrDict, IterDB
 from pybot.utils.itertools_recipes import chunks
@@ -291,31 +292,39 @@ def classification_report(y_true, y_pred, labels=None, target_names=None,
 
 
 def root_sift(kpts, desc, eps=1e-7): 
-    """ Compute Root-SIFT on descriptor """
+    """ 
+    Compute Root-SIFT on descriptor 
+    (kpts are structured keypoints, or [cv2.KeyPoint, ...])
+    """
     desc = desc.astype(np.float32)
     desc = np.sqrt(desc / (np.sum(desc, axis=1)[:,np.newaxis] + eps))
     # desc /= (np.linalg.norm(desc, axis=1)[:,np.newaxis] + eps)
 
     inds, = np.where(np.isfinite(desc).all(axis=1))
-    kpts, desc = [kpts[ind] for ind in inds], desc[inds]
-    return kpts, desc
+    kpts = kpts[inds] if is_kpts_struct(kpts) else [kpts[ind] for ind in inds]
+    return kpts, desc[inds]
 
 def im_detect_and_describe(img, mask=None, detector='dense', descriptor='SIFT', colorspace='gray',
                            step=4, levels=7, scale=np.sqrt(2)): 
     """ 
     Describe image using dense sampling / specific detector-descriptor combination. 
+    img may be an ImageFrame, in which case its memoized grayscale 
+    image is used (for colorspace='gray').
     """
     detector = get_detector(detector=detector, step=step, levels=levels, scale=scale)
     extractor = cv2.DescriptorExtractor_create(descriptor)
+    if isinstance(img, ImageFrame): 
+        img = img.gray if colorspace == 'gray' else img.im
 
     try:     
         kpts = detector.detect(img, mask=mask)
         kpts, desc = extractor.compute(img, kpts)
+        kpts = kpts_to_struct(kpts)
         
         if descriptor == 'SIFT': 
             kpts, desc = root_sift(kpts, desc)
 
-        pts = np.vstack([kp.pt for kp in kpts]).astype(np.int32)
+        pts = to_pts(kpts).astype(np.int32)
         return pts, desc
 
     except Exception as e: 
@@ -10,7 +10,7 @@ from scipy.interpolate import LinearNDInterpolator
 from pybot.utils.timer import timeitmethod
 from pybot.utils.db_utils import AttrDict
 
-from pybot.vision.camera_utils import StereoCamera
+from pybot.vision.camera_utils import StereoCamera, undistort_rectify_maps
 from pybot.vision.image_utils import im_resize, gaussian_blur, to_color, to_gray, valid_pixels
 from pybot.vision.imshow_utils import imshow_cv, trackbar_create, trackbar_value
 from pybot.vision.color_utils import colormap
@@ -99,22 +99,23 @@ class StereoBM:
 
 
 class CalibratedStereo(object): 
-    def __init__(self, left, right):
+    def __init__(self, left, right, cache=None):
         self.cams = [left, right]
         self.undistortion_map = {}
         self.rectification_map = {}
         
+        # Fixed-point (CV_16SC2) maps, shared across instances via the map cache
         for cidx, cam in enumerate(self.cams):
-            (self.undistortion_map[cidx], self.rectification_map[cidx]) = cv2.initUndistortRectifyMap(
-                cam.K, cam.D, cam.R, cam.P, cam.shape[:2], cv2.CV_32FC1)
+            (self.undistortion_map[cidx], self.rectification_map[cidx]) = undistort_rectify_maps(
+                cam.K, cam.D, R=cam.R, P=cam.P, shape=cam.shape[:2], cache=cache)
 
     def rectify(self, l, r): 
         """
         Rectify frames passed as (left, right) 
         Remapping is done with nearest neighbor for speed.
         """
-        return [cv2.remap(l, self.undistortion_map[cidx], self.rectification_map[cidx], cv2.INTER_NEAREST)
-                for cidx in range(len(self.cams))]
+        return [cv2.remap(im, self.undistortion_map[cidx], self.rectification_map[cidx], cv2.INTER_NEAREST)
+                for cidx, im in enumerate([l, r])]
         
 
 class CalibratedFastStereo(object): 
@@ -1,6 +1,7 @@
-from ..feature_detection import finite_and_within_bounds, to_kpt, to_kpts, to_pts, kpts_to_array
+from ..feature_detection import finite_and_within_bounds, to_kpt, to_kpts, to_pts, kpts_to_array, \
+    kpt_dtype, make_kpts, kpts_to_struct, struct_to_kpts
 from ..feature_detection import FeatureDetector
-from .tracker_utils import TrackManager, OpticalFlowTracker, LKTracker, FarnebackTracker
+from .tracker_utils import TrackManager, ArrayTrackManager, OpticalFlowTracker, LKTracker, FarnebackTracker
 from .base_klt import BaseKLT, OpenCVKLT
 try: 
     from .base_klt import MeshKLT, BoundingBoxKLT
@@ -31,27 +31,39 @@ from pybot.utils.timer import timeitmethod
 from pybot.utils.plot_utils import colormap
 
 from pybot.vision.imshow_utils import imshow_cv
-from pybot.vision.image_utils import to_color, to_gray, gaussian_blur
+from pybot.vision.image_utils import to_color, to_frame, to_image, ImageFrame
 from pybot.vision.draw_utils import draw_features, draw_lines
 
 
 from pybot.vision.trackers import FeatureDetector, OpticalFlowTracker, LKTracker
 from pybot.vision.trackers import finite_and_within_bounds, to_pts, \
-    TrackManager, FeatureDetector, OpticalFlowTracker, LKTracker
+    ArrayTrackManager, FeatureDetector, OpticalFlowTracker, LKTracker
 
 class BaseKLT(object): 
     """
     General-purpose KLT tracker that combines the use of FeatureDetector and 
-    OpticalFlowTracker class. 
+    OpticalFlowTracker class. Other detectors are supported if they implement 
+    process(im, mask=mask, return_keypoints=True), and the strongest of their 
+    keypoints are retained. 
 
         min_track_length:   Defines the minimum length of the track that returned. 
                             Other shorter tracks are still considered while tracking
         
         max_track_length:   Maximum deque length for track history lookup
 
+        mask_type:          Feature-crowding mask type {circle, grid}. 'circle' masks
+                            a disk of radius mask_size around each tracked point, 
+                            'grid' masks occupied cells (of size 2 * mask_size) of 
+                            an occupancy grid (see occupancy)
+
+        reuse_mask:         Reuse the mask buffer across frames. The mask returned 
+                            by create_mask is then overwritten in-place on the 
+                            next call, and should be copied if it is retained
+
     """
     default_detector_params = AttrDict(method='fast', grid=(12,10), max_corners=1200, 
-                                       max_levels=4, subpixel=False, params=FeatureDetector.fast_params)
+                                       max_levels=4, subpixel=False, params=FeatureDetector.fast_params, 
+                                       selection='anms')
     default_tracker_params = AttrDict(method='lk', fb_check=True, 
                                       params=OpticalFlowTracker.lk_params)
 
@@ -61,49 +73,96 @@ class BaseKLT(object):
     def __init__(self, 
                  detector=default_detector, 
                  tracker=default_tracker,  
-                 min_track_length=2, max_track_length=4, min_tracks=1200, mask_size=9): 
+                 min_track_length=2, max_track_length=4, min_tracks=1200, mask_size=9, 
+                 mask_type='circle', reuse_mask=False): 
         
         # BaseKLT Params
         self.detector_ = detector
         self.tracker_ = tracker
 
         # Track Manager
-        self.tm_ = TrackManager(maxlen=max_track_length)
+        self.tm_ = ArrayTrackManager(maxlen=max_track_length)
         self.min_track_length_ = min_track_length
         self.min_tracks_ = min_tracks
         self.mask_size_ = mask_size
 
+        # Feature-crowding mask
+        if mask_type not in ('circle', 'grid'): 
+            raise ValueError('Mask type {:} undefined, use circle or grid'.format(mask_type))
+        self.mask_type_ = mask_type
+        self.reuse_mask_ = reuse_mask
+        self.mask_kernel_ = cv2.getStructuringElement(
+            cv2.MORPH_ELLIPSE, (2 * mask_size + 1, 2 * mask_size + 1))
+        self.occupancy_ = None
+
     @classmethod
     def from_params(cls, detector_params=default_detector_params, 
                     tracker_params=default_tracker_params,
-                    min_track_length=2, max_track_length=4, min_tracks=1200, mask_size=9): 
+                    min_track_length=2, max_track_length=4, min_tracks=1200, mask_size=9, 
+                    mask_type='circle', reuse_mask=False): 
 
         # Setup detector and tracker
         detector = FeatureDetector(**detector_params)
         tracker = OpticalFlowTracker.create(**tracker_params)
         return cls(detector, tracker, 
                    min_track_length=min_track_length, max_track_length=max_track_length, 
-                   min_tracks=min_tracks, mask_size=mask_size)
+                   min_tracks=min_tracks, mask_size=mask_size, 
+                   mask_type=mask_type, reuse_mask=reuse_mask)
 
     def register_on_track_delete_callback(self, cb): 
         self.tm_.register_on_track_delete_callback(cb)
 
+    def _buffer(self, name, shape): 
+        buf = getattr(self, name, None)
+        if not self.reuse_mask_ or buf is None or buf.shape != shape: 
+            buf = np.empty(shape, dtype=np.uint8)
+            setattr(self, name, buf)
+        return buf
+
     def create_mask(self, shape, pts): 
         """
         Create a mask image to prevent feature extraction around regions
         that already have features detected. i.e prevent feature crowding
         """
+        shape = tuple(shape[:2])
+        H, W = shape
+
+        # Integer pixel locations of tracked (and augmented) points
+        all_pts = [p for p in (getattr(self, 'aug_pts_', None), pts) 
+                   if p is not None and len(p)]
+        all_pts = np.vstack(all_pts).reshape(-1,2) if len(all_pts) \
+                  else np.empty((0,2), dtype=np.float32)
+        xy = all_pts[finite_and_within_bounds(all_pts, shape).astype(np.bool)].astype(np.int64)
+        
+        mask = self._buffer('mask_', shape)
+        if self.mask_type_ == 'grid': 
+            # Occupancy grid via integer binning, upsampled to the mask
+            c = 2 * self.mask_size_
+            occ = np.zeros(((H + c - 1) // c, (W + c - 1) // c), dtype=np.bool)
+            occ[xy[:,1] // c, xy[:,0] // c] = True
+            self.occupancy_ = occ
+
+            free = np.where(occ, 0, 255).astype(np.uint8)
+            np.take(free[np.arange(H) // c], np.arange(W) // c, axis=1, out=mask)
+        else: 
+            # Dilate points with a disk of radius mask_size
+            pim = self._buffer('mask_pts_', shape)
+            pim.fill(0)
+            pim[xy[:,1], xy[:,0]] = 255
+            cv2.dilate(pim, self.mask_kernel_, dst=mask)
+            cv2.bitwise_not(mask, dst=mask)
 
-        mask = np.ones(shape=shape, dtype=np.uint8) * 255
-        all_pts = np.vstack([self.aug_pts_, pts]) if hasattr(self, 'aug_pts_') \
-                  else pts
-        try: 
-            for pt in all_pts: 
-                cv2.circle(mask, tuple(map(int, pt)), self.mask_size_, 0, -1, lineType=cv2.CV_AA)
-        except:
-            pass
         return mask
 
+    @property
+    def occupancy(self): 
+        """
+        Occupancy grid [H/c x W/c] (bool) of the latest grid mask, 
+        and its cell size c. FeatureDetector.detect skips tiles 
+        whose cells are all occupied.
+        """
+        return self.occupancy_, 2 * self.mask_size_
+
     def augment_mask(self, pts): 
         """
         Augment the mask of tracked features with additional features. 
@@ -158,16 +217,7 @@ class BaseKLT(object):
         return out
 
     def matches(self, index1=-2, index2=-1): 
-        tids, p1, p2 = [], [], []
-        for tid, pts in self.tm_.tracks.iteritems(): 
-            if len(pts) > abs(index1) and len(pts) > abs(index2): 
-                tids.append(tid)
-                p1.append(pts.items[index1])
-                p2.append(pts.items[index2]) 
-        try: 
-            return tids, np.vstack(p1), np.vstack(p2)
-        except: 
-            return np.array([]), np.array([]), np.array([])
+        return self.tm_.matches(index1=index1, index2=index2)
 
     def process(self, im, detected_pts=None):
         raise NotImplementedError()
@@ -203,9 +253,14 @@ class OpenCVKLT(BaseKLT):
         self.add_features_ = True
 
     def process(self, im, detected_pts=None):
+        """
+        Track features in image im (ndarray, or ImageFrame whose memoized 
+        blurred grayscale image is shared with other components)
+        """
 
-        # Preprocess
-        self.ims_.append(gaussian_blur(to_gray(im)))
+        # Preprocess (as a frame, so that its LK pyramid is 
+        # memoized, and reused when tracking the next image)
+        self.ims_.append(ImageFrame(to_frame(im).blurred(size=3)))
 
         # Track object
         pids, ppts = self.tm_.ids, self.tm_.pts
@@ -229,10 +284,21 @@ class OpenCVKLT(BaseKLT):
 
             if detected_pts is None: 
 
-                # Detect features
-                new_kpts = self.detector_.process(self.ims_[-1], mask=mask, return_keypoints=True)
                 newlen = max(0, self.min_tracks_ - len(ppts))
-                new_pts = to_pts(sorted(new_kpts, key=lambda kpt: kpt.response, reverse=True)[:newlen])
+                if isinstance(self.detector_, FeatureDetector): 
+                    # Detect features, and retain the strongest (or well-spread). 
+                    # With grid masks, fully occupied tiles are skipped
+                    occupancy = self.occupancy if self.mask_type_ == 'grid' else None
+                    new_kpts = self.detector_.detect(self.ims_[-1], mask=mask, occupancy=occupancy)
+                    new_pts = to_pts(self.detector_.select(new_kpts, newlen))
+                else: 
+                    # Other detectors provide [cv2.KeyPoint, ... ] via process, 
+                    # retain the strongest
+                    new_kpts = self.detector_.process(to_image(self.ims_[-1]), mask=mask, 
+                                                      return_keypoints=True)
+                    responses = np.float32([kpt.response for kpt in new_kpts])
+                    new_pts = to_pts([new_kpts[j] for j in 
+                                      np.argsort(-responses, kind='mergesort')[:newlen]])
             else: 
                 xy = detected_pts.astype(np.int32)
                 valid = mask[xy[:,1], xy[:,0]] > 0
@@ -3,10 +3,12 @@
 import cv2
 import numpy as np
 from copy import deepcopy
-from collections import defaultdict, deque
+from itertools import izip
+from collections import defaultdict, deque, OrderedDict
 
 from pybot.utils.db_utils import AttrDict
 from pybot.utils.timer import timeitmethod
+from pybot.vision.image_utils import ImageFrame
 
 from pybot.vision.feature_detection import to_kpt, to_kpts, to_pts, \
     finite_and_within_bounds
@@ -143,6 +145,235 @@ class TrackManager(object):
         inds, = np.where(self.lengths >= min_length)
         return inds
 
+    def matches(self, index1=-2, index2=-1): 
+        tids, p1, p2 = [], [], []
+        for tid, pts in self.tracks_.iteritems(): 
+            if len(pts) > abs(index1) and len(pts) > abs(index2): 
+                tids.append(tid)
+                p1.append(pts.items[index1])
+                p2.append(pts.items[index2]) 
+        try: 
+            return tids, np.vstack(p1), np.vstack(p2)
+        except: 
+            return np.array([]), np.array([]), np.array([])
+
+    @property
+    def index(self): 
+        return self.index_
+
+class ArrayTrackManager(object): 
+    """
+    Track manager with the same interface as TrackManager, backed by
+    preallocated ring buffers of [capacity x maxlen x 2] points and 
+    [capacity x maxlen] frame indices, along with a free-list of 
+    track slots. Adding, pruning and querying tracks are vectorized
+    array operations, instead of per-track python loops. 
+
+        maxlen:     Maximum track history retained per track
+        capacity:   Initial number of track slots (grows as required)
+    """
+    def __init__(self, maxlen=20, capacity=2048, on_delete_cb=None): 
+        self.maxlen_ = maxlen
+        self.capacity_ = capacity
+
+        # Register callbacks on track delete
+        self.on_delete_cb_ = on_delete_cb
+
+        # Reset tracks before start
+        self.reset()
+
+    def reset(self): 
+        self.index_ = 0
+        self.next_id_ = 0
+
+        # Ring buffers of (time_index, feature) for each slot, 
+        # written at position (length % maxlen)
+        self.pts_ = np.full((self.capacity_, self.maxlen_, 2), np.nan, dtype=np.float32)
+        self.indices_ = np.full((self.capacity_, self.maxlen_), -1, dtype=np.int64)
+        self.ids_ = np.full(self.capacity_, -1, dtype=np.int64)
+        self.lengths_ = np.zeros(self.capacity_, dtype=np.int64)
+        self.latest_index_ = np.full(self.capacity_, -1, dtype=np.int64)
+
+        # Free and active (in order of creation) slots
+        self.free_ = np.arange(self.capacity_, dtype=np.int64)
+        self.active_ = np.empty(0, dtype=np.int64)
+
+    def _grow(self, n): 
+        cap = self.capacity_
+        ncap = max(2 * cap, cap + n)
+        pad = lambda a, fill: np.concatenate(
+            [a, np.full((ncap - cap, ) + a.shape[1:], fill, dtype=a.dtype)])
+
+        self.pts_ = pad(self.pts_, np.nan)
+        self.indices_ = pad(self.indices_, -1)
+        self.ids_ = pad(self.ids_, -1)
+        self.lengths_ = pad(self.lengths_, 0)
+        self.latest_index_ = pad(self.latest_index_, -1)
+        self.free_ = np.r_[self.free_, np.arange(cap, ncap, dtype=np.int64)]
+        self.capacity_ = ncap
+
+    def _allocate(self, tids): 
+        n = len(tids)
+        if n > len(self.free_): 
+            self._grow(n - len(self.free_))
+        slots, self.free_ = self.free_[:n], self.free_[n:]
+
+        self.ids_[slots] = tids
+        self.lengths_[slots] = 0
+        self.pts_[slots] = np.nan
+        self.indices_[slots] = -1
+        self.active_ = np.r_[self.active_, slots]
+        return slots
+
+    def _slots(self, tids): 
+        """ Slots for track ids (-1 if the track does not exist) """
+        slots = np.full(len(tids), -1, dtype=np.int64)
+        if not len(self.active_) or not len(tids): 
+            return slots
+
+        aids = self.ids_[self.active_]
+        order = np.argsort(aids)
+        k = np.searchsorted(aids[order], tids).clip(max=len(aids)-1)
+        found = aids[order[k]] == tids
+        slots[found] = self.active_[order[k[found]]]
+        return slots
+
+    def _history(self, slots, n): 
+        """ 
+        Latest n items (oldest first) of each slot, with 
+        [N x n x 2] points and [N x n] frame indices. 
+        Missing entries are nan (points) and -1 (indices)
+        """
+        L = self.lengths_[slots][:,np.newaxis]
+        k = np.arange(-n+1, 1)
+        pos = (L - 1 + k) % self.maxlen_
+        missing = (-k >= np.minimum(L, self.maxlen_))
+
+        pts = self.pts_[slots[:,np.newaxis], pos]
+        pts[missing] = np.nan
+        inds = self.indices_[slots[:,np.newaxis], pos]
+        inds[missing] = -1
+        return pts, inds
+
+    def _as_tracks(self, slots): 
+        tracks = OrderedDict()
+        pts, inds = self._history(slots, self.maxlen_)
+        for tid, length, tpts, tinds in izip(self.ids_[slots], self.lengths_[slots], pts, inds): 
+            valid = tinds >= 0
+            track = IndexedDeque(maxlen=self.maxlen_)
+            track.items_.extend(tpts[valid])
+            track.indices_.extend(tinds[valid])
+            track.length_ = length
+            tracks[tid] = track
+        return tracks
+
+    def add(self, pts, ids=None, prune=True): 
+        # Add only if valid and non-zero
+        if not len(pts): 
+            return
+
+        # Retain valid points
+        valid = np.isfinite(pts).all(axis=1)
+        pts = pts[valid]
+
+        # ID valid points (ids of deleted tracks are never reused)
+        tids = np.arange(len(pts), dtype=np.int64) + self.next_id_ if ids is None \
+               else np.asarray(ids)[valid].astype(np.int64)
+        if len(tids): 
+            self.next_id_ = max(self.next_id_, tids.max() + 1)
+        
+        # Find existing tracks, and allocate new ones
+        slots = self._slots(tids)
+        new = slots < 0
+        if np.any(new): 
+            slots[new] = self._allocate(tids[new])
+
+        # Add pts to track
+        pos = self.lengths_[slots] % self.maxlen_
+        self.pts_[slots, pos] = pts
+        self.indices_[slots, pos] = self.index_
+        self.lengths_[slots] += 1
+        self.latest_index_[slots] = self.index_
+
+        # If features are propagated
+        if prune: 
+            self.prune()
+
+        # Frame counter
+        self.index_ += 1
+
+    def prune(self): 
+        # Remove tracks that are not most recent
+        stale = self.latest_index_[self.active_] < self.index_
+        dead = self.active_[stale]
+        if self.on_delete_cb_ is not None: 
+            self.on_delete_cb_(self._as_tracks(dead))
+
+        self.ids_[dead] = -1
+        self.latest_index_[dead] = -1
+        self.active_ = self.active_[~stale]
+        self.free_ = np.r_[dead, self.free_]
+                
+    def register_on_track_delete_callback(self, cb): 
+        print('{:}: Register callback for track deletion {:}'
+              .format(self.__class__.__name__, cb))
+        self.on_delete_cb_ = cb
+
+    def history(self, n=None): 
+        """ 
+        Latest n (<= maxlen) points of each track (oldest first), 
+        [N x n x 2], nan-padded for shorter tracks
+        """
+        n = self.maxlen_ if n is None else min(n, self.maxlen_)
+        return self._history(self.active_, n)[0]
+
+    @property
+    def tracks(self): 
+        """ 
+        Tracks as {track_id: IndexedDeque, ...}, ordered consistently 
+        with ids and pts (constructed on request)
+        """
+        return self._as_tracks(self.active_)
+
+    @property
+    def flow(self): 
+        if not len(self.active_): 
+            return np.array([])
+        pts = self.history(2)
+        flow = pts[:,1] - pts[:,0]
+        flow[~np.isfinite(flow)] = 0
+        return flow
+
+    @property
+    def pts(self): 
+        a = self.active_
+        return self.pts_[a, (self.lengths_[a] - 1) % self.maxlen_]
+        
+    @property
+    def ids(self): 
+        return self.ids_[self.active_]
+
+    @property
+    def lengths(self): 
+        return self.lengths_[self.active_].astype(np.int32)
+
+    def confident_tracks(self, min_length=4): 
+        inds, = np.where(self.lengths >= min_length)
+        return inds
+
+    def matches(self, index1=-2, index2=-1): 
+        """
+        Track ids, and their points at (negative) history 
+        indices index1 and index2, for tracks long enough
+        """
+        n = max(abs(index1), abs(index2))
+        if not len(self.active_) or n > self.maxlen_: 
+            return np.array([]), np.array([]), np.array([])
+
+        valid = np.minimum(self.lengths_[self.active_], self.maxlen_) > n
+        pts = self._history(self.active_[valid], n)[0]
+        return self.ids_[self.active_[valid]], pts[:,n+index1], pts[:,n+index2]
+
     @property
     def index(self): 
         return self.index_
@@ -192,9 +423,37 @@ class OpticalFlowTracker(object):
     def track(self, im0, im1, p0):
         raise NotImplementedError()
 
+def lk_supports_pyramids(): 
+    """ 
+    Check (once) if cv2.calcOpticalFlowPyrLK accepts pre-built pyramids, 
+    which depends on the OpenCV python bindings
+    """
+    global _lk_pyramid_support
+    if _lk_pyramid_support is None: 
+        im, pt = np.zeros((16,16), dtype=np.uint8), np.zeros((1,2), dtype=np.float32)
+        try: 
+            _, pyr = cv2.buildOpticalFlowPyramid(im, (5,5), 0)
+            cv2.calcOpticalFlowPyrLK(pyr, pyr, pt, None, winSize=(5,5), maxLevel=0)
+            _lk_pyramid_support = True
+        except (TypeError, AttributeError, cv2.error): 
+            _lk_pyramid_support = False
+    return _lk_pyramid_support
+_lk_pyramid_support = None
+
 class LKTracker(OpticalFlowTracker): 
     """
     OpenCV's LK Tracker (with modifications for forward backward flow check)
+
+    Image pyramids are built once per image (cv2.buildOpticalFlowPyramid), 
+    and shared between the forward and backward passes. Pyramids of 
+    ImageFrames are memoized with the frame, so that they are also 
+    reused for the forward pass of the next frame (raw image buffers 
+    may be reused by the caller, and are never cached). track() also 
+    accepts pre-built pyramids (see pyramid()). If the OpenCV bindings 
+    do not accept pyramids, images are used as is.
+
+    The backward pass only tracks points that were tracked successfully
+    in the forward pass.
     """
 
     default_params = OpticalFlowTracker.lk_params
@@ -202,25 +461,52 @@ class LKTracker(OpticalFlowTracker):
         OpticalFlowTracker.__init__(self, fb_check=fb_check)
         self.lk_params_ = AttrDict(winSize=winSize, maxLevel=maxLevel)
 
+    def _build_pyramid(self, im): 
+        _, pyr = cv2.buildOpticalFlowPyramid(im, tuple(self.lk_params_.winSize), 
+                                             self.lk_params_.maxLevel, withDerivatives=True)
+        return pyr
+
+    def pyramid(self, im): 
+        """
+        Build (or retrieve the memoized) LK image pyramid for image im. 
+        Pyramids (lists) are returned as is, and ImageFrames 
+        memoize the pyramid of their grayscale image. 
+        """
+        if isinstance(im, ImageFrame): 
+            if not lk_supports_pyramids(): 
+                return im.gray
+            return im.memoize(('lk_pyramid', tuple(self.lk_params_.winSize), self.lk_params_.maxLevel), 
+                              lambda: self._build_pyramid(im.gray))
+
+        if isinstance(im, (list, tuple)) or not lk_supports_pyramids(): 
+            return im
+        return self._build_pyramid(im)
+
     # @timeitmethod
     def track(self, im0, im1, p0): 
         """
-        Main tracking method using sparse optical flow (LK)
+        Main tracking method using sparse optical flow (LK), 
+        where im0, im1 are images, ImageFrames or their pyramids
         """
         if p0 is None or not len(p0): 
             return np.array([])
 
+        # Image pyramids (built once, or memoized)
+        pyr0, pyr1 = self.pyramid(im0), self.pyramid(im1)
+
         # Forward flow
-        p1, st1, err1 = cv2.calcOpticalFlowPyrLK(im0, im1, p0, None, **self.lk_params_)
-        p1[st1 == 0] = np.nan
+        p1, st1, err1 = cv2.calcOpticalFlowPyrLK(pyr0, pyr1, p0, None, **self.lk_params_)
+        p1[st1.ravel() == 0] = np.nan
 
         if self.fb_check_: 
-            # Backward flow
-            p0r, st0, err0 = cv2.calcOpticalFlowPyrLK(im1, im0, p1, None, **self.lk_params_)
-            p0r[st0 == 0] = np.nan
+            # Backward flow (only for successfully tracked points)
+            inds, = np.where(st1.ravel() != 0)
+            fb_good = np.zeros(len(p0), dtype=np.bool)
+            if len(inds): 
+                p0r, st0, err0 = cv2.calcOpticalFlowPyrLK(pyr1, pyr0, p1[inds], None, **self.lk_params_)
+                fb_good[inds] = (st0.ravel() != 0) & (np.fabs(p0r-p0[inds]) < 3).all(axis=1)
             
             # Set only good
-            fb_good = (np.fabs(p0r-p0) < 3).all(axis=1)
             p1[~fb_good] = np.nan
 
         return p1
@@ -239,10 +525,15 @@ class FarnebackTracker(OpticalFlowTracker):
 
     # @timeitmethod
     def track(self, im0, im1, p0): 
+        """
+        Main tracking method using dense optical flow (Farneback), 
+        where im0, im1 are images or ImageFrames (of their grayscale image)
+        """
         if p0 is None or not len(p0): 
             return np.array([])
 
-        fflow = cv2.calcOpticalFlowFarneback(im0, im1, **self.farneback_params_)
+        im0, im1 = [im.gray if isinstance(im, ImageFrame) else im for im in (im0, im1)]
+        fflow = cv2.calcOpticalFlowFarneback(im0, im1, flow=None, **self.farneback_params_)
         fflow = cv2.medianBlur(fflow, 5)
 
         # Initialize forward flow and propagated points
@@ -266,7 +557,7 @@ class FarnebackTracker(OpticalFlowTracker):
             p0r = np.ones(shape=p0.shape) * np.nan
             flow_p1 = np.ones(shape=p0.shape) * np.nan
 
-            rflow = cv2.calcOpticalFlowFarneback(im1, im0, **self.farneback_params_)
+            rflow = cv2.calcOpticalFlowFarneback(im1, im0, flow=None, **self.farneback_params_)
             rflow = cv2.medianBlur(rflow, 5)
 
             # Check finite value for pts, and within image bounds
@@ -285,3 +576,39 @@ class FarnebackTracker(OpticalFlowTracker):
             p1 = p0 + flow_p0
 
         return p1
+
+if __name__ == "__main__": 
+    # Benchmark per-frame LK tracking time (fwd-bwd check) over 
+    # an image sequence, with raw images, and with ImageFrames 
+    # (whose pyramids are memoized, and reused across frames)
+    import time
+    from pybot.vision.image_utils import gaussian_blur
+
+    np.random.seed(1)
+    H, W, N, nframes = 480, 640, 1200, 30
+    texture = gaussian_blur(np.random.randint(0, 255, (H+2*nframes, W+2*nframes)).astype(np.uint8), size=5)
+    ims = [texture[i:i+H, i:i+W].copy() for i in range(nframes)]
+    p0 = np.float32(np.random.rand(N, 2) * [W-1, H-1])
+
+    print 'LKTracker: {:} pts, {:}x{:}, {:} frames'.format(N, W, H, nframes)
+    if not lk_supports_pyramids(): 
+        print '\tcv2 {:} does not accept pre-built pyramids in calcOpticalFlowPyrLK, ' \
+            'pyramids cannot be shared or memoized (raw images only)'.format(cv2.__version__)
+
+    for max_level in range(5): 
+        tracker = LKTracker(fb_check=True, maxLevel=max_level)
+        st = time.time()
+        for im0, im1 in izip(ims[:-1], ims[1:]): 
+            tracker.track(im0, im1, p0)
+        traw = (time.time() - st) / (nframes-1) * 1e3
+        if not lk_supports_pyramids(): 
+            print '\tmaxLevel={:}: {:5.2f} ms/frame'.format(max_level, traw)
+            continue
+
+        frames = [ImageFrame(im) for im in ims]
+        st = time.time()
+        for f0, f1 in izip(frames[:-1], frames[1:]): 
+            tracker.track(f0, f1, p0)
+        tframe = (time.time() - st) / (nframes-1) * 1e3
+        print '\tmaxLevel={:}: images {:5.2f} ms/frame, ImageFrames (memoized pyramids) ' \
+            '{:5.2f} ms/frame ({:4.2f}x)'.format(max_level, traw, tframe, traw / tframe)
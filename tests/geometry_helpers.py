@@ -0,0 +1,18 @@
+"""
+Random rotation and pose generators shared across the geometry tests
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import numpy as np
+
+from pybot.geometry.rigid_transform import RigidTransformArray
+
+def random_quats(N, rng):
+    """ Uniformly distributed unit quaternions [N x 4] (xyzw) """
+    q = rng.randn(N, 4)
+    return q / np.linalg.norm(q, axis=1)[:,np.newaxis]
+
+def random_poses(N, rng):
+    """ RigidTransformArray [N] with random rotations and translations """
+    return RigidTransformArray(random_quats(N, rng), rng.randn(N, 3))
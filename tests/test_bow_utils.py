@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Tests for BoWVectorizer vocabulary construction
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+
+from pybot.vision.bow_utils import BoWVectorizer
+
+class TestBoWVectorizer(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(5)
+
+    def test_build_incremental_vocab_tree_float(self):
+        # Float (e.g. SIFT) descriptors collected over calls build a
+        # float vocabulary tree (not a binary tree on truncated bytes)
+        bow = BoWVectorizer(quantizer='vocab-tree', method='bow', branch=4, depth=2)
+        data = [self.rng.rand(200, 16).astype(np.float32) for _ in range(3)]
+        for X in data[:-1]: 
+            bow.build_incremental(X, N=1000)
+        self.assertFalse(bow.ready())
+        bow.build_incremental(data[-1], N=1000, finalize=True)
+
+        self.assertTrue(bow.ready())
+        self.assertFalse(bow.binary)
+        np.testing.assert_allclose(bow.vbuilder__.data, np.vstack(data))
+        code = bow.get_code(data[0])
+        self.assertEqual(len(code), len(data[0]))
+        self.assertTrue(np.all((code >= 0) & (code < bow.K)))
+
+    def test_build_incremental_vocab_tree_binary(self):
+        bow = BoWVectorizer(quantizer='vocab-tree', method='bow', branch=4, depth=2)
+        data = self.rng.randint(0, 256, size=(300, 32)).astype(np.uint8)
+        bow.build_incremental(data, N=1000, finalize=True)
+        self.assertTrue(bow.binary)
+        self.assertEqual(len(bow.get_code(data)), len(data))
+
+if __name__ == "__main__":
+    unittest.main()
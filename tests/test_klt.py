@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Tests for OpenCVKLT, tracking a shifted image with the 
+sparse (lk) and dense (farneback) trackers
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+import cv2
+
+from pybot.vision.trackers import OpenCVKLT, OpticalFlowTracker
+
+class TestOpenCVKLT(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        im = cv2.GaussianBlur((rng.rand(240, 320) * 255).astype(np.uint8), (7,7), 2)
+        self.im0, self.im1 = im[:, 4:-4], im[:, 2:-6]
+
+    def _track(self, method, params):
+        klt = OpenCVKLT.from_params(tracker_params=dict(method=method, fb_check=True, params=params))
+        klt.process(self.im0)
+        ids0, pts0 = klt.latest_ids.copy(), klt.latest_pts.copy()
+        self.assertGreater(len(ids0), 0)
+
+        # Tracked points move by 2 px along x
+        ids1, pts1 = klt.process(self.im1)
+        tracked = np.in1d(ids1, ids0)
+        flow = pts1[tracked] - pts0[np.searchsorted(ids0, ids1[tracked])]
+        good = np.isfinite(flow).all(axis=1)
+        self.assertGreater(good.sum(), len(ids0) / 2)
+        np.testing.assert_allclose(np.median(flow[good], axis=0), [2, 0], atol=0.25)
+
+    def test_lk(self):
+        self._track('lk', OpticalFlowTracker.lk_params)
+
+    def test_dense(self):
+        self._track('dense', OpticalFlowTracker.farneback_params)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Tests for the batched SO(3)/SE(3)/Sim(3) exp/log maps, Jacobians
+and adjoints, against expm and finite differences
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+from scipy.linalg import expm
+
+from pybot.geometry import lie
+from pybot.geometry.quaternion import QuaternionArray
+
+from geometry_helpers import random_poses
+
+def random_axes(N, rng):
+    w = rng.randn(N, 3)
+    return w / np.linalg.norm(w, axis=1)[:,np.newaxis]
+
+class TestLie(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(2)
+        self.N = 30
+
+    def _angles(self):
+        """ Rotation vectors across small, generic, and near-pi angles """
+        axes = random_axes(self.N, self.rng)
+        angles = np.concatenate([[0, 1e-12, 1e-8, 1e-5, 1e-3, 1e-2 - 1e-9, 1e-2 + 1e-9],
+                                 self.rng.uniform(0.1, 3.0, self.N - 11),
+                                 [np.pi - 1e-3, np.pi - 1e-6, np.pi - 1e-9, np.pi]])
+        return axes * angles[:,np.newaxis]
+
+    def test_hat_vee(self):
+        w = self.rng.randn(self.N, 3)
+        v = self.rng.randn(self.N, 3)
+        np.testing.assert_allclose(lie.vee(lie.hat(w)), w)
+        np.testing.assert_allclose(np.einsum('nij,nj->ni', lie.hat(w), v), np.cross(w, v), atol=1e-12)
+
+    def test_so3_exp(self):
+        w = self._angles()
+        expected = np.array([expm(W) for W in lie.hat(w)])
+        np.testing.assert_allclose(lie.so3_exp(w), expected, atol=1e-12)
+        np.testing.assert_allclose(QuaternionArray(lie.quat_exp(w)).R, expected, atol=1e-12)
+
+    def test_so3_exp_log(self):
+        w = self._angles()
+        R = lie.so3_exp(w)
+
+        # log(exp(w)) == w for |w| < pi (at pi, w and -w are equivalent)
+        wl = lie.so3_log(R)
+        below_pi = np.linalg.norm(w, axis=1) < np.pi - 1e-6
+        np.testing.assert_allclose(wl[below_pi], w[below_pi], atol=1e-9)
+        np.testing.assert_allclose(lie.so3_exp(wl), R, atol=1e-9)
+        np.testing.assert_allclose(lie.quat_log(lie.quat_exp(w))[below_pi], w[below_pi], atol=1e-9)
+
+    def test_se3_exp_log(self):
+        xi = np.hstack([self._angles(), self.rng.randn(self.N, 3)])
+        T = lie.se3_exp(xi)
+        expected = np.zeros((self.N, 4, 4))
+        expected[:,:3,:3], expected[:,:3,3] = lie.hat(xi[:,:3]), xi[:,3:]
+        np.testing.assert_allclose(T, np.array([expm(X) for X in expected]), atol=1e-9)
+        np.testing.assert_allclose(lie.se3_exp(lie.se3_log(T)), T, atol=1e-9)
+
+        q, t = lie.se3_exp_quat(xi)
+        np.testing.assert_allclose(QuaternionArray(q).R, T[:,:3,:3], atol=1e-12)
+        np.testing.assert_allclose(t, T[:,:3,3], atol=1e-12)
+
+    def test_sim3_exp_log(self):
+        xi = np.hstack([self._angles(), self.rng.randn(self.N, 3),
+                        np.concatenate([[0, 1e-8, -1e-6], self.rng.uniform(-1, 1, self.N - 3)])[:,np.newaxis]])
+        X = np.zeros((self.N, 4, 4))
+        X[:,:3,:3] = lie.hat(xi[:,:3]) + xi[:,6,np.newaxis,np.newaxis] * np.eye(3)
+        X[:,:3,3] = xi[:,3:6]
+        T = lie.sim3_exp(xi)
+        np.testing.assert_allclose(T, np.array([expm(x) for x in X]), atol=1e-8)
+        np.testing.assert_allclose(lie.sim3_exp(lie.sim3_log(T)), T, atol=1e-8)
+
+    def test_so3_jacobians(self):
+        # exp(w + dw) ~ exp(Jl(w) dw) exp(w) ~ exp(w) exp(Jr(w) dw)
+        w, eps = self._angles()[:-3], 1e-6
+        Jl, Jr = lie.so3_left_jacobian(w), lie.so3_right_jacobian(w)
+        R = lie.so3_exp(w)
+        for j in range(3):
+            dw = np.zeros_like(w)
+            dw[:,j] = eps
+            Rd = lie.so3_exp(w + dw)
+            np.testing.assert_allclose(lie.so3_log(np.einsum('nij,nkj->nik', Rd, R)) / eps,
+                                       Jl[:,:,j], atol=1e-5)
+            np.testing.assert_allclose(lie.so3_log(np.einsum('nji,njk->nik', R, Rd)) / eps,
+                                       Jr[:,:,j], atol=1e-5)
+
+        I = np.tile(np.eye(3), (len(w), 1, 1))
+        np.testing.assert_allclose(np.einsum('nij,njk->nik', lie.so3_left_jacobian_inv(w), Jl), I, atol=1e-9)
+        np.testing.assert_allclose(np.einsum('nij,njk->nik', lie.so3_right_jacobian_inv(w), Jr), I, atol=1e-9)
+
+    def test_se3_jacobians(self):
+        xi, eps = np.hstack([self._angles()[:-3], self.rng.randn(self.N - 3, 3)]), 1e-6
+        Jl = lie.se3_left_jacobian(xi)
+        Tinv = np.linalg.inv(lie.se3_exp(xi))
+        for j in range(6):
+            dxi = np.zeros_like(xi)
+            dxi[:,j] = eps
+            Td = lie.se3_exp(xi + dxi)
+            np.testing.assert_allclose(lie.se3_log(np.einsum('nij,njk->nik', Td, Tinv)) / eps,
+                                       Jl[:,:,j], atol=1e-5)
+        np.testing.assert_allclose(lie.se3_right_jacobian(xi), lie.se3_left_jacobian(-xi))
+
+    def test_sim3_jacobians(self):
+        sigma = np.concatenate([[0, 1e-8, -1e-6], self.rng.uniform(-1, 1, self.N - 6)])
+        xi, eps = np.hstack([self._angles()[:-3], self.rng.randn(self.N - 3, 3), sigma[:,np.newaxis]]), 1e-6
+        Jl = lie.sim3_left_jacobian(xi)
+        Tinv = np.linalg.inv(lie.sim3_exp(xi))
+        for j in range(7):
+            dxi = np.zeros_like(xi)
+            dxi[:,j] = eps
+            Td = lie.sim3_exp(xi + dxi)
+            np.testing.assert_allclose(lie.sim3_log(np.einsum('nij,njk->nik', Td, Tinv)) / eps,
+                                       Jl[:,:,j], atol=1e-5)
+        np.testing.assert_allclose(lie.sim3_right_jacobian(xi), lie.sim3_left_jacobian(-xi))
+
+        # Reduces to the SE(3) Jacobian without scale
+        xi[:,6] = 0
+        np.testing.assert_allclose(lie.sim3_left_jacobian(xi)[:,:6,:6], lie.se3_left_jacobian(xi[:,:6]), atol=1e-9)
+
+    def test_adjoints(self):
+        # exp(Ad(T) xi) == T exp(xi) T^-1
+        T = random_poses(self.N, self.rng).to_matrix()
+        xi = self.rng.randn(self.N, 6) * 0.5
+        lhs = lie.se3_exp(np.einsum('nij,nj->ni', lie.se3_adjoint(T), xi))
+        rhs = np.einsum('nij,njk,nkl->nil', T, lie.se3_exp(xi), np.linalg.inv(T))
+        np.testing.assert_allclose(lhs, rhs, atol=1e-9)
+
+        S = lie.sim3_exp(self.rng.randn(self.N, 7) * 0.5)
+        xi = self.rng.randn(self.N, 7) * 0.5
+        lhs = lie.sim3_exp(np.einsum('nij,nj->ni', lie.sim3_adjoint(S), xi))
+        rhs = np.einsum('nij,njk,nkl->nil', S, lie.sim3_exp(xi), np.linalg.inv(S))
+        np.testing.assert_allclose(lhs, rhs, atol=1e-9)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""
+Tests for the vectorized DescriptorMatcher, against cv2.BFMatcher
+with Lowe's ratio test and mutual consistency check
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+import cv2
+
+from pybot.vision.match_utils import DescriptorMatcher, cdist, epipolar_distance
+
+def bf_match(A, B, ratio, norm):
+    """ Reference cv2.BFMatcher matches (sorted (query, train) pairs) """
+    bf = cv2.BFMatcher(norm)
+    fwd = dict((m.queryIdx, m.trainIdx) for m, n in bf.knnMatch(A, B, k=2)
+               if m.distance < ratio * n.distance)
+    rev = dict((m[0].queryIdx, m[0].trainIdx) for m in bf.knnMatch(B, A, k=1))
+    return sorted((q, t) for q, t in fwd.items() if rev[t] == q)
+
+class TestDescriptorMatcher(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.rng = rng
+
+        # Float descriptors, with 400 noisy correspondences
+        self.A = rng.rand(700, 64).astype(np.float32)
+        self.B = np.vstack([self.A[:400] + 0.05 * rng.randn(400, 64).astype(np.float32),
+                            rng.rand(600, 64).astype(np.float32)])
+
+        # Binary descriptors, with 400 correspondences (2 bits flipped)
+        self.Ab = rng.randint(0, 256, (700, 32)).astype(np.uint8)
+        self.Bb = np.vstack([self.Ab[:400], rng.randint(0, 256, (300, 32)).astype(np.uint8)])
+        self.Bb[:400,0] ^= 3
+
+        # Keypoints, with correspondences perturbed by ~1px
+        self.p1 = rng.rand(700, 2) * 640
+        self.p2 = np.vstack([self.p1[:400] + rng.randn(400, 2), rng.rand(600, 2) * 640])
+
+    def test_brute_float(self):
+        expected = bf_match(self.A, self.B, 0.8, cv2.NORM_L2)
+        for blocksize in (128, 1024):
+            i1, i2, d = DescriptorMatcher(blocksize=blocksize).match(self.A, self.B)
+            self.assertEqual(sorted(zip(i1, i2)), expected)
+            np.testing.assert_allclose(d, np.linalg.norm(self.A[i1] - self.B[i2], axis=1),
+                                       rtol=1e-4, atol=1e-4)
+
+    def test_brute_hamming(self):
+        expected = bf_match(self.Ab, self.Bb, 0.8, cv2.NORM_HAMMING)
+        for blocksize in (128, 1024):
+            i1, i2, d = DescriptorMatcher(blocksize=blocksize).match(self.Ab, self.Bb)
+            self.assertEqual(sorted(zip(i1, i2)), expected)
+            np.testing.assert_array_equal(d, 2)
+
+    def test_ratio_mutual(self):
+        # Without ratio test and mutual check, every query is matched to its nearest neighbour
+        i1, i2, _ = DescriptorMatcher(ratio=None, mutual=False).match(self.A, self.B)
+        np.testing.assert_array_equal(i1, np.arange(len(self.A)))
+        np.testing.assert_array_equal(i2, cdist(self.A, self.B).argmin(axis=1))
+
+        bf = cv2.BFMatcher(cv2.NORM_L2)
+        expected = sorted((m.queryIdx, m.trainIdx) for m, n in bf.knnMatch(self.A, self.B, k=2)
+                          if m.distance < 0.8 * n.distance)
+        i1, i2, _ = DescriptorMatcher(mutual=False).match(self.A, self.B)
+        self.assertEqual(sorted(zip(i1, i2)), expected)
+
+    def test_knn(self):
+        D = cdist(self.A, self.B)
+        inds, dists = DescriptorMatcher(blocksize=256).knn(self.A, self.B, k=3)
+        np.testing.assert_allclose(dists, np.sort(D, axis=1)[:,:3], atol=1e-3)
+        np.testing.assert_allclose(D[np.arange(len(D))[:,np.newaxis], inds], dists, atol=1e-3)
+
+    def test_kdtree(self):
+        # With all database descriptors as candidates, kdtree is exact
+        expected = DescriptorMatcher().match(self.A, self.B)
+        i1, i2, _ = DescriptorMatcher(method='kdtree', candidates=len(self.A) + len(self.B)) \
+                    .match(self.A, self.B)
+        np.testing.assert_array_equal(i1, expected[0])
+        np.testing.assert_array_equal(i2, expected[1])
+
+    def test_radius(self):
+        D = cdist(self.A, self.B)
+        D[(np.abs(self.p1[:,np.newaxis] - self.p2[np.newaxis]) > 5).any(axis=-1)] = np.inf
+        expected = np.sort(D, axis=1)[:,:2]
+        for blocksize in (128, 1024):
+            inds, dists = DescriptorMatcher(blocksize=blocksize).knn(
+                self.A, self.B, k=2, pts1=self.p1, pts2=self.p2, radius=5)
+            np.testing.assert_allclose(dists, expected, atol=1e-3)
+            self.assertTrue(np.all((inds >= 0) == np.isfinite(expected)))
+
+    def test_epipolar(self):
+        # Pure x-translation, epipolar lines are image rows
+        F = np.array([[0, 0, 0], [0, 0, -1], [0, 1, 0.]])
+        p2 = np.vstack([self.p1[:400] + [5, 0], self.rng.rand(600, 2) * 640])
+        D = cdist(self.A, self.B)
+        D[epipolar_distance(F, self.p1[:,np.newaxis], p2[np.newaxis]) > 1.0] = np.inf
+        inds, dists = DescriptorMatcher(blocksize=256).knn(self.A, self.B, k=2, pts1=self.p1, pts2=p2, F=F)
+        np.testing.assert_allclose(dists, np.sort(D, axis=1)[:,:2], atol=1e-3)
+
+        i1, i2, _ = DescriptorMatcher().match(self.A, self.B, pts1=self.p1, pts2=p2, F=F)
+        self.assertTrue(np.all(i2[i1 < 400] == i1[i1 < 400]))
+        self.assertGreater(np.sum(i1 < 400), 350)
+
+    def test_empty(self):
+        i1, i2, d = DescriptorMatcher().match(self.A[:0], self.B)
+        self.assertEqual((len(i1), len(i2), len(d)), (0, 0, 0))
+
+if __name__ == "__main__":
+    unittest.main()
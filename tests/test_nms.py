@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Tests for nms_fast, batched_nms and soft_nms, against the
+reference (greedy) nms
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+
+from pybot.vision.recognition.nms import nms, iou, nms_fast, batched_nms, soft_nms, _random_dets
+
+def clustered_dets(N, clusters=20, seed=0):
+    """ Heavily overlapping detections, jittered around a few boxes """
+    rng = np.random.RandomState(seed)
+    centers = _random_dets(clusters, seed=seed)[:,:4]
+    boxes = centers[rng.randint(0, clusters, N)] + rng.randn(N, 4) * 5
+    boxes[:,2:] = np.maximum(boxes[:,2:], boxes[:,:2] + 1)
+    return np.hstack([boxes, rng.uniform(0, 1, (N, 1))])
+
+def soft_nms_reference(dets, thresh, sigma, method, score_thresh):
+    """ Per-box loop implementation of soft-NMS """
+    scores = dets[:,4].astype(np.float64, copy=True)
+    remaining = [i for i in range(len(dets)) if scores[i] >= score_thresh]
+    keep, keep_scores = [], []
+    while remaining:
+        i = max(remaining, key=lambda j: scores[j])
+        keep.append(i)
+        keep_scores.append(scores[i])
+        remaining.remove(i)
+        for j in remaining:
+            o = iou(dets[i:i+1,:4], dets[j:j+1,:4])[0,0]
+            if method == 'linear':
+                scores[j] *= (1 - o) if o > thresh else 1
+            else:
+                scores[j] *= np.exp(-o * o / sigma)
+        remaining = [j for j in remaining if scores[j] >= score_thresh]
+    return keep, keep_scores
+
+class TestNMS(unittest.TestCase):
+    def setUp(self):
+        self.dets = [_random_dets(2000, seed=seed) for seed in range(3)] + \
+                    [_random_dets(500, size=200, seed=3), clustered_dets(1000)]
+
+    def test_nms_fast(self):
+        for dets in self.dets:
+            for thresh in (0.1, 0.3, 0.5, 0.7, 0.9):
+                expected = np.array(nms(dets, thresh))
+                for method in ('graph', 'matrix'):
+                    np.testing.assert_array_equal(nms_fast(dets, thresh, method=method), expected)
+
+    def test_blocksize(self):
+        dets = self.dets[0]
+        expected = np.array(nms(dets, 0.3))
+        for blocksize in (1, 64, 5000):
+            np.testing.assert_array_equal(nms_fast(dets, 0.3, blocksize=blocksize), expected)
+
+    def test_top_k(self):
+        for dets in self.dets:
+            expected = np.array(nms(dets, 0.5))
+            for top_k in (1, 10, 100, len(dets)):
+                for method in ('graph', 'matrix'):
+                    np.testing.assert_array_equal(nms_fast(dets, 0.5, top_k=top_k, method=method),
+                                                  expected[:top_k])
+
+    def test_empty(self):
+        for method in ('graph', 'matrix'):
+            self.assertEqual(len(nms_fast(np.empty((0, 5)), 0.3, method=method)), 0)
+        self.assertEqual(len(batched_nms(np.empty((0, 5)), np.empty(0), 0.3)), 0)
+        self.assertRaises(ValueError, nms_fast, self.dets[0], 0.3, method='unknown')
+
+    def test_batched_nms(self):
+        rng = np.random.RandomState(0)
+        for dets in self.dets:
+            labels = rng.randint(0, 10, len(dets))
+            expected = np.sort(np.concatenate([np.flatnonzero(labels == l)[nms(dets[labels == l], 0.3)]
+                                               for l in np.unique(labels)]))
+            for method in ('graph', 'matrix'):
+                np.testing.assert_array_equal(np.sort(batched_nms(dets, labels, 0.3, method=method)),
+                                              expected)
+
+    def test_soft_nms(self):
+        dets = clustered_dets(200)
+        for method in ('linear', 'gaussian'):
+            expected, expected_scores = soft_nms_reference(dets, 0.3, 0.5, method, 0.001)
+            for max_matrix in (0, 4096):
+                keep, scores = soft_nms(dets, 0.3, sigma=0.5, method=method, max_matrix=max_matrix)
+                np.testing.assert_array_equal(keep, expected)
+                np.testing.assert_allclose(scores, expected_scores, rtol=1e-12)
+
+            keep, _ = soft_nms(dets, 0.3, sigma=0.5, method=method, top_k=10)
+            np.testing.assert_array_equal(keep, expected[:10])
+        self.assertRaises(ValueError, soft_nms, dets, method='unknown')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Tests for QuaternionArray, against the scalar Quaternion and
+transformations.py paths
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+
+import pybot.geometry.transformations as tf
+from pybot.geometry import lie
+from pybot.geometry.quaternion import Quaternion, QuaternionArray
+
+from geometry_helpers import random_quats
+
+def same_rotation(q1, q2, atol=1e-9):
+    """ Quaternions q and -q represent the same rotation """
+    return np.allclose(np.fabs(np.sum(q1 * q2, axis=-1)), 1, atol=atol)
+
+class TestQuaternionArray(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.N = 50
+        self.q0 = QuaternionArray(random_quats(self.N, self.rng))
+        self.q1 = QuaternionArray(random_quats(self.N, self.rng))
+
+    def test_multiply(self):
+        q = (self.q0 * self.q1).q
+        expected = np.vstack([tf.quaternion_multiply(a, b) for a, b in zip(self.q0.q, self.q1.q)])
+        np.testing.assert_allclose(q, expected, atol=1e-12)
+
+    def test_inverse(self):
+        q = (self.q0 * self.q0.inverse()).q
+        self.assertTrue(same_rotation(q, QuaternionArray.identity(self.N).q))
+
+    def test_rotate(self):
+        v = self.rng.randn(self.N, 3)
+        expected = np.vstack([Quaternion(q).rotate(x) for q, x in zip(self.q0.q, v)])
+        np.testing.assert_allclose(self.q0.rotate(v), expected, atol=1e-12)
+
+        outer = self.q0.rotate(v, outer=True)
+        self.assertEqual(outer.shape, (self.N, self.N, 3))
+        np.testing.assert_allclose(outer[3], np.dot(v, self.q0.R[3].T), atol=1e-12)
+
+    def test_matrix_roundtrip(self):
+        R = self.q0.to_matrix()
+        expected = np.array([Quaternion(q).to_matrix()[:3,:3] for q in self.q0.q])
+        np.testing.assert_allclose(R[:,:3,:3], expected, atol=1e-12)
+        self.assertTrue(same_rotation(QuaternionArray.from_matrix(R).q, self.q0.q))
+
+    def test_rpy(self):
+        expected = np.vstack([Quaternion(q).to_rpy() for q in self.q0.q])
+        np.testing.assert_allclose(self.q0.to_rpy(), expected, atol=1e-9)
+        rpy = self.q0.to_rpy()
+        q = QuaternionArray.from_rpy(rpy[:,0], rpy[:,1], rpy[:,2])
+        self.assertTrue(same_rotation(q.q, self.q0.q))
+
+    def test_slerp_endpoints(self):
+        self.assertTrue(same_rotation(self.q0.slerp(self.q1, 0).q, self.q0.q))
+        self.assertTrue(same_rotation(self.q0.slerp(self.q1, 1).q, self.q1.q))
+
+        # Nearly identical quaternions (numerically unstable region)
+        q = self.q0.slerp(self.q0, self.rng.rand(self.N))
+        self.assertTrue(same_rotation(q.q, self.q0.q))
+
+    def test_slerp_midpoint(self):
+        # Constant angular velocity: angle(q0, qw) = w * angle(q0, q1)
+        w = self.rng.rand(self.N)
+        qw = self.q0.slerp(self.q1, w)
+        angle = lambda a, b: np.linalg.norm(lie.quat_log((a.inverse() * b).q), axis=1)
+        np.testing.assert_allclose(angle(self.q0, qw), w * angle(self.q0, self.q1), atol=1e-9)
+
+    def test_interpolate(self):
+        w = 0.3
+        expected = np.vstack([Quaternion(a).interpolate(Quaternion(b), w).q
+                              for a, b in zip(self.q0.q, self.q1.q)])
+        self.assertTrue(same_rotation(self.q0.interpolate(self.q1, w).q, expected))
+
+if __name__ == "__main__":
+    unittest.main()
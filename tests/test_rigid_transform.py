@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Tests for RigidTransform and Sim3 point transformations, against
+the homogeneous matrix path
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+
+from pybot.geometry import lie
+from pybot.geometry.rigid_transform import RigidTransform, Sim3
+
+from geometry_helpers import random_quats
+
+def homogeneous_transform(T, X):
+    """ Transform [N x 3] points with the [4 x 4] matrix T
+    (without normalizing the homogeneous coordinate) """
+    X = np.hstack([X, np.ones((len(X),1))]).T
+    return (np.dot(T, X).T)[:,:3]
+
+class TestRigidTransform(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(3)
+        self.X = self.rng.randn(40, 3)
+
+    def test_transform_points(self):
+        p = RigidTransform(random_quats(1, self.rng)[0], self.rng.randn(3))
+        np.testing.assert_allclose(p * self.X, homogeneous_transform(p.matrix, self.X), atol=1e-12)
+
+        Y = p * self.X.astype(np.float32)
+        self.assertEqual(Y.dtype, np.float32)
+        np.testing.assert_allclose(Y, homogeneous_transform(p.matrix, self.X), atol=1e-5)
+
+    def test_sim3_transform_points(self):
+        p = Sim3(random_quats(1, self.rng)[0], self.rng.randn(3), scale=2.5)
+        np.testing.assert_allclose(p * self.X, homogeneous_transform(p.matrix, self.X), atol=1e-12)
+        np.testing.assert_allclose(p * self.X, np.dot(self.X, p.R.T) / 2.5 + p.tvec, atol=1e-12)
+
+        # Cache is invalidated with a new scale
+        p.scale = 0.5
+        np.testing.assert_allclose(p * self.X, homogeneous_transform(p.matrix, self.X), atol=1e-12)
+
+    def test_sim3_exp_log(self):
+        xi = np.hstack([self.rng.randn(6), 0.7])
+        p = Sim3.exp(xi)
+        np.testing.assert_allclose(p.scale, np.exp(-0.7))
+        np.testing.assert_allclose(p.log(), xi, atol=1e-9)
+
+        # to_matrix and the Lie group operations describe the same transformation
+        np.testing.assert_allclose(p.to_matrix()[:3], lie.sim3_exp(xi)[0,:3], atol=1e-9)
+        np.testing.assert_allclose(p * self.X, homogeneous_transform(lie.sim3_exp(xi)[0], self.X), atol=1e-9)
+        np.testing.assert_allclose(Sim3.from_matrix(p.to_matrix()).log(), xi, atol=1e-9)
+
+if __name__ == "__main__":
+    unittest.main()
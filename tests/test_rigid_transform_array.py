@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Tests for RigidTransformArray, against the list of RigidTransform path
+"""
+# Author: Sudeep Pillai <spillai@csail.mit.edu>
+# License: MIT
+
+import unittest
+import numpy as np
+
+from pybot.geometry.rigid_transform import RigidTransform, RigidTransformArray
+
+from geometry_helpers import random_poses
+
+class TestRigidTransformArray(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(1)
+        self.N = 50
+        self.p0 = random_poses(self.N, self.rng)
+        self.p1 = random_poses(self.N, self.rng)
+
+    def assertPosesEqual(self, pa, pb, atol=1e-9):
+        self.assertEqual(len(pa), len(pb))
+        np.testing.assert_allclose(pa.to_matrix(), RigidTransformArray.from_list(list(pb)).to_matrix()
+                                   if isinstance(pb, list) else pb.to_matrix(), atol=atol)
+
+    def test_indexing(self):
+        self.assertIsInstance(self.p0[3], RigidTransform)
+        self.assertIsInstance(self.p0[2:5], RigidTransformArray)
+        self.assertEqual(len(self.p0[2:5]), 3)
+        self.assertPosesEqual(RigidTransformArray.from_list(self.p0.to_list()), self.p0)
+
+    def test_oplus(self):
+        expected = [a.oplus(b) for a, b in zip(self.p0.to_list(), self.p1.to_list())]
+        self.assertPosesEqual(self.p0.oplus(self.p1), expected)
+        self.assertPosesEqual(self.p0 * self.p1, expected)
+
+        # Broadcast a single pose
+        p = self.p1[0]
+        self.assertPosesEqual(self.p0.oplus(p), [a.oplus(p) for a in self.p0.to_list()])
+
+    def test_inverse(self):
+        expected = [a.inverse() for a in self.p0.to_list()]
+        self.assertPosesEqual(self.p0.inverse(), expected)
+        self.assertPosesEqual(self.p0.oplus(self.p0.inverse()), RigidTransformArray.identity(self.N))
+
+    def test_ominus_relative(self):
+        expected = [b.inverse().oplus(a) for a, b in zip(self.p0.to_list(), self.p1.to_list())]
+        self.assertPosesEqual(self.p0.ominus(self.p1), expected)
+
+        poses = self.p0.to_list()
+        expected = [a.inverse().oplus(b) for a, b in zip(poses[:-2], poses[2:])]
+        self.assertPosesEqual(self.p0.relative(step=2), expected)
+        self.assertRaises(ValueError, self.p0.relative, step=0)
+
+    def test_matrix_roundtrip(self):
+        T = self.p0.to_matrix()
+        np.testing.assert_allclose(T, np.array([p.to_matrix() for p in self.p0.to_list()]), atol=1e-12)
+        self.assertPosesEqual(RigidTransformArray.from_matrix(T), self.p0)
+
+    def test_transform_points(self):
+        X = self.rng.randn(20, 3)
+        Y = self.p0 * X
+        self.assertEqual(Y.shape, (self.N, 20, 3))
+        for p, y in zip(self.p0.to_list(), Y):
+            np.testing.assert_allclose(y, p * X, atol=1e-12)
+
+    def test_log_exp(self):
+        xi = self.p0.log()
+        np.testing.assert_allclose(xi, np.vstack([p.log() for p in self.p0.to_list()]), atol=1e-12)
+        self.assertPosesEqual(RigidTransformArray.exp(xi), self.p0)
+
+if __name__ == "__main__":
+    unittest.main()